@@ -1,340 +1,267 @@
 import streamlit as st
-import pandas as pd
-import yfinance as yf
-import requests
+import os
 import time
 import json
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 from datetime import datetime
-import plotly.express as px
-import plotly.graph_objects as go
-import urllib3
-
-# 忽略 SSL 警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+from lazy import lazy_import
+from metrics import METRICS
 
 # 設定頁面配置 (注意：這裡加了 v2.0 方便您確認更新成功)
 st.set_page_config(page_title="全功能資產管家 Pro v2.0", layout="wide", page_icon="📈")
 
-# --- 股票代碼與名稱對照表 (可自行擴充) ---
-STOCK_MAP = {
-    '2330.TW': '台積電', '2317.TW': '鴻海', '2454.TW': '聯發科',
-    '2603.TW': '長榮', '2609.TW': '陽明', '2615.TW': '萬海',
-    '3231.TW': '緯創', '2382.TW': '廣達', '3017.TW': '奇鋐',
-    '2301.TW': '光寶科', '6488.TWO': '環球晶', '8271.TWO': '宇瞻',
-    '00685L.TW': '群益台指正2', '00670L.TW': '元大NASDAQ正2',
-    'NVDA': '輝達', 'AAPL': '蘋果', 'TSLA': '特斯拉', 'AMD': '超微',
-    'MSFT': '微軟', 'GOOG': '谷歌', 'AMZN': '亞馬遜',
-    '0050.TW': '元大台灣50', 'SPY': 'S&P 500', 'QQQ': '納斯達克100'
-}
-
-# --- Google Sheets 連線與資料處理 ---
+# --- 登入介面 ---
+if 'current_user' not in st.session_state:
+    st.session_state.current_user = None
+
+if not st.session_state.current_user:
+    st.markdown("<h1 style='text-align: center;'>🔐 股票資產管家 Pro v2.0</h1>", unsafe_allow_html=True)
+    c1, c2, c3 = st.columns([1,2,1])
+    with c2:
+        with st.form("login_form"):
+            user_input = st.text_input("使用者名稱")
+            pwd_input = st.text_input("密碼", type="password")
+            submit = st.form_submit_button("登入", use_container_width=True)
+            
+            if submit:
+                users_db = st.secrets.get("passwords", {})
+                if user_input in users_db and str(users_db[user_input]) == str(pwd_input):
+                    st.session_state.current_user = user_input
+                    st.success("登入成功！")
+                    st.rerun()
+                else:
+                    st.error("帳號或密碼錯誤")
+    st.stop()
+
+# --- 登入後才載入的模組 ---
+# yfinance / gspread / oauth2client / plotly 再延後到第一次使用時才載入
+import pandas as pd
+from market import QuoteCache, QuoteRefresher, snapshot_errors, quotes_time, empty_quote, market_of, is_market_open, fetch_fx_rates, REFRESH_INTERVAL_OPEN
+from fx import FxTable, foreign_currencies
+from valuation import value_account, cost_basis_twd, sell_basis_twd, DISPLAY_COLUMNS
+from sheets import SheetPool, WriteBehind, authorize
+from storage import GoogleSheetsBackend, SQLiteBackend, commit_event
+from history_store import HistoryMirror
+from reconstruct import backfill_history
+from returns import ReturnTracker, cash_flows, row_flows
+from risk import RiskEngine, RISK_BENCHMARKS
+from margin import margin_book, margin_alerts, MARGIN_CALL_RATIO, MARGIN_WARN_RATIO
+from price_store import PriceStore
+from events import buy_event, sell_event, cash_event, principal_event, delete_event
+from ledger import COST_METHODS
+from realized import realized_index, BREAKDOWNS
+from symbols import load_directory
+from tables import FormattedTable, history_frame, page_count, PAGE_SIZES, HOLDINGS_FORMATS, HOLDINGS_COLORED, HISTORY_FORMATS, HISTORY_COLORED, BREAKDOWN_FORMATS
+
+px = lazy_import('plotly.express')
+go = lazy_import('plotly.graph_objects')
+
+# --- 股票代碼與名稱 (symbols.csv，第一次使用時載入) ---
+@st.cache_resource
+def get_symbols():
+    return load_directory()
+
+def is_known_symbol(code):
+    """代碼在清單內，或清單未收錄但抓得到報價 (避免打錯代碼後一直以 0 元計價)"""
+    if code in get_symbols(): return True
+    found = get_quote_cache().get_quotes([code])[0]
+    return found.get(code, {}).get('p', 0) > 0
+
+# --- 資料儲存 (Google Sheets / SQLite) ---
 def get_google_client():
     try:
-        scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
         secret_info = st.secrets["service_account_info"]
         if isinstance(secret_info, str):
             creds_dict = json.loads(secret_info, strict=False)
         else:
             creds_dict = secret_info
-        creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-        client = gspread.authorize(creds)
-        return client
+        return authorize(creds_dict)
     except Exception as e:
         st.error(f"連線 Google Sheets 失敗: {e}")
         return None
 
-def get_user_sheet(client, username):
-    try:
-        spreadsheet_name = st.secrets["spreadsheet_name"]
-        spreadsheet = client.open(spreadsheet_name)
-        worksheet_name = f"User_{username}"
-        try:
-            sheet = spreadsheet.worksheet(worksheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            sheet = spreadsheet.add_worksheet(title=worksheet_name, rows="100", cols="2")
-        return sheet
-    except Exception as e:
-        st.error(f"讀取使用者資料失敗: {e}")
-        return None
-
-def get_user_history_sheet(client, username):
-    try:
-        spreadsheet_name = st.secrets["spreadsheet_name"]
-        spreadsheet = client.open(spreadsheet_name)
-        worksheet_name = f"Hist_{username}"
-        try:
-            history_sheet = spreadsheet.worksheet(worksheet_name)
-        except gspread.exceptions.WorksheetNotFound:
-            history_sheet = spreadsheet.add_worksheet(title=worksheet_name, rows="1000", cols="3")
-            history_sheet.append_row(['Date', 'NetAsset', 'Principal'])
-        return history_sheet
-    except: return None
-
-def load_data(sheet):
-    default_data = {'h': {}, 'cash': 0.0, 'principal': 0.0, 'history': []}
-    if not sheet: return default_data
-    try:
-        raw_data = sheet.acell('A1').value
-        if raw_data:
-            data = json.loads(raw_data)
-            if 'h' not in data: data['h'] = {}
-            if 'cash' not in data: data['cash'] = 0.0
-            if 'history' not in data: data['history'] = []
-            if 'principal' not in data: data['principal'] = data.get('cash', 0.0)
-            
-            # 資料清洗與相容性處理
-            for code in data.get('h', {}):
-                if 'lots' not in data['h'][code]:
-                    data['h'][code]['lots'] = [{
-                        'd': '初始', 'p': data['h'][code]['c'], 's': data['h'][code]['s'], 'type': '現股', 'debt': 0
-                    }]
-            return data
-    except: pass
-    return default_data
-
-def save_data(sheet, data):
-    if sheet:
-        try:
-            json_str = json.dumps(data, ensure_ascii=False)
-            sheet.update_acell('A1', json_str)
-        except Exception as e: st.error(f"存檔失敗: {e}")
-
-def record_history(client, username, net_asset, current_principal):
-    hist_sheet = get_user_history_sheet(client, username)
-    if hist_sheet and net_asset > 0:
+@st.cache_resource
+def get_sheet_pool():
+    # 所有 session 共用同一組已授權的 client 與工作表 handle
+    return SheetPool(get_google_client, st.secrets.get("spreadsheet_name"))
+
+@st.cache_resource
+def get_write_behind():
+    # 合併同一使用者的快照與同一天的資產紀錄，定時批次寫入
+    writer = WriteBehind(on_error=lambda title: get_sheet_pool().invalidate(title))
+    writer.start()
+    return writer
+
+def get_cache_dir():
+    # 本機快取資料夾 (資產走勢鏡像、日線資料等)，可在 secrets 設定 cache_dir
+    return st.secrets.get("cache_dir", ".cache")
+
+@st.cache_resource
+def get_storage():
+    # secrets 的 storage 決定儲存後端："gsheets" (預設) 或 "sqlite"
+    # snapshot_compress 決定快照是否壓縮 (Google Sheets 預設壓縮，SQLite 預設不壓縮)
+    if st.secrets.get("storage", "gsheets") == "sqlite":
+        return SQLiteBackend(st.secrets.get("sqlite_path", os.path.join(get_cache_dir(), 'portfolio.db')),
+                             compress=st.secrets.get("snapshot_compress", False))
+    return GoogleSheetsBackend(get_sheet_pool(), get_write_behind(), compress=st.secrets.get("snapshot_compress", True))
+
+@st.cache_resource
+def configure_metrics():
+    # secrets 設定 metrics_jsonl / metrics_prom 路徑時輸出效能紀錄 (JSON lines / Prometheus textfile)
+    METRICS.configure(st.secrets.get("metrics_jsonl"), st.secrets.get("metrics_prom"))
+    return METRICS
+
+def is_admin(username):
+    return username in st.secrets.get("admins", [])
+
+@st.cache_resource
+def get_history_mirror():
+    return HistoryMirror(os.path.join(get_cache_dir(), 'history.db'))
+
+@st.cache_resource
+def get_return_tracker(username):
+    # 每位使用者一個，資產紀錄只新增當天的列時增量更新
+    return ReturnTracker()
+
+def get_cash_flows(username):
+    """資金存提紀錄 (TWR / XIRR 的外部資金流入)，交易紀錄有新事件時才重讀"""
+    key = (username, data.get('_seq', 0))
+    cached = st.session_state.get('cash_flows')
+    if cached is None or cached[0] != key:
+        flush_writes()
+        cached = st.session_state.cash_flows = (key, cash_flows(get_storage().read_events(username)))
+    return cached[1]
+
+def show_write_errors(errors):
+    for name, e in errors:
+        st.error(f"寫入 {name} 失敗，稍後自動重試: {e}")
+
+def flush_writes():
+    # 立即送出佇列中的寫入 (登出時使用)
+    show_write_errors(get_storage().flush())
+
+def save_event(username, data, event, durable=False):
+    """套用並儲存一筆交易事件；durable=True (買進/賣出) 時立即寫入"""
+    try: show_write_errors(commit_event(get_storage(), username, data, event, durable))
+    except Exception as e: st.error(f"存檔失敗: {e}")
+
+def record_history(username, net_asset, current_principal):
+    if net_asset > 0:
         today = datetime.now().strftime('%Y-%m-%d')
-        try:
-            all_values = hist_sheet.get_all_values()
-            if len(all_values) > 0 and len(all_values[0]) < 3:
-                 hist_sheet.update_cell(1, 3, 'Principal')
-
-            if len(all_values) > 1:
-                last_row = all_values[-1]
-                if last_row[0] == today:
-                    row_index = len(all_values)
-                    hist_sheet.update_cell(row_index, 2, int(net_asset))
-                    hist_sheet.update_cell(row_index, 3, int(current_principal))
-                    return
+        get_history_mirror().upsert(username, today, int(net_asset), int(current_principal))
+        try: get_storage().record_history(username, today, net_asset, current_principal)
         except: pass
-        hist_sheet.append_row([today, int(net_asset), int(current_principal)])
 
 # --- 核心計算邏輯 ---
 
-@st.cache_data(ttl=300)
-def get_usdtwd():
-    try:
-        data = yf.download("USDTWD=X", period="1d", progress=False)
-        if not data.empty:
-            p = data['Close'].iloc[-1]
-            if isinstance(p, pd.Series): p = p.iloc[0]
-            return float(p)
-        return 32.5
-    except: return 32.5
-
-def fetch_twse_realtime(codes):
-    """
-    更新版：加入 User-Agent 偽裝成瀏覽器，解決 Streamlit Cloud 被擋的問題。
-    """
-    if not codes: return {}
-    
-    query_parts = []
-    for c in codes:
-        c_upper = c.upper()
-        if '.TW' in c_upper and '.TWO' not in c_upper:
-            # 上市
-            raw = c_upper.replace('.TW', '')
-            query_parts.append(f"tse_{raw}.tw")
-        elif '.TWO' in c_upper:
-            # 上櫃
-            raw = c_upper.replace('.TWO', '')
-            query_parts.append(f"otc_{raw}.tw")
-    
-    if not query_parts: return {}
-    
-    query_str = "|".join(query_parts)
-    timestamp = int(time.time() * 1000)
-    url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch={query_str}&json=1&delay=0&_={timestamp}"
-    
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-        "Accept": "application/json, text/javascript, */*; q=0.01",
-        "Referer": "https://mis.twse.com.tw/stock/fibest.jsp?stock=2330",
-        "Connection": "keep-alive"
-    }
-
-    results = {}
-    try:
-        session = requests.Session()
-        response = session.get(url, headers=headers, verify=False, timeout=10)
-        
-        if response.status_code != 200:
-            st.error(f"證交所連線被拒 (Code {response.status_code})")
-            return {}
-
-        data = response.json()
-        
-        if 'msgArray' in data:
-            for item in data['msgArray']:
-                exchange = item.get('ex', '')
-                code_raw = item.get('c', '')
-                
-                if exchange == 'tse':
-                    original_code = f"{code_raw}.TW"
-                elif exchange == 'otc':
-                    original_code = f"{code_raw}.TWO"
-                else:
-                    original_code = code_raw
-
-                try:
-                    price_str = item.get('z', '-')
-                    if price_str == '-':
-                        bid = item.get('b', '').split('_')[0]
-                        ask = item.get('a', '').split('_')[0]
-                        if bid and bid != '-': price_str = bid
-                        elif ask and ask != '-': price_str = ask
-                    
-                    price = float(price_str) if price_str and price_str != '-' else 0.0
-                    prev_close = float(item.get('y', 0.0))
-                    
-                    if price > 0 and prev_close > 0:
-                        change_val = price - prev_close
-                        change_pct = (change_val / prev_close * 100)
-                    else:
-                        change_val = 0; change_pct = 0
-                        
-                    results[original_code] = {'p': price, 'chg': change_val, 'chg_pct': change_pct, 'realtime': True}
-                except:
-                    results[original_code] = {'p': 0, 'chg': 0, 'chg_pct': 0, 'realtime': False}
-                    
-    except Exception as e:
-        pass
-        
+@st.cache_resource
+def get_quote_cache():
+    # 整個伺服器程序共用，不同使用者持有相同股票時只抓一次；匯率表也一起共用
+    return QuoteCache(fx=FxTable(fetch_fx_rates, get_price_store()))
+
+def get_fx_table():
+    return get_quote_cache().fx
+
+def fx_rate(code):
+    """代碼計價幣別對台幣的即時匯率 (台股為 1)"""
+    return get_fx_table().rate_for(code)
+
+def holdings_cost_basis(holdings):
+    """以買進當天匯率計算的台幣成本 {代碼: 金額}"""
+    dates = [lot.d for pos in holdings.values() for lot in pos.iter_lots()]
+    start = min(dates) if dates else datetime.now().strftime('%Y-%m-%d')
+    return cost_basis_twd(holdings, get_fx_table().daily(foreign_currencies(holdings), start))
+
+def get_cost_basis(username):
+    """庫存的台幣成本 (買進當天匯率)，持股有變動 (新的事件) 才重算；只有台股時不需要"""
+    key = (username, data.get('_seq', 0))
+    cached = st.session_state.get('cost_basis')
+    if cached is None or cached[0] != key:
+        h = data.get('h', {})
+        cached = st.session_state.cost_basis = (key, holdings_cost_basis(h) if foreign_currencies(h) else None)
+    return cached[1]
+
+def apply_manual_prices(results):
+    # 手動更新覆蓋 (只影響目前使用者的 session，不寫回共用快取)
+    for m_code, m_price in st.session_state.get('manual_prices', {}).items():
+        if m_price > 0:
+            results[m_code] = {'p': m_price, 'chg': 0, 'chg_pct': 0}
     return results
 
-@st.cache_data(ttl=10) 
-def get_batch_market_data(codes, usdtwd_rate):
-    if not codes: return {}
-    
-    tw_query = [c for c in codes if '.TW' in c or '.TWO' in c]
-    other_query = [c for c in codes if c not in tw_query]
-    
-    results = {}
-    
-    # 1. 台股
-    if tw_query:
-        tw_results = fetch_twse_realtime(tw_query)
-        results.update(tw_results)
-
-    # 2. 美股
-    if other_query:
-        try:
-            yf_data = yf.download(other_query, period="5d", group_by='ticker', progress=False, auto_adjust=False)
-            for code in other_query:
-                try:
-                    hist = yf_data if len(other_query) == 1 else yf_data[code]
-                    if 'Close' in hist.columns:
-                        clean = hist['Close'].dropna()
-                        if not clean.empty:
-                            price = float(clean.iloc[-1])
-                            prev_close = float(clean.iloc[-2]) if len(clean) >= 2 else price
-                            
-                            change_val = price - prev_close
-                            change_pct = (change_val / prev_close * 100) if prev_close else 0
-                            
-                            results[code] = {'p': price, 'chg': change_val, 'chg_pct': change_pct}
-                        else:
-                            if code not in results: results[code] = {'p': 0, 'chg': 0, 'chg_pct': 0}
-                except:
-                    if code not in results: results[code] = {'p': 0, 'chg': 0, 'chg_pct': 0}
-        except: pass
-
-    # 防呆
-    for c in codes:
-        if c not in results:
-             results[c] = {'p': 0, 'chg': 0, 'chg_pct': 0}
-
-    # 3. 手動更新覆蓋
-    if 'manual_prices' in st.session_state:
-        for m_code, m_price in st.session_state.manual_prices.items():
-            if m_code in results and m_price > 0:
-                results[m_code]['p'] = m_price
-                results[m_code]['chg'] = 0
-                results[m_code]['chg_pct'] = 0
-            elif m_code not in results and m_price > 0:
-                results[m_code] = {'p': m_price, 'chg': 0, 'chg_pct': 0}
+@st.cache_resource
+def get_quote_refresher():
+    # 背景執行緒定期更新所有線上使用者的持股報價
+    refresher = QuoteRefresher(get_quote_cache())
+    refresher.start()
+    return refresher
 
-    return results
+def get_batch_market_data(codes):
+    """
+    極速版：直接讀取背景更新的最新報價快照，快照缺少的代碼才同步補抓。
+    回傳 (報價 dict, {幣別: 匯率}, 快照)
+    """
+    snap = get_quote_refresher().get(codes)
+    for err in snapshot_errors(snap, codes):
+        st.error(err)
+    results = {c: dict(snap.quotes.get(c, empty_quote())) for c in codes}
+    rates = dict(snap.fx)
+    missing = [cur for cur in foreign_currencies(codes) if cur not in rates]
+    if missing: rates.update(get_fx_table().get(missing))
+    return apply_manual_prices(results), rates, snap
+
+@st.cache_resource
+def get_price_store():
+    # 本機日線資料庫，基準指數與持股歷史價格共用
+    return PriceStore(os.path.join(get_cache_dir(), 'prices'))
+
+@st.cache_resource
+def get_risk_engine():
+    return RiskEngine(get_price_store(), get_fx_table())
+
+BENCHMARK_TICKERS = ['0050.TW', 'SPY', 'QQQ']
 
-@st.cache_data(ttl=3600)
 def get_benchmark_data(start_date):
-    tickers = ['0050.TW', 'SPY', 'QQQ']
     try:
-        df = yf.download(tickers, start=start_date, group_by='ticker', progress=False, auto_adjust=False)
+        closes = get_price_store().closes(BENCHMARK_TICKERS, start_date)
         benchmarks = {}
-        for t in tickers:
-            sub_df = df if len(tickers) == 1 else df[t]
-            if 'Close' in sub_df.columns:
-                series = sub_df['Close'].dropna()
-                if not series.empty:
-                    start_val = series.iloc[0]
-                    if start_val > 0:
-                        benchmarks[t] = ((series / start_val) - 1) * 100
+        for t in BENCHMARK_TICKERS:
+            series = closes[t].dropna() if t in closes else pd.Series(dtype=float)
+            if not series.empty:
+                start_val = series.iloc[0]
+                if start_val > 0:
+                    benchmarks[t] = ((series / start_val) - 1) * 100
         return benchmarks
     except: return {}
 
-# --- 登入介面 ---
-if 'current_user' not in st.session_state:
-    st.session_state.current_user = None
-
-if not st.session_state.current_user:
-    st.markdown("<h1 style='text-align: center;'>🔐 股票資產管家 Pro v2.0</h1>", unsafe_allow_html=True)
-    c1, c2, c3 = st.columns([1,2,1])
-    with c2:
-        with st.form("login_form"):
-            user_input = st.text_input("使用者名稱")
-            pwd_input = st.text_input("密碼", type="password")
-            submit = st.form_submit_button("登入", use_container_width=True)
-            
-            if submit:
-                users_db = st.secrets.get("passwords", {})
-                if user_input in users_db and str(users_db[user_input]) == str(pwd_input):
-                    st.session_state.current_user = user_input
-                    st.success("登入成功！")
-                    st.rerun()
-                else:
-                    st.error("帳號或密碼錯誤")
-    st.stop()
-
 # --- 主程式 ---
 username = st.session_state.current_user
 
 with st.sidebar:
     st.info(f"👤 User: **{username}**")
     if st.button("登出"):
+        get_quote_refresher().unwatch(username)
+        flush_writes()
         st.session_state.current_user = None
         if 'data' in st.session_state: del st.session_state.data
-        if 'sheet' in st.session_state: del st.session_state.sheet
         if 'dashboard_data' in st.session_state: del st.session_state.dashboard_data
         st.rerun()
     st.markdown("---")
 
-if 'client' not in st.session_state: st.session_state.client = get_google_client()
-if 'sheet' not in st.session_state or st.session_state.get('sheet_user') != username:
-    if st.session_state.client:
-        st.session_state.sheet = get_user_sheet(st.session_state.client, username)
-        st.session_state.sheet_user = username
-        st.session_state.data = load_data(st.session_state.sheet)
-    else: st.session_state.sheet = None
+configure_metrics()
+
+if 'data' not in st.session_state or st.session_state.get('data_user') != username:
+    try:
+        with METRICS.span('storage.load'):
+            st.session_state.data = get_storage().load(username)
+        st.session_state.data_user = username
+    except Exception as e:
+        st.error(f"讀取使用者資料失敗: {e}")
+        st.error("⚠️ 無法取得資料，請檢查 Secrets 設定。")
+        st.stop()
 
-client = st.session_state.client
-sheet = st.session_state.sheet
 data = st.session_state.data
 
-if not sheet:
-    st.error("⚠️ 無法取得資料，請檢查 Secrets 設定。")
-    st.stop()
+# 讓背景報價更新涵蓋目前使用者的持股
+get_quote_refresher().watch(username, list(data.get('h', {}).keys()))
 
 st.title(f"📈 資產管家 - {username}")
 
@@ -346,33 +273,31 @@ with st.sidebar:
     with st.expander("⚙️ 系統設定 / 本金校正"):
         st.info("若報酬率計算異常，請點擊下方按鈕進行自動校正。")
         if st.button("🔄 自動校正本金"):
-            current_stock_cost = 0
-            for code, info in data.get('h', {}).items():
-                s = info.get('s', 0)
-                c = info.get('c', 0)
-                debt = sum(l.get('debt', 0) for l in info.get('lots', []))
-                rate = 1.0 if ('.TW' in code or '.TWO' in code) else get_usdtwd()
-                current_stock_cost += (s * c * rate) - debt
+            # 海外持股以買進當天的匯率計算成本
+            basis = holdings_cost_basis(data.get('h', {}))
+            current_stock_cost = sum(basis[code] - pos.debt for code, pos in data.get('h', {}).items())
             
             new_principal = data['cash'] + current_stock_cost
-            data['principal'] = new_principal
-            save_data(sheet, data)
+            save_event(username, data, principal_event(new_principal))
             st.success(f"本金已校正為: ${int(new_principal):,}")
             st.rerun()
 
     with st.expander("💵 資金存提 (影響本金)"):
         cash_op = st.number_input("金額 (正存/負提)", step=1000.0)
         if st.button("執行異動"):
-            data['cash'] += cash_op
-            if 'principal' not in data: data['principal'] = 0.0
-            data['principal'] += cash_op 
-            save_data(sheet, data)
+            save_event(username, data, cash_event(cash_op))
             st.success("資金已更新"); st.rerun()
 
     st.markdown("---")
     
     st.subheader("🔵 買入股票")
-    code_in = st.text_input("買入代碼 (如 2330.TW, 6488.TWO)").strip().upper()
+    code_query = st.text_input("買入代碼 (輸入代碼或名稱搜尋，如 2330、台積、NVDA)").strip()
+    code_matches = get_symbols().search(code_query) if code_query else []
+    if code_matches:
+        code_in = st.selectbox("選擇股票", code_matches, format_func=get_symbols().label, key="buy_select")
+    else:
+        code_in = code_query.upper()
+        if code_in: st.caption("⚠️ 清單中沒有這個代碼，買入前會先確認抓得到報價")
     c1, c2 = st.columns(2)
     shares_in = c1.number_input("買入股數", min_value=1, value=1000, step=100)
     cost_in = c2.number_input("買入單價", min_value=0.0, value=0.0, step=0.1, format="%.2f")
@@ -382,9 +307,10 @@ with st.sidebar:
         margin_ratio = st.slider("自備款成數", 0.1, 0.9, 0.4, 0.1)
 
     if st.button("確認買入", type="primary"):
-        if code_in and cost_in > 0:
-            if 'h' not in data: data['h'] = {}
-            rate = 1.0 if ('.TW' in code_in or '.TWO' in code_in) else get_usdtwd()
+        if code_in and cost_in > 0 and not is_known_symbol(code_in):
+            st.error(f"查無代碼 {code_in}，請確認後再買入 (台股需加 .TW / .TWO)")
+        elif code_in and cost_in > 0:
+            rate = fx_rate(code_in)
             total_twd = cost_in * shares_in * rate
             cash_needed = total_twd * margin_ratio
             debt_created = total_twd - cash_needed
@@ -392,20 +318,8 @@ with st.sidebar:
             if data['cash'] < cash_needed:
                  st.error(f"現金不足！需 ${int(cash_needed):,}，現有 ${int(data['cash']):,}")
             else:
-                data['cash'] -= cash_needed
-                new_lot = {'d': datetime.now().strftime('%Y-%m-%d'), 'p': cost_in, 's': shares_in, 'type': trade_type, 'debt': debt_created}
-                if code_in in data['h']:
-                    if 'lots' not in data['h'][code_in]: data['h'][code_in]['lots'] = []
-                    lots = data['h'][code_in]['lots']
-                    lots.append(new_lot)
-                    tot_s = sum(l['s'] for l in lots)
-                    tot_c_val = sum(l['s'] * l['p'] for l in lots)
-                    data['h'][code_in]['s'] = tot_s
-                    data['h'][code_in]['c'] = tot_c_val / tot_s if tot_s else 0
-                    data['h'][code_in]['lots'] = lots
-                else:
-                    data['h'][code_in] = {'s': shares_in, 'c': cost_in, 'n': code_in, 'lots': [new_lot]}
-                save_data(sheet, data)
+                today = datetime.now().strftime('%Y-%m-%d')
+                save_event(username, data, buy_event(today, code_in, cost_in, shares_in, trade_type, debt_created, cash_needed), durable=True)
                 st.success(f"買入成功！{code_in}"); st.rerun()
         else: st.error("資料不完整")
 
@@ -414,58 +328,31 @@ with st.sidebar:
     st.subheader("🔴 賣出股票")
     holdings_list = list(data.get('h', {}).keys())
     if holdings_list:
-        sell_code = st.selectbox("賣出代碼", ["請選擇"] + holdings_list, key="sell_select")
+        sell_code = st.selectbox("賣出代碼", ["請選擇"] + holdings_list, format_func=get_symbols().label, key="sell_select")
         if sell_code != "請選擇":
-            current_hold = data['h'][sell_code]['s']
-            st.caption(f"持有: {current_hold} 股")
+            pos = data['h'][sell_code]
+            current_hold = pos.shares
+            st.caption(f"持有: {current_hold} 股 ({pos.lot_count} 批)")
             sc1, sc2 = st.columns(2)
             sell_qty = sc1.number_input("賣出股數", min_value=1, max_value=int(current_hold), value=int(current_hold), step=100)
             sell_price = sc2.number_input("賣出單價", min_value=0.0, value=0.0, step=0.1, format="%.2f")
+            cost_method = st.selectbox("成本計算", list(COST_METHODS), format_func=COST_METHODS.get, key="sell_method")
+            lot_ids = None
+            if cost_method == 'SPECIFIC':
+                lot_labels = {lot.id: f"{lot.d} {lot.s:,} 股 @ {lot.p:,.2f} ({lot.type})" for lot in pos.iter_lots()}
+                lot_ids = st.multiselect("指定賣出批次 (依選擇順序扣除，不足部分先進先出)", list(lot_labels), format_func=lot_labels.get)
             
             if st.button("確認賣出"):
                 if sell_price > 0:
-                    info = data['h'][sell_code]
-                    lots = info.get('lots', [])
-                    rate = 1.0 if ('.TW' in sell_code or '.TWO' in sell_code) else get_usdtwd()
-                    sell_revenue = sell_qty * sell_price * rate
-                    remain_to_sell = sell_qty
-                    total_cost_basis = 0
-                    total_debt_repaid = 0
-                    new_lots = []
-                    for lot in lots:
-                        if remain_to_sell > 0:
-                            take_qty = min(lot['s'], remain_to_sell)
-                            lot_cost = take_qty * lot['p'] * rate
-                            lot_debt = lot.get('debt', 0) * (take_qty / lot['s']) if lot['s'] > 0 else 0
-                            total_cost_basis += lot_cost
-                            total_debt_repaid += lot_debt
-                            lot['s'] -= take_qty
-                            lot['debt'] -= lot_debt
-                            remain_to_sell -= take_qty
-                            if lot['s'] > 0: new_lots.append(lot)
-                        else: new_lots.append(lot)
-                    
-                    realized_profit = sell_revenue - total_cost_basis
-                    realized_roi = (realized_profit / total_cost_basis * 100) if total_cost_basis else 0
-                    cash_back = sell_revenue - total_debt_repaid
-                    data['cash'] += cash_back
-                    
-                    if new_lots:
-                        data['h'][sell_code]['lots'] = new_lots
-                        data['h'][sell_code]['s'] -= sell_qty
-                        ts = sum(l['s'] for l in new_lots)
-                        tc = sum(l['s']*l['p'] for l in new_lots)
-                        data['h'][sell_code]['c'] = tc / ts if ts else 0
-                    else: del data['h'][sell_code]
-                    
-                    if 'history' not in data: data['history'] = []
-                    data['history'].append({
-                        'd': datetime.now().strftime('%Y-%m-%d'), 'code': sell_code,
-                        'name': STOCK_MAP.get(sell_code, sell_code), 'qty': sell_qty,
-                        'buy_cost': total_cost_basis, 'sell_rev': sell_revenue,
-                        'profit': realized_profit, 'roi': realized_roi
-                    })
-                    save_data(sheet, data)
+                    rate = fx_rate(sell_code)
+                    today = datetime.now().strftime('%Y-%m-%d')
+                    # 海外持股的成本以各批買進當天的匯率換算，已實現損益才含匯兌損益
+                    basis = None
+                    if foreign_currencies([sell_code]):
+                        first = min(lot.d for lot in pos.iter_lots())
+                        basis = sell_basis_twd(pos, sell_qty, get_fx_table().daily(foreign_currencies([sell_code]), first), cost_method, lot_ids)
+                    ev = sell_event(today, sell_code, sell_qty, sell_price, rate, get_symbols().get(sell_code, sell_code), cost_method, lot_ids, basis)
+                    save_event(username, data, ev, durable=True)
                     st.success(f"賣出成功"); st.balloons(); st.rerun()
 
     st.markdown("---")
@@ -477,11 +364,10 @@ with st.sidebar:
             to_del_code = st.selectbox("選擇要處理的股票", ["請選擇"] + del_list)
             
             if to_del_code != "請選擇":
-                info = data['h'][to_del_code]
-                current_s = info.get('s', 0)
-                current_c = info.get('c', 0)
-                rate = 1.0 if ('.TW' in to_del_code or '.TWO' in to_del_code) else get_usdtwd()
-                total_cost_basis = current_s * current_c * rate
+                pos = data['h'][to_del_code]
+                current_s = pos.shares
+                current_c = pos.avg_cost
+                total_cost_basis = holdings_cost_basis({to_del_code: pos})[to_del_code]
                 
                 st.write(f"📊 持有股數: {current_s}, 平均成本: {current_c}")
                 st.write(f"💰 估算原始投入成本: ${int(total_cost_basis):,}")
@@ -490,15 +376,12 @@ with st.sidebar:
                 
                 with col_del_1:
                     if st.button("❌ 僅刪除代碼", type="secondary"):
-                        del data['h'][to_del_code]
-                        save_data(sheet, data)
+                        save_event(username, data, delete_event(to_del_code))
                         st.success(f"已刪除 {to_del_code}"); time.sleep(1); st.rerun()
 
                 with col_del_2:
                     if st.button("💸 刪除並退回現金", type="primary"):
-                        data['cash'] += total_cost_basis
-                        del data['h'][to_del_code]
-                        save_data(sheet, data)
+                        save_event(username, data, delete_event(to_del_code, total_cost_basis))
                         st.success(f"已刪除並退款"); time.sleep(1); st.rerun()
 
     st.markdown("---")
@@ -526,8 +409,7 @@ with st.sidebar:
         real_principal = st.number_input("設定正確本金", value=float(data.get('principal', 0)), step=10000.0)
         
         if st.button("確認修正本金"):
-            data['principal'] = real_principal
-            save_data(sheet, data)
+            save_event(username, data, principal_event(real_principal))
             st.success(f"本金已修正為 ${int(real_principal):,}")
             time.sleep(1)
             st.rerun()
@@ -536,91 +418,65 @@ with st.sidebar:
 if 'dashboard_data' not in st.session_state:
     st.session_state.dashboard_data = None
 
-if st.button("🔄 更新即時報價 (極速版)", type="primary", use_container_width=True):
+def build_dashboard(batch_prices, fx_rates, snap):
+    """估值並計算帳戶總覽 (總損益 = 未實現 + 已實現；ROI = 總損益 / 本金)，回傳 dashboard_data"""
+    with METRICS.span('valuation'):
+        d = value_account(data, batch_prices, fx_rates, names=get_symbols(), basis=get_cost_basis(username))
+    # 融資維持率：融資批次陣列只在持股變動時重建，每次報價更新只重算一次
+    with METRICS.span('margin'):
+        book = margin_book(data)
+        d['margin'] = book.status(batch_prices, fx_rates) if len(book) else None
+    # snap_ts 判斷快照是否更新；quote_ts 為持股報價實際取得的時間 (顯示用)
+    d['snap_ts'] = snap.ts
+    d['quote_ts'] = quotes_time(snap, data.get('h', {}))
+    return d
+
+rc1, rc2 = st.columns([4, 1])
+if rc1.button("🔄 更新即時報價 (極速版)", type="primary", use_container_width=True):
     with st.spinner('正在同步市場數據 (台股即時+美股)...'):
-        usdtwd = get_usdtwd()
         h = data.get('h', {})
-        batch_prices = get_batch_market_data(list(h.keys()), usdtwd)
-        
-        temp_list = []
-        total_mkt_val = 0.0
-        total_cost_val = 0.0
-        total_debt = 0.0
-        total_day_profit = 0.0
-        
-        for code, info in h.items():
-            market_info = batch_prices.get(code, {'p': info['c'], 'chg': 0, 'chg_pct': 0})
-            cur_p = market_info['p'] if market_info['p'] > 0 else info['c']
-            
-            rate = 1.0 if ('.TW' in code or '.TWO' in code) else usdtwd
-            s_val = float(info['s'])
-            c_val = float(info['c'])
-            p_val = float(cur_p)
-            
-            mkt_val = p_val * s_val * rate
-            cost_val = c_val * s_val * rate
-            stock_debt = sum(l.get('debt', 0) for l in info.get('lots', []))
-            actual_principal = cost_val - stock_debt
-            
-            total_profit_val = mkt_val - cost_val
-            total_profit_pct = (total_profit_val / actual_principal * 100) if actual_principal > 0 else 0
-            
-            day_profit_val = market_info['chg'] * s_val * rate
-            total_day_profit += day_profit_val
-            
-            total_mkt_val += mkt_val
-            total_cost_val += cost_val
-            total_debt += stock_debt
-
-            name = STOCK_MAP.get(code, code)
-            temp_list.append({
-                "raw_code": code, "股票代碼": code, "公司名稱": name,
-                "股數": int(s_val), "成本": c_val, "現價": p_val,
-                "日損益%": market_info['chg_pct'] / 100, "日損益": day_profit_val,
-                "總損益%": total_profit_pct / 100, "總損益": total_profit_val,
-                "市值": mkt_val, "mkt_val_raw": mkt_val
-            })
-
-        final_rows = []
-        for item in temp_list:
-            weight = (item['mkt_val_raw'] / total_mkt_val) if total_mkt_val > 0 else 0
-            item["占比"] = weight
-            final_rows.append(item)
-
-        net_asset = (total_mkt_val + data['cash']) - total_debt
-        unrealized_profit = total_mkt_val - total_cost_val
-        
-        # 取得已實現損益
-        total_realized_profit = sum(r.get('profit', 0) for r in data.get('history', []))
-        
-        # === 關鍵修改：總損益 = 未實現 + 已實現 ===
-        total_profit_sum = unrealized_profit + total_realized_profit
-        
-        current_principal = data.get('principal', data['cash'])
-        if client: record_history(client, username, net_asset, current_principal)
-
-        # === 關鍵修改：ROI = (總損益 / 本金) ===
-        roi_basis = current_principal if current_principal > 0 else 1
-        total_roi_pct = (total_profit_sum / roi_basis) * 100
-
-        st.session_state.dashboard_data = {
-            'net_asset': net_asset,
-            'cash': data.get('cash', 0),
-            'total_mkt_val': total_mkt_val,
-            'current_principal': current_principal,
-            'total_day_profit': total_day_profit,
-            'unrealized_profit': unrealized_profit,
-            'total_realized_profit': total_realized_profit,
-            'total_profit_sum': total_profit_sum,  # 新增欄位
-            'total_roi_pct': total_roi_pct,        # 新的 ROI
-            'final_rows': final_rows,
-            'temp_list': temp_list
-        }
-
-# --- 顯示層 ---
-if st.session_state.dashboard_data:
+        batch_prices, fx_rates, snap = get_batch_market_data(list(h.keys()))
+        st.session_state.dashboard_data = build_dashboard(batch_prices, fx_rates, snap)
+        with METRICS.span('record_history'):
+            record_history(username, st.session_state.dashboard_data['net_asset'], st.session_state.dashboard_data['current_principal'])
+rc2.toggle("⚡ 盤中自動更新", key="auto_refresh", help="開盤時間定期更新報價相關數字，不重新整理整頁")
+
+# --- 盤中自動更新 ---
+# 以 fragment 只重跑總覽數字與庫存明細，讀取背景更新的報價快照，
+# 側邊欄、圖表與資產紀錄寫入都不受影響 (資產紀錄仍只在按下更新按鈕時寫入)。
+def auto_refresh_interval():
+    # 預設與背景報價更新同步，可在 secrets 設定 auto_refresh_interval (秒)
+    return int(st.secrets.get("auto_refresh_interval", REFRESH_INTERVAL_OPEN))
+
+def markets_open(codes):
+    markets = {market_of(c) for c in codes} or {'TW'}
+    return any(is_market_open(m) for m in markets)
+
+def live_dashboard():
+    """快照比畫面上的新時才重新估值，回傳最新的 dashboard_data"""
     d = st.session_state.dashboard_data
-    
+    h = data.get('h', {})
+    if not st.session_state.get('auto_refresh') or not markets_open(h): return d
+    if get_quote_refresher().snapshot.ts <= (d.get('snap_ts') or 0): return d
+    batch_prices, fx_rates, snap = get_batch_market_data(list(h.keys()))
+    d = build_dashboard(batch_prices, fx_rates, snap)
+    st.session_state.dashboard_data = d
+    return d
+
+def live_fragment(fn):
+    # 收盤時不排程，下次整頁重跑時再依開盤狀態決定
+    live = st.session_state.get('auto_refresh') and markets_open(data.get('h', {}))
+    run_every = auto_refresh_interval() if live else None
+    return st.fragment(fn, run_every=run_every)
+
+def render_overview():
+    d = live_dashboard()
+    if d.get('quote_ts'):
+        quote_age = int(time.time() - d['quote_ts'])
+        st.caption(f"🕒 報價時間 {datetime.fromtimestamp(d['quote_ts']).strftime('%H:%M:%S')} ({quote_age} 秒前)")
+        if d['positions']['stale'].any():
+            st.warning("部分報價來源暫時無法連線，顯示的是最後一次取得的價格。")
+
     st.subheader("🏦 資產概況")
     k1, k2, k3, k4 = st.columns(4)
     k1.metric("💰 淨資產", f"${int(d['net_asset']):,}")
@@ -642,29 +498,65 @@ if st.session_state.dashboard_data:
     # 第四欄顯示已實現供參考
     kp4.metric("📥 其中已實現", f"${int(d['total_realized_profit']):+,}")
 
-    tab1, tab2, tab3, tab4 = st.tabs(["📋 庫存明細", "🗺️ 熱力圖", "📊 資產走勢", "📜 已實現損益"])
-    
-    def color_profit(val):
-        color = 'red' if val > 0 else 'green' if val < 0 else 'black'
-        return f'color: {color}'
+    margin = d.get('margin')
+    if margin:
+        render_margin(margin)
+
+def render_margin(margin):
+    warn_ratio = float(st.secrets.get("margin_warn_ratio", MARGIN_WARN_RATIO))
+    for level, msg in margin_alerts(margin, warn_ratio):
+        (st.error if level == 'error' else st.warning)(f"🚨 {msg}")
+    m1, m2, m3, m4 = st.columns(4)
+    m1.metric("🛡️ 整戶維持率", f"{margin['ratio']:.0%}", help=f"融資股票市值 / 融資金額，低於 {MARGIN_CALL_RATIO:.0%} 會被追繳")
+    m2.metric("💳 融資金額", f"${int(margin['debt']):,}")
+    m3.metric("📦 融資股票市值", f"${int(margin['value']):,}")
+    m4.metric("📐 距追繳跌幅", f"{max(margin['drop'], 0):.1%}")
+    with st.expander("融資維持率明細"):
+        st.dataframe(margin['symbols'].style.format({
+            '融資市值': '{:,.0f}', '融資金額': '{:,.0f}', '維持率': '{:.0%}', '現價': '{:.2f}', '追繳價': '{:.2f}', '距追繳跌幅': '{:.1%}'
+        }), use_container_width=True, hide_index=True)
+
+def render_table(key, table, search_cols, placeholder, height="auto"):
+    """搜尋、排序、分頁都在伺服器端處理，只把目前這一頁交給 st.dataframe"""
+    c1, c2, c3, c4 = st.columns([3, 2, 1, 1])
+    search = c1.text_input("搜尋", key=f"{key}_search", placeholder=placeholder)
+    sort_by = c2.selectbox("排序欄位", ["(預設)"] + list(table.raw.columns), key=f"{key}_sort")
+    ascending = c3.selectbox("順序", ["遞減", "遞增"], key=f"{key}_order") == "遞增"
+    page_size = c4.selectbox("每頁", PAGE_SIZES, key=f"{key}_size")
+
+    rows = table.query(search.strip(), search_cols, None if sort_by == "(預設)" else sort_by, ascending)
+    pages = page_count(len(rows), page_size)
+    # 搜尋後頁數變少時回到第一頁
+    if st.session_state.get(f"{key}_page", 1) > pages: st.session_state[f"{key}_page"] = 1
+    page = st.session_state.get(f"{key}_page", 1) - 1
+    st.dataframe(table.page(rows, page, page_size), use_container_width=True, height=height, hide_index=True)
+    p1, p2 = st.columns([1, 3])
+    p1.number_input("頁次", min_value=1, max_value=pages, step=1, key=f"{key}_page")
+    p2.caption(f"共 {len(rows):,} 筆，第 {page + 1} / {pages} 頁")
+
+def render_holdings():
+    d = live_dashboard()
+    if not d['positions'].empty:
+        with METRICS.span('render.holdings'):
+            # 格式與顏色每個報價快照只算一次
+            if 'holdings_table' not in d:
+                d['holdings_table'] = FormattedTable(d['positions'][DISPLAY_COLUMNS], HOLDINGS_FORMATS, HOLDINGS_COLORED)
+            render_table("holdings", d['holdings_table'], ['股票代碼', '公司名稱'], "代碼或名稱", height=500)
+    else: st.info("無庫存資料")
+
+# --- 顯示層 ---
+if st.session_state.dashboard_data:
+    live_fragment(render_overview)()
+    d = st.session_state.dashboard_data
+
+    tab1, tab2, tab3, tab4, tab5 = st.tabs(["📋 庫存明細", "🗺️ 熱力圖", "📊 資產走勢", "📜 已實現損益", "⚠️ 風險分析"])
 
     with tab1:
-        if d['final_rows']:
-            df = pd.DataFrame(d['final_rows'])
-            cols = ['股票代碼', '公司名稱', '股數', '成本', '現價', '日損益%', '日損益', '總損益%', '總損益', '市值', '占比']
-            df = df[cols]
-            styler = df.style.format({
-                '股數': '{:,}', '成本': '{:,.2f}', '現價': '{:,.2f}',
-                '日損益%': '{:+.2%}', '日損益': '{:+,.0f}',
-                '總損益%': '{:+.2%}', '總損益': '{:+,.0f}',
-                '市值': '{:,.0f}', '占比': '{:.1%}'
-            }).map(color_profit, subset=['日損益%', '日損益', '總損益%', '總損益'])
-            st.dataframe(styler, use_container_width=True, height=500, hide_index=True)
-        else: st.info("無庫存資料")
+        live_fragment(render_holdings)()
 
     with tab2:
-        if d['temp_list']:
-            df_tree = pd.DataFrame(d['temp_list'])
+        if not d['positions'].empty:
+            df_tree = d['positions']
             fig_tree = px.treemap(
                 df_tree, path=['股票代碼'], values='mkt_val_raw', color='日損益%',
                 color_continuous_scale='RdYlGn_r', color_continuous_midpoint=0,
@@ -675,98 +567,178 @@ if st.session_state.dashboard_data:
         else: st.info("無數據")
 
     with tab3:
-        st.caption("ℹ️ 資產走勢分析：可切換查看「獲利金額」或「報酬率」")
+        st.caption("ℹ️ 資產走勢分析：可切換查看「獲利金額」、「報酬率」或扣除資金存提的「時間加權報酬率」")
+
+        with st.expander("🧩 補齊歷史資產紀錄"):
+            st.caption("沒有按下更新的日子不會有紀錄。依交易紀錄、歷史收盤價與匯率重建每天的淨資產，只補上缺少的日期。")
+            if st.button("開始補齊", key="backfill_history"):
+                flush_writes()
+                try:
+                    with st.spinner("重建歷史資產中..."), METRICS.span('history.backfill'):
+                        added = backfill_history(get_storage(), username, get_price_store(), get_fx_table(), data)
+                    # 工作表整批改寫過，本機鏡像重新完整同步
+                    get_history_mirror().reset(username)
+                    st.success(f"已補上 {added} 天的紀錄")
+                except Exception as e: st.error(f"補齊失敗: {e}")
         
-        if client:
-            hs = get_user_history_sheet(client, username)
-            if hs:
-                hvals = hs.get_all_values()
-                if len(hvals) > 1:
-                    headers = hvals[0]
-                    dfh = pd.DataFrame(hvals[1:], columns=headers)
-                    
-                    dfh['Date'] = pd.to_datetime(dfh['Date'])
-                    dfh['NetAsset'] = pd.to_numeric(dfh['NetAsset'], errors='coerce').fillna(0)
-                    
-                    if 'Principal' in dfh.columns:
-                        dfh['Principal'] = pd.to_numeric(dfh['Principal'], errors='coerce').fillna(0)
-                    else:
-                        dfh['Principal'] = dfh['NetAsset'] 
-
-                    dfh['Principal'] = dfh.apply(lambda x: x['NetAsset'] if x['Principal'] == 0 else x['Principal'], axis=1)
-                    dfh = dfh.sort_values('Date')
-
-                    dfh['Profit_Val'] = dfh['NetAsset'] - dfh['Principal']
-                    dfh['ROI_Pct'] = (dfh['Profit_Val'] / dfh['Principal']) * 100
-                    
-                    view_type = st.radio("顯示模式", ["💰 總損益金額 (TWD)", "📈 累計報酬率 (%)"], horizontal=True)
-
-                    fig = go.Figure()
-
-                    if view_type == "💰 總損益金額 (TWD)":
-                        fig.add_trace(go.Scatter(
-                            x=dfh['Date'], y=dfh['Profit_Val'],
-                            mode='lines+markers', name='總損益金額',
-                            line=dict(color='#d62728', width=3),
-                            fill='tozeroy', 
-                            fillcolor='rgba(214, 39, 40, 0.1)',
-                            hovertemplate='<b>日期</b>: %{x|%Y-%m-%d}<br><b>損益</b>: $%{y:,.0f}<extra></extra>'
-                        ))
-                        yaxis_format = ",.0f"
-                        y_title = "損益金額 (TWD)"
-                        
-                    else:
+        # 只補抓上次同步後的新資料，圖表直接讀本機鏡像
+        try:
+            with METRICS.span('history.sync'):
+                get_history_mirror().sync(username, lambda start_row: get_storage().read_history(username, start_row))
+        except: st.error("無法讀取歷史資料，以下為本機暫存的紀錄")
+        dfh = get_history_mirror().frame(username)
+        if not dfh.empty:
+            try: flows = get_cash_flows(username)
+            except Exception as e:
+                flows = None
+                st.error(f"無法讀取資金存提紀錄，報酬率未扣除存提: {e}")
+            with METRICS.span('history.returns'):
+                tracker = get_return_tracker(username).extend(dfh, row_flows(dfh['Date'], flows))
+            twr = tracker.curve()
+            r1, r2 = st.columns(2)
+            r1.metric("⏱️ 時間加權報酬率 (TWR)", f"{twr.iloc[-1]:+.2f}%", help="扣除資金存提的影響，可直接與大盤比較")
+            r2.metric("💹 年化資金加權報酬率 (XIRR)", f"{tracker.xirr * 100:+.2f}%" if pd.notna(tracker.xirr) else "—", help="考慮每次存提的時間與金額")
+
+            view_type = st.radio("顯示模式", ["💰 總損益金額 (TWD)", "📈 累計報酬率 (%)", "⏱️ 時間加權報酬率 (%)"], horizontal=True)
+
+            fig = go.Figure()
+
+            if view_type == "💰 總損益金額 (TWD)":
+                fig.add_trace(go.Scatter(
+                    x=dfh['Date'], y=dfh['Profit_Val'],
+                    mode='lines+markers', name='總損益金額',
+                    line=dict(color='#d62728', width=3),
+                    fill='tozeroy', 
+                    fillcolor='rgba(214, 39, 40, 0.1)',
+                    hovertemplate='<b>日期</b>: %{x|%Y-%m-%d}<br><b>損益</b>: $%{y:,.0f}<extra></extra>'
+                ))
+                yaxis_format = ",.0f"
+                y_title = "損益金額 (TWD)"
+                
+            else:
+                if view_type == "📈 累計報酬率 (%)":
+                    x, y, name = dfh['Date'], dfh['ROI_Pct'], '我的報酬率'
+                else:
+                    x, y, name = twr.index, twr.values, '我的 TWR'
+                fig.add_trace(go.Scatter(
+                    x=x, y=y,
+                    mode='lines+markers', name=name,
+                    line=dict(color='#d62728', width=3),
+                    hovertemplate='<b>日期</b>: %{x|%Y-%m-%d}<br><b>報酬率</b>: %{y:.2f}%<extra></extra>'
+                ))
+
+                if not dfh.empty:
+                    start_date = dfh['Date'].min().strftime('%Y-%m-%d')
+                    benchmarks = get_benchmark_data(start_date)
+                    colors = {'0050.TW': 'blue', 'SPY': 'green', 'QQQ': 'purple'}
+                    for name, series in benchmarks.items():
+                        aligned_series = series[series.index >= dfh['Date'].min()]
                         fig.add_trace(go.Scatter(
-                            x=dfh['Date'], y=dfh['ROI_Pct'],
-                            mode='lines+markers', name='我的報酬率',
-                            line=dict(color='#d62728', width=3),
-                            hovertemplate='<b>日期</b>: %{x|%Y-%m-%d}<br><b>報酬率</b>: %{y:.2f}%<extra></extra>'
+                            x=aligned_series.index, y=aligned_series.values,
+                            mode='lines', name=name,
+                            line=dict(color=colors.get(name, 'gray'), width=1, dash='dot'),
+                            hovertemplate=f'<b>{name}</b>: %{{y:.2f}}%<extra></extra>'
                         ))
-
-                        if not dfh.empty:
-                            start_date = dfh['Date'].min().strftime('%Y-%m-%d')
-                            benchmarks = get_benchmark_data(start_date)
-                            colors = {'0050.TW': 'blue', 'SPY': 'green', 'QQQ': 'purple'}
-                            for name, series in benchmarks.items():
-                                aligned_series = series[series.index >= dfh['Date'].min()]
-                                fig.add_trace(go.Scatter(
-                                    x=aligned_series.index, y=aligned_series.values,
-                                    mode='lines', name=name,
-                                    line=dict(color=colors.get(name, 'gray'), width=1, dash='dot'),
-                                    hovertemplate=f'<b>{name}</b>: %{{y:.2f}}%<extra></extra>'
-                                ))
-                        yaxis_format = ".2f"
-                        y_title = "累計報酬率 (%)"
-
-                    fig.update_layout(
-                        xaxis_title="日期", 
-                        yaxis_title=y_title,
-                        hovermode="x unified",
-                        yaxis=dict(tickformat=yaxis_format),
-                        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
-                        height=500
-                    )
-                    st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.info("尚無歷史資料，請先執行一次「更新即時報價」。")
+                yaxis_format = ".2f"
+                y_title = "累計報酬率 (%)"
+
+            fig.update_layout(
+                xaxis_title="日期", 
+                yaxis_title=y_title,
+                hovermode="x unified",
+                yaxis=dict(tickformat=yaxis_format),
+                legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="right", x=1),
+                height=500
+            )
+            st.plotly_chart(fig, use_container_width=True)
         else:
-            st.error("無法讀取歷史資料 (Client Error)")
+            st.info("尚無歷史資料，請先執行一次「更新即時報價」。")
 
     with tab4:
         history = data.get('history', [])
         if history:
-            df_hist = pd.DataFrame(history[::-1])
-            st.subheader(f"累計已實現損益: ${int(d['total_realized_profit']):+,}")
-            if not df_hist.empty:
-                df_hist = df_hist[['d', 'code', 'name', 'qty', 'buy_cost', 'sell_rev', 'profit', 'roi']]
-                df_hist.columns = ['日期', '代碼', '名稱', '賣出股數', '總成本', '賣出收入', '獲利金額', '報酬率%']
-                df_hist['報酬率%'] = df_hist['報酬率%'] / 100
-                styler_h = df_hist.style.format({
-                    '賣出股數': '{:,}', '總成本': '{:,.0f}', '賣出收入': '{:,.0f}',
-                    '獲利金額': '{:+,.0f}', '報酬率%': '{:+.2%}'
-                }).map(color_profit, subset=['獲利金額', '報酬率%'])
-                st.dataframe(styler_h, use_container_width=True, hide_index=True)
+            realized = realized_index(data)
+            st.subheader(f"累計已實現損益: ${int(realized.total_profit):+,}")
+            view = st.radio("檢視", ["明細"] + list(BREAKDOWNS.values()), horizontal=True, key="realized_view")
+            if view != "明細":
+                kind = next(k for k, label in BREAKDOWNS.items() if label == view)
+                breakdown = realized.frame(kind)
+                fig_bar = px.bar(breakdown.head(30), x='項目', y='獲利金額', color='獲利金額',
+                                 color_continuous_scale='RdYlGn_r', color_continuous_midpoint=0)
+                fig_bar.update_layout(xaxis_title=None, yaxis_title="獲利金額 (TWD)", coloraxis_showscale=False, height=350)
+                if kind != 'symbol': fig_bar.update_xaxes(type='category', categoryorder='category ascending')
+                st.plotly_chart(fig_bar, use_container_width=True)
+                table = FormattedTable(breakdown, BREAKDOWN_FORMATS, HISTORY_COLORED)
+                st.dataframe(table.page(table.query(), 0, len(table)), use_container_width=True, hide_index=True)
+            else:
+                with METRICS.span('render.history'):
+                    # 紀錄有變動 (新的事件) 才重新建表與格式化
+                    hist_key = (username, data.get('_seq', 0), len(history))
+                    cached = st.session_state.get('history_table')
+                    if cached is None or cached[0] != hist_key:
+                        cached = (hist_key, FormattedTable(history_frame(history), HISTORY_FORMATS, HISTORY_COLORED))
+                        st.session_state.history_table = cached
+                    render_table("history", cached[1], ['日期', '代碼', '名稱'], "代碼、名稱或日期 (如 2024-05)")
         else: st.info("尚無賣出紀錄")
 
+    with tab5:
+        positions = d['positions']
+        if not positions.empty:
+            st.caption(f"ℹ️ 以目前持股權重回看近一年的日報酬 (持股與基準皆以台幣計價，含匯率變動)；Beta 對照 {' / '.join(RISK_BENCHMARKS)}")
+            try:
+                with st.spinner("計算風險指標中..."), METRICS.span('risk.report'):
+                    risk = get_risk_engine().report(list(positions['raw_code']), positions['股數'], positions['mkt_val_raw'])
+            except Exception as e:
+                risk = None
+                st.error(f"無法取得歷史價格: {e}")
+            if risk and risk['days'] > 1:
+                k1, k2, k3, k4 = st.columns(4)
+                k1.metric("📉 年化波動率", f"{risk['volatility']:.2%}")
+                k2.metric("🔻 最大回撤", f"{risk['max_drawdown']:.2%}")
+                for col, (name, beta) in zip([k3, k4], risk['betas'].items()):
+                    col.metric(f"β vs {name}", f"{beta:.2f}")
+
+                st.subheader("單日風險值 (VaR)")
+                st.dataframe(risk['var'].style.format({
+                    '歷史模擬 VaR': '${:,.0f}', '參數法 VaR': '${:,.0f}', '歷史模擬 %': '{:.2%}', '參數法 %': '{:.2%}'
+                }), use_container_width=True, hide_index=True)
+
+                dd = risk['drawdown'] * 100
+                fig_dd = go.Figure(go.Scatter(x=dd.index, y=dd.values, mode='lines', fill='tozeroy', name='回撤',
+                                              line=dict(color='#d62728'), hovertemplate='%{x|%Y-%m-%d}: %{y:.2f}%<extra></extra>'))
+                fig_dd.update_layout(title="回撤走勢", yaxis_title="回撤 (%)", height=300)
+                st.plotly_chart(fig_dd, use_container_width=True)
+
+                if len(risk['corr']) > 1:
+                    # 持股太多時只畫權重最大的幾檔，熱力圖才看得清楚
+                    top = positions.nlargest(30, 'mkt_val_raw')['raw_code']
+                    fig_corr = px.imshow(risk['corr'].loc[top, top], color_continuous_scale='RdBu_r', zmin=-1, zmax=1, title="相關係數")
+                    fig_corr.update_layout(height=max(400, 20 * len(top)))
+                    st.plotly_chart(fig_corr, use_container_width=True)
+
+                st.dataframe(risk['holdings'].style.format({'占比': '{:.2%}', '年化波動率': '{:.2%}'}, precision=2),
+                             use_container_width=True, hide_index=True)
+            elif risk is not None: st.info("歷史價格資料不足，無法計算風險指標")
+        else: st.info("無庫存資料")
+
 else:
     st.info("👆 請點擊上方按鈕，開始載入您的投資組合數據")
+
+# --- 效能監控 (僅管理員) ---
+if is_admin(username):
+    with st.sidebar:
+        with st.expander("⏱️ 效能監控"):
+            stages = METRICS.stage_table()
+            if stages:
+                df_stages = pd.DataFrame(stages).drop(columns=['last_at'])
+                st.dataframe(df_stages.style.format({
+                    'last_ms': '{:.1f}', 'p50_ms': '{:.1f}', 'p95_ms': '{:.1f}', 'max_ms': '{:.1f}'
+                }), use_container_width=True, hide_index=True)
+            else: st.caption("尚無紀錄")
+            counters = METRICS.counters()
+            if counters:
+                st.dataframe(pd.DataFrame(list(counters.items()), columns=['指標', '數值']), use_container_width=True, hide_index=True)
+            st.download_button("下載 Prometheus 格式", METRICS.prometheus_text(), file_name="stock_app.prom")
+            if st.button("重設統計"):
+                METRICS.reset()
+                st.rerun()
@@ -0,0 +1,135 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tomllib
+from datetime import datetime
+
+from market import fetch_quotes_concurrent, fetch_fx_rates
+from fx import FxTable, foreign_currencies, currency_of, BASE_CURRENCY
+from valuation import value_account
+from sheets import SheetPool, WriteBehind, authorize
+from storage import GoogleSheetsBackend, SQLiteBackend
+from price_store import PriceStore
+from reconstruct import backfill_history
+from metrics import METRICS
+
+# --- 批次估值 (不需要 Streamlit) ---
+# 所有使用者的持股聯集只抓一次報價，逐一估值後把當天的淨資產一次批次寫入 Hist_，
+# 沒有人登入的日子資產走勢也不會缺漏。報價是即時的，所以只記錄今天；
+# 有持股抓不到報價或匯率的使用者不寫入 (估值會以成本價代替，不是真的淨資產)，列在 skipped 裡。
+# 用法 (cron)：python -m batch_job [--secrets .streamlit/secrets.toml] [--users a b] [--dry-run]
+# 補齊過去缺少的日期：python -m batch_job --backfill
+
+DEFAULT_SECRETS = os.path.join('.streamlit', 'secrets.toml')
+
+def load_secrets(path=DEFAULT_SECRETS):
+    with open(path, 'rb') as f:
+        return tomllib.load(f)
+
+def make_backend(secrets):
+    """與 app.get_storage 相同的設定 (secrets 的 storage / sqlite_path / snapshot_compress)"""
+    if secrets.get("storage", "gsheets") == "sqlite":
+        path = secrets.get("sqlite_path", os.path.join(secrets.get("cache_dir", ".cache"), 'portfolio.db'))
+        return SQLiteBackend(path, compress=secrets.get("snapshot_compress", False))
+    info = secrets["service_account_info"]
+    creds_dict = json.loads(info, strict=False) if isinstance(info, str) else dict(info)
+    pool = SheetPool(lambda: authorize(creds_dict), secrets.get("spreadsheet_name"))
+    return GoogleSheetsBackend(pool, WriteBehind(), compress=secrets.get("snapshot_compress", True))
+
+def value_users(datas, fetcher=fetch_quotes_concurrent, names=None):
+    """
+    datas: {使用者: data}。持股聯集與所需匯率只抓一次。
+    回傳 ({使用者: 估值結果}, [(來源, 錯誤訊息)], 報價, 匯率)
+    """
+    codes = sorted({c for data in datas.values() for c in data.get('h', {})})
+    with METRICS.span('batch.quotes'):
+        quotes, rates, errors = fetcher(codes, currencies=foreign_currencies(codes))
+    with METRICS.span('batch.valuation'):
+        results = {u: value_account(data, quotes, rates, names) for u, data in datas.items()}
+    return results, errors, quotes, rates
+
+def unpriced_codes(data, quotes, rates):
+    """沒有有效報價 (缺少、價格 <= 0 或沿用舊報價) 或缺少匯率的持股代碼"""
+    missing = []
+    for code in data.get('h', {}):
+        q = quotes.get(code) or {}
+        cur = currency_of(code)
+        if float(q.get('p', 0) or 0) <= 0 or q.get('stale') or (cur != BASE_CURRENCY and not rates.get(cur)):
+            missing.append(code)
+    return sorted(missing)
+
+def run(backend, users=None, fetcher=fetch_quotes_concurrent, names=None, dry_run=False):
+    """估值所有 (或指定) 使用者並寫入今天的資產紀錄，回傳執行摘要"""
+    t0 = time.perf_counter()
+    date = datetime.now().strftime('%Y-%m-%d')
+    with METRICS.span('batch.list_users'):
+        users = list(users) if users else backend.list_users()
+    with METRICS.span('batch.load'):
+        datas = backend.load_many(users)
+    results, quote_errors, quotes, rates = value_users(datas, fetcher, names)
+
+    # 有持股沒有報價的使用者略過，不把以成本價估的淨資產當成當天紀錄
+    skipped = {u: unpriced_codes(datas[u], quotes, rates) for u in results}
+    skipped = {u: codes for u, codes in skipped.items() if codes}
+    # 與頁面上的 record_history 相同：淨資產為正才記錄
+    records = [(u, date, r['net_asset'], r['current_principal']) for u, r in results.items()
+               if r['net_asset'] > 0 and u not in skipped]
+    write_errors = []
+    if not dry_run:
+        with METRICS.span('batch.write'):
+            write_errors = backend.record_history_many(records)
+    return {
+        'date': date, 'users': len(datas), 'symbols': len({c for d in datas.values() for c in d.get('h', {})}),
+        'recorded': 0 if dry_run else len(records), 'results': results, 'skipped': skipped,
+        'quote_errors': quote_errors, 'write_errors': write_errors,
+        'seconds': time.perf_counter() - t0,
+    }
+
+def backfill(backend, secrets, users=None):
+    """由交易紀錄重建每位使用者缺少的歷史資產紀錄，回傳 {使用者: 補上的筆數 或 例外}"""
+    cache_dir = secrets.get("cache_dir", ".cache")
+    price_store = PriceStore(os.path.join(cache_dir, 'prices'))
+    fx_table = FxTable(fetch_fx_rates, price_store)
+    users = list(users) if users else backend.list_users()
+    datas = backend.load_many(users)
+    added = {}
+    for user, data in datas.items():
+        try:
+            with METRICS.span('batch.backfill'):
+                added[user] = backfill_history(backend, user, price_store, fx_table, data)
+        except Exception as e:
+            added[user] = e
+    return added
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="所有使用者的批次估值與資產紀錄")
+    parser.add_argument('--secrets', default=DEFAULT_SECRETS, help="Streamlit secrets.toml 路徑")
+    parser.add_argument('--users', nargs='+', help="只處理這些使用者")
+    parser.add_argument('--dry-run', action='store_true', help="只估值，不寫入")
+    parser.add_argument('--backfill', action='store_true', help="由交易紀錄補齊過去缺少的日期 (不做今天的估值)")
+    args = parser.parse_args(argv)
+
+    secrets = load_secrets(args.secrets)
+    METRICS.configure(secrets.get("metrics_jsonl"), secrets.get("metrics_prom"))
+    if args.backfill:
+        added = backfill(make_backend(secrets), secrets, args.users)
+        for user, n in sorted(added.items()):
+            print(f"{user:<20}補上 {n} 筆" if isinstance(n, int) else f"{user:<20}失敗: {n}")
+        return 1 if any(not isinstance(n, int) for n in added.values()) else 0
+    report = run(make_backend(secrets), args.users, dry_run=args.dry_run)
+
+    for user, r in sorted(report['results'].items()):
+        print(f"{user:<20}{int(r['net_asset']):>16,}{int(r['current_principal']):>16,}{len(r['positions']):>6} 檔")
+    for user, codes in sorted(report['skipped'].items()):
+        print(f"{user:<20}未寫入：{', '.join(codes)} 沒有報價或匯率", file=sys.stderr)
+    for source, msg in report['quote_errors']: print(f"報價錯誤 [{source}] {msg}", file=sys.stderr)
+    for title, e in report['write_errors']: print(f"寫入 {title} 失敗: {e}", file=sys.stderr)
+    print(f"{report['date']}：{report['users']} 位使用者、{report['symbols']} 檔股票，"
+          f"寫入 {report['recorded']} 筆、略過 {len(report['skipped'])} 位，耗時 {report['seconds']:.1f} 秒")
+    if secrets.get("metrics_prom"): METRICS.write_prometheus(secrets["metrics_prom"])
+    return 1 if report['write_errors'] or report['skipped'] else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
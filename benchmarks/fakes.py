@@ -0,0 +1,196 @@
+import time
+import random
+import re
+import numpy as np
+import pandas as pd
+import gspread
+
+# --- 離線替身：證交所、yfinance、Google Sheets ---
+# 每次呼叫先睡 latency 秒，並以 failure_rate 的機率丟出例外，模擬真實網路。
+
+class Upstream:
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._rng = random.Random(seed)
+
+    def reliable(self):
+        """暫時關閉模擬失敗 (準備測試資料時使用)"""
+        upstream = self
+        class _Reliable:
+            def __enter__(self):
+                self.saved = upstream.failure_rate
+                upstream.failure_rate = 0.0
+            def __exit__(self, *exc):
+                upstream.failure_rate = self.saved
+        return _Reliable()
+
+    def hit(self, name):
+        self.calls += 1
+        if self.latency: time.sleep(self.latency)
+        if self.failure_rate and self._rng.random() < self.failure_rate:
+            raise RuntimeError(f"{name} 模擬失敗")
+
+def fake_price(code):
+    return 10.0 + (sum(map(ord, code)) % 900)
+
+def fake_closes(symbols, start):
+    """取代 price_store.download_closes：每檔一條固定斜率的日線 (到 2025 年底)"""
+    idx = pd.bdate_range(pd.Timestamp(start), '2025-12-31')
+    step = np.arange(len(idx))
+    return {s: pd.Series(fake_price(s) * (1 + 0.0002 * step), index=idx) for s in symbols}
+
+class FakeTwse:
+    """取代 market.fetch_twse_chunk，回傳與 mis.twse.com.tw 相同格式解析後的結果"""
+    def __init__(self, upstream):
+        self.upstream = upstream
+
+    def __call__(self, query_parts):
+        self.upstream.hit('TWSE')
+        results = {}
+        for q in query_parts:
+            ex, raw = q.split('_', 1)
+            code = raw.replace('.tw', '') + ('.TW' if ex == 'tse' else '.TWO')
+            p = fake_price(code)
+            results[code] = {'p': p, 'chg': p * 0.01, 'chg_pct': 1.0, 'realtime': True}
+        return results
+
+class FakeYf:
+    """取代 yfinance 模組的 download (group_by='ticker' 的欄位格式)"""
+    def __init__(self, upstream, days=5):
+        self.upstream = upstream
+        self.days = days
+
+    def download(self, tickers, period=None, start=None, end=None, group_by=None, progress=False, auto_adjust=False):
+        self.upstream.hit('yfinance')
+        tickers = [tickers] if isinstance(tickers, str) else list(tickers)
+        idx = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=self.days)
+        base = np.array([fake_price(t) for t in tickers])
+        close = np.outer(1 + 0.001 * np.arange(len(idx)), base)
+        if len(tickers) == 1: return pd.DataFrame({'Close': close[:, 0]}, index=idx)
+        columns = pd.MultiIndex.from_product([tickers, ['Close']])
+        return pd.DataFrame(close, index=idx, columns=columns)
+
+class FakeWorksheet:
+    def __init__(self, title, upstream, rows=1000, sheet_id=0):
+        self.title = title
+        self.upstream = upstream
+        self.rows = []
+        # 與 API 相同：格線列數固定，只有 append 與 add_rows 會擴充，其他寫入超出時失敗
+        self.row_count = rows
+        self.id = sheet_id
+
+    def acell(self, a1):
+        self.upstream.hit('acell')
+        m = re.match(r"([A-Z])(\d+)", a1)
+        col, row = ord(m.group(1)) - 64, int(m.group(2))
+        cell = type('Cell', (), {})()
+        cell.value = self.rows[row - 1][col - 1] if row <= len(self.rows) and col <= len(self.rows[row - 1]) else None
+        return cell
+
+    def get(self, rng, **kwargs):
+        self.upstream.hit('get')
+        return self.values(rng)
+
+    def values(self, rng):
+        """A1 表示法的範圍 (A1、A:A、A2:C、A1:C1)，與 API 一樣去掉結尾的空列"""
+        m = re.match(r"([A-Z])(\d*)(?::([A-Z])(\d*))?$", rng)
+        c0 = ord(m.group(1)) - 65
+        c1 = ord(m.group(3) or m.group(1)) - 64
+        r0 = int(m.group(2) or 1)
+        r1 = int(m.group(4)) if m.group(4) else (r0 if m.group(2) and not m.group(3) else len(self.rows))
+        values = [list(r[c0:c1]) for r in self.rows[r0 - 1:r1]]
+        while values and not any(values[-1]): values.pop()
+        return values
+
+    def get_all_values(self):
+        self.upstream.hit('get_all_values')
+        return [list(r) for r in self.rows]
+
+    def append_row(self, row, **kwargs):
+        self.append_rows([row])
+
+    def append_rows(self, rows, **kwargs):
+        self.upstream.hit('append_rows')
+        self.rows.extend([str(v) for v in r] for r in rows)
+        self.row_count = max(self.row_count, len(self.rows))
+
+    def add_rows(self, n):
+        self.upstream.hit('add_rows')
+        self.row_count += n
+
+    def update_cell(self, r, c, value):
+        self.upstream.hit('update_cell')
+        self._set(r, c, value)
+
+    def batch_update(self, data, **kwargs):
+        self.upstream.hit('batch_update')
+        for d in data:
+            m = re.match(r"([A-Z])(\d+)", d['range'])
+            col, row = ord(m.group(1)) - 64, int(m.group(2))
+            for i, values in enumerate(d['values']):
+                for j, v in enumerate(values): self._set(row + i, col + j, v)
+
+    def _set(self, r, c, value):
+        if r > self.row_count: raise ValueError(f"Range ({self.title}!R{r}) exceeds grid limits. Max rows: {self.row_count}")
+        while len(self.rows) < r: self.rows.append([])
+        row = self.rows[r - 1]
+        while len(row) < c: row.append('')
+        row[c - 1] = str(value)
+
+class FakeSpreadsheet:
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self._sheets = {}
+
+    def worksheet(self, title):
+        self.upstream.hit('worksheet')
+        if title not in self._sheets: raise gspread.exceptions.WorksheetNotFound(title)
+        return self._sheets[title]
+
+    def add_worksheet(self, title, rows, cols):
+        self.upstream.hit('add_worksheet')
+        self._sheets[title] = FakeWorksheet(title, self.upstream, int(rows), len(self._sheets) + 1)
+        return self._sheets[title]
+
+    def worksheets(self):
+        self.upstream.hit('worksheets')
+        return list(self._sheets.values())
+
+    def _split(self, rng):
+        title, cells = rng.rsplit('!', 1)
+        return self._sheets[title.strip("'").replace("''", "'")], cells
+
+    def values_batch_get(self, ranges, params=None):
+        self.upstream.hit('values_batch_get')
+        value_ranges = []
+        for rng in ranges:
+            ws, cells = self._split(rng)
+            value_ranges.append({'range': rng, 'values': ws.values(cells)})
+        return {'valueRanges': value_ranges}
+
+    def batch_update(self, body):
+        self.upstream.hit('batch_update')
+        by_id = {ws.id: ws for ws in self._sheets.values()}
+        for req in body['requests']:
+            dim = req['appendDimension']
+            by_id[dim['sheetId']].row_count += dim['length']
+
+    def values_batch_update(self, body=None):
+        self.upstream.hit('values_batch_update')
+        for d in body['data']:
+            ws, cells = self._split(d['range'])
+            m = re.match(r"([A-Z])(\d+)", cells)
+            col, row = ord(m.group(1)) - 64, int(m.group(2))
+            for i, values in enumerate(d['values']):
+                for j, v in enumerate(values): ws._set(row + i, col + j, v)
+
+class FakeClient:
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.spreadsheet = FakeSpreadsheet(upstream)
+
+    def open(self, name):
+        self.upstream.hit('open')
+        return self.spreadsheet
@@ -0,0 +1,228 @@
+import os
+import sys
+import copy
+import json
+import time
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import market
+from events import apply_event, sell_event, cash_event
+from fx import FxTable, foreign_currencies
+from valuation import value_portfolio, summarize_portfolio
+from sheets import SheetPool, WriteBehind
+from storage import GoogleSheetsBackend, SQLiteBackend, commit_event, normalize_data
+from ledger import Position
+from tables import FormattedTable, history_frame, HISTORY_FORMATS, HISTORY_COLORED
+from benchmarks.fakes import Upstream, FakeTwse, FakeYf, FakeClient, fake_closes
+from benchmarks.synthetic import make_portfolio
+import batch_job
+from price_store import PriceStore
+from reconstruct import reconstruct
+from returns import ReturnTracker, twr_curve, xirr_of, row_flows
+from risk import RiskEngine, RISK_BENCHMARKS
+from margin import MarginBook, margin_book
+
+# --- 效能基準測試 ---
+# 用法：python -m benchmarks.run [--sizes 10 1000 10000] [--latency 0.05] [--save-baseline]
+# 證交所、yfinance、Google Sheets 都以本機替身取代，可設定延遲與失敗率。
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+def measure(fn, repeat, setup=None):
+    """回傳 (每次耗時秒數 list, 失敗次數, 峰值記憶體 bytes)"""
+    times = []
+    errors = 0
+    for _ in range(repeat):
+        arg = setup() if setup else None
+        t0 = time.perf_counter()
+        try: fn(arg)
+        except Exception: errors += 1
+        times.append(time.perf_counter() - t0)
+
+    # 另外跑一次量測峰值記憶體，避免 tracemalloc 影響計時
+    arg = setup() if setup else None
+    tracemalloc.start()
+    try: fn(arg)
+    except Exception: pass
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, errors, peak
+
+def sheets_backend(upstream):
+    client = FakeClient(upstream)
+    return GoogleSheetsBackend(SheetPool(lambda: client, 'bench'), WriteBehind())
+
+def bench_size(n, args, upstreams, tmpdir):
+    data = normalize_data(make_portfolio(n, lots_per_holding=args.lots, n_history=n * args.history_factor, seed=n))
+    codes = list(data['h'])
+    repeat = args.repeat if n < 10000 else max(3, args.repeat // 5)
+    results = {}
+
+    # 1. 存檔 / 讀檔 (快照 + 事件重播)
+    backends = {
+        'sheets': sheets_backend(upstreams['sheets']),
+        'sqlite': SQLiteBackend(os.path.join(tmpdir, f"bench_{n}.db")),
+    }
+    for name, backend in backends.items():
+        user = f"bench{n}"
+        def save(_, backend=backend, user=user):
+            backend.save_snapshot(user, data)
+            errors = backend.flush()
+            if errors: raise errors[0][1]
+        results[f"save[{name}]"] = measure(save, repeat)
+
+        with upstreams['sheets'].reliable():
+            tail = copy.deepcopy(data)
+            backend.save_snapshot(user, tail)
+            for _ in range(args.tail_events):
+                commit_event(backend, user, tail, cash_event(1000.0))
+            backend.flush()
+        results[f"load[{name}]"] = measure(lambda _, backend=backend, user=user: backend.load(user), repeat)
+
+    # 2. FIFO 賣出 (單一持股有大量 lots)
+    sell_code = codes[0]
+    pos = Position(sell_code)
+    for _ in range(args.sell_lots): pos.buy('2020-01-01', 100.0, 100)
+    big = {'h': {sell_code: pos}, 'cash': 0.0, 'history': []}
+    sell_ev = sell_event('2024-01-01', sell_code, 100 * args.sell_lots // 2, 100.0, 1.0, sell_code)
+    results['sell_fifo'] = measure(lambda d: apply_event(d, sell_ev), repeat, setup=lambda: copy.deepcopy(big))
+
+    # 3. 報價 (台股分批 + yfinance 平行)
+    def quotes(_):
+        errors = market.fetch_quotes_concurrent(codes, foreign_currencies(codes))[2]
+        if errors: raise RuntimeError(errors[0][1])
+    results['quotes'] = measure(quotes, repeat)
+
+    # 4. 估值
+    with upstreams['twse'].reliable(), upstreams['yf'].reliable():
+        quotes, fx_rates, _ = market.fetch_quotes_concurrent(codes, foreign_currencies(codes))
+    def valuation(_):
+        positions = value_portfolio(data['h'], quotes, fx_rates)
+        summarize_portfolio(positions, data['cash'], data['principal'], 0.0)
+    results['valuation'] = measure(valuation, repeat)
+
+    # 4b. 融資維持率 (每次報價更新都會執行；批次陣列建好後只做陣列運算)
+    book = margin_book(data)
+    results[f"margin_tick[{len(book)}lots]"] = measure(lambda _: book.status(quotes, fx_rates), repeat)
+    results['margin_build'] = measure(lambda _: MarginBook(data['h']), repeat)
+
+    # 5. 已實現損益表 (建表格式化一次 + 搜尋排序取一頁)
+    def history_table(_):
+        table = FormattedTable(history_frame(data['history']), HISTORY_FORMATS, HISTORY_COLORED)
+        rows = table.query('TW', ['代碼'], '獲利金額', False)
+        table.page(rows, 0, 50).to_html()
+    results['history_table'] = measure(history_table, repeat)
+
+    # 6. 批次估值 (多位使用者：一次報價、批次讀取快照與寫入資產紀錄)
+    n_users = max(1, min(n, args.batch_users))
+    backend = sheets_backend(upstreams['sheets'])
+    with upstreams['sheets'].reliable():
+        for i in range(n_users):
+            backend.save_snapshot(f"u{i}", normalize_data(make_portfolio(args.batch_holdings, args.lots, n_history=0, seed=i)))
+        backend.flush()
+    def batch(_):
+        report = batch_job.run(backend)
+        errors = report['quote_errors'] + report['write_errors'] + [('skipped', u) for u in report['skipped']]
+        if errors: raise RuntimeError(errors[0][1])
+    results[f"batch_job[{n_users}u]"] = measure(batch, repeat)
+
+    # 7. 歷史資產重建 (由 lots 與已實現紀錄推估，日期 x 代碼矩陣)
+    prices = PriceStore(os.path.join(tmpdir, f"prices_{n}"), downloader=fake_closes)
+    fx_table = FxTable(lambda currencies: {c: 30.0 for c in currencies}, prices)
+    prices.update(list(data['h']) + [r['code'] for r in data['history']] + ['USDTWD=X'] + RISK_BENCHMARKS, '2019-01-01')
+    results['reconstruct'] = measure(lambda _: reconstruct(data, [], prices, fx_table, end='2025-12-31'), repeat)
+    # 舊資料 (事件化之前的持股) 之後的第一筆事件就是賣出：重播失敗時要改用推估
+    legacy_sell = [(1, '2024-01-02 10:00:00', sell_event('2024-01-02', codes[0], 100, 100.0, 1.0, codes[0]))]
+    if reconstruct(data, legacy_sell, prices, fx_table, end='2025-12-31').empty:
+        raise RuntimeError("reconstruct failed for a legacy snapshot with a sell event")
+
+    # 8. TWR / XIRR (n 天的資產紀錄與資金存提：新增一天的增量更新，與整段重算核對)
+    rng = np.random.default_rng(n)
+    days = max(n, 250)
+    dates = pd.bdate_range('2015-01-01', periods=days)
+    deposits = pd.Series(rng.normal(0, 1e5, days).round(-4), index=dates)[rng.random(days) < 0.02]
+    flows = row_flows(dates, deposits)
+    dfh = pd.DataFrame({'Date': dates, 'NetAsset': 1e6 * np.cumprod(1 + rng.normal(3e-4, 0.01, days)) + np.cumsum(flows)})
+    tracker = ReturnTracker().extend(dfh.iloc[:-1], flows[:-1]).extend(dfh, flows)
+    if abs(tracker.curve().iloc[-1] - twr_curve(dfh, flows).iloc[-1]) > 1e-6 or abs(tracker.xirr - xirr_of(dfh, flows)) > 1e-6:
+        raise RuntimeError("incremental returns differ from full recompute")
+    results['returns_update'] = measure(lambda t: t.extend(dfh, flows), repeat, setup=lambda: ReturnTracker().extend(dfh.iloc[:-1], flows[:-1]))
+    results['returns_full'] = measure(lambda _: (twr_curve(dfh, flows), xirr_of(dfh, flows)), repeat)
+
+    # 9. 風險分析 (報酬矩陣 + 指標；第二次同持股同日期走快取)
+    mkt_val = np.array([p.shares * p.avg_cost for p in data['h'].values()])
+    shares = [p.shares for p in data['h'].values()]
+    results['risk'] = measure(lambda engine: engine.report(codes, shares, mkt_val, '2025-12-31'), repeat,
+                              setup=lambda: RiskEngine(prices, fx_table))
+    engine = RiskEngine(prices, fx_table)
+    engine.report(codes, shares, mkt_val, '2025-12-31')
+    results['risk_cached'] = measure(lambda _: engine.report(codes, shares, mkt_val, '2025-12-31'), repeat)
+    return results
+
+def summarize(times, errors, peak):
+    ms = np.array(times) * 1000
+    return {
+        'p50': float(np.percentile(ms, 50)), 'p99': float(np.percentile(ms, 99)),
+        'peak_mb': peak / 1e6, 'errors': errors, 'n': len(times)
+    }
+
+def compare(report, baseline, tolerance):
+    regressions = []
+    for key, cur in report.items():
+        base = baseline.get(key)
+        if base and cur['p50'] > base['p50'] * (1 + tolerance) and cur['p50'] - base['p50'] > 1.0:
+            regressions.append((key, base['p50'], cur['p50']))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="資產管家效能基準測試 (離線)")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000])
+    parser.add_argument('--lots', type=int, default=5, help="每檔持股的 lots 數")
+    parser.add_argument('--history-factor', type=int, default=2, help="已實現紀錄筆數 = 持股數 x 此倍數")
+    parser.add_argument('--sell-lots', type=int, default=2000, help="FIFO 賣出測試的 lots 數")
+    parser.add_argument('--tail-events', type=int, default=10, help="讀檔時需重播的事件數")
+    parser.add_argument('--batch-users', type=int, default=200, help="批次估值測試的使用者數上限")
+    parser.add_argument('--batch-holdings', type=int, default=20, help="批次估值測試每位使用者的持股數")
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--latency', type=float, default=0.0, help="每次上游呼叫的模擬延遲 (秒)")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="上游呼叫的模擬失敗率")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25, help="p50 超過基準多少比例視為退步")
+    args = parser.parse_args(argv)
+
+    upstreams = {name: Upstream(args.latency, args.failure_rate, seed=i) for i, name in enumerate(['twse', 'yf', 'sheets'])}
+    market.fetch_twse_chunk = FakeTwse(upstreams['twse'])
+    market.yf = FakeYf(upstreams['yf'])
+
+    report = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for n in args.sizes:
+            for stage, measured in bench_size(n, args, upstreams, tmpdir).items():
+                report[f"{stage}@{n}"] = summarize(*measured)
+
+    print(f"{'stage':<24}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>10}{'errors':>8}")
+    for key, r in report.items():
+        print(f"{key:<24}{r['p50']:>10.2f}{r['p99']:>10.2f}{r['peak_mb']:>10.2f}{r['errors']:>8}")
+    print("upstream calls: " + ", ".join(f"{k}={u.calls}" for k, u in upstreams.items()))
+
+    status = 0
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f: json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f: baseline = json.load(f)
+        regressions = compare(report, baseline, args.tolerance)
+        for key, base, cur in regressions:
+            print(f"REGRESSION {key}: p50 {base:.2f} ms -> {cur:.2f} ms")
+        status = 1 if regressions else 0
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
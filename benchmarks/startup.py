@@ -0,0 +1,94 @@
+import os
+import re
+import ast
+import sys
+import argparse
+import subprocess
+
+# --- 冷啟動載入時間報告 ---
+# 用法：python -m benchmarks.startup [--budget-login 800] [--budget-app 2000] [--top 10]
+# 以 python -X importtime 在新的直譯器中分別載入「登入頁」與「登入後」所需的模組，
+# 列出最慢的套件，超過預算或登入頁載入了重型套件時回傳非 0。
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+APP_PATH = os.path.join(ROOT, 'app.py')
+
+def app_imports(path=APP_PATH):
+    """
+    由 app.py 最外層的 import 取得 (登入前, 登入後) 的模組清單，
+    第一個最外層的 if (登入表單) 之前為登入前。app.py 新增 import 時不必同步修改這裡。
+    """
+    with open(path, encoding='utf-8') as f:
+        tree = ast.parse(f.read())
+    login, app = [], []
+    target = login
+    for node in tree.body:
+        if isinstance(node, ast.If): target = app
+        elif isinstance(node, ast.Import): target.extend(a.name for a in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0: target.append(node.module)
+    return list(dict.fromkeys(login)), list(dict.fromkeys(app))
+
+# app.py 在登入表單之前 import 的模組、登入後主程式 import 的模組 (不含延遲載入的部分)
+LOGIN_MODULES, APP_MODULES = app_imports()
+# 延遲到第一次使用才載入
+LAZY_MODULES = ['yfinance', 'gspread', 'oauth2client.service_account', 'plotly.express', 'plotly.graph_objects']
+# 登入頁不應出現的套件 (plotly 的部分模組由 streamlit 本身載入，不列入)
+HEAVY_PACKAGES = {'pandas', 'numpy', 'yfinance', 'gspread', 'oauth2client', 'pyarrow'}
+
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)')
+
+def importtime(modules, preloaded=()):
+    """
+    在新的直譯器載入 modules，回傳 (總耗時 ms, [(套件, 累計 ms)], 所有載入的模組名稱)。
+    preloaded 先載入但不計入 (例如登入後的階段已經載入過 streamlit)。
+    """
+    code = ''.join(f"import {m}\n" for m in preloaded)
+    code += "import sys\nsys.stderr.write('--- measure ---\\n')\n"
+    code += ''.join(f"import {m}\n" for m in modules)
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=ROOT,
+                          capture_output=True, text=True, check=True)
+    stderr = proc.stderr.split('--- measure ---\n', 1)[-1]
+    top = []
+    loaded = set()
+    for line in stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if not m: continue
+        loaded.add(m.group(4))
+        # 沒有縮排的是最外層的 import，累計時間已包含其相依套件
+        if len(m.group(3)) == 1:
+            top.append((m.group(4), int(m.group(2)) / 1000))
+    return sum(ms for _, ms in top), sorted(top, key=lambda t: t[1], reverse=True), loaded
+
+def report(title, total, top, budget, n):
+    status = 'OK' if budget is None or total <= budget else 'OVER BUDGET'
+    budget_str = f" / budget {budget:.0f} ms" if budget is not None else ''
+    print(f"{title}: {total:.0f} ms{budget_str}  [{status}]")
+    for name, ms in top[:n]:
+        print(f"    {name:<36}{ms:>10.1f} ms")
+    return budget is None or total <= budget
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="冷啟動 import 時間報告")
+    parser.add_argument('--budget-login', type=float, default=None, help="登入頁 import 預算 (ms)")
+    parser.add_argument('--budget-app', type=float, default=None, help="登入後 import 預算 (ms)")
+    parser.add_argument('--top', type=int, default=10)
+    args = parser.parse_args(argv)
+
+    ok = True
+    total, top, loaded = importtime(LOGIN_MODULES)
+    ok &= report("login page", total, top, args.budget_login, args.top)
+    heavy = sorted(p for p in HEAVY_PACKAGES if p in loaded)
+    if heavy:
+        print(f"    !! login page imports heavy packages: {', '.join(heavy)}")
+        ok = False
+
+    total, top, _ = importtime(APP_MODULES, preloaded=LOGIN_MODULES)
+    ok &= report("main app", total, top, args.budget_app, args.top)
+
+    total, top, _ = importtime(LAZY_MODULES, preloaded=LOGIN_MODULES + APP_MODULES)
+    report("lazy (first use)", total, top, None, args.top)
+    return 0 if ok else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
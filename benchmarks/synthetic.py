@@ -0,0 +1,44 @@
+import random
+from datetime import date, timedelta
+
+# --- 合成投資組合 ---
+
+def make_codes(n, seed=0):
+    rng = random.Random(seed)
+    codes = []
+    for i in range(n):
+        r = rng.random()
+        if r < 0.6: codes.append(f"{1000 + i}.TW")
+        elif r < 0.8: codes.append(f"{5000 + i}.TWO")
+        else: codes.append(f"US{i:05d}")
+    return codes
+
+def make_portfolio(n_holdings, lots_per_holding=5, n_history=None, seed=0):
+    """產生與 data 相同結構的合成資料 (h / cash / principal / history)"""
+    rng = random.Random(seed)
+    n_history = n_holdings * 2 if n_history is None else n_history
+    start = date(2020, 1, 1)
+    h = {}
+    for code in make_codes(n_holdings, seed):
+        lots = []
+        for k in range(lots_per_holding):
+            margin = rng.random() < 0.3
+            p = round(rng.uniform(10, 1000), 2)
+            s = rng.choice([100, 500, 1000, 2000])
+            lots.append({
+                'd': (start + timedelta(days=k * 7)).isoformat(), 'p': p, 's': s,
+                'type': '融資' if margin else '現股', 'debt': p * s * 0.6 if margin else 0
+            })
+        tot_s = sum(l['s'] for l in lots)
+        h[code] = {'s': tot_s, 'c': sum(l['s'] * l['p'] for l in lots) / tot_s, 'n': code, 'lots': lots}
+
+    history = []
+    for i in range(n_history):
+        cost = rng.uniform(1e4, 1e6)
+        rev = cost * rng.uniform(0.7, 1.5)
+        history.append({
+            'd': (start + timedelta(days=i % 2000)).isoformat(), 'code': f"{1000 + i % 500}.TW",
+            'name': f"{1000 + i % 500}.TW", 'qty': 1000,
+            'buy_cost': cost, 'sell_rev': rev, 'profit': rev - cost, 'roi': (rev - cost) / cost * 100
+        })
+    return {'h': h, 'cash': 1e7, 'principal': 5e7, 'history': history}
@@ -0,0 +1,120 @@
+import json
+import zlib
+import base64
+
+from ledger import Position
+
+# --- 快照編碼 ---
+# 第 2 版：持股、lots 與已實現紀錄改成「每個欄位一個陣列」，重複的字串 (日期、名稱、類別)
+# 再以字典編碼，可選擇 zlib 壓縮後轉 base64。
+# 沒有 'v' 欄位的 JSON 為第 1 版 (舊格式)，讀取時自動轉換，下次存檔即改存新格式。
+
+FORMAT_VERSION = 2
+# 壓縮後的字串以此開頭 (後接版本號與 ':')
+COMPRESSED_PREFIX = 'z'
+# Google Sheets 單一儲存格上限為 50,000 字元，留一點餘裕
+CELL_LIMIT = 49000
+
+# 只存在記憶體中的欄位 (讀取時記錄的版本、已實現損益索引、融資批次陣列)
+RUNTIME_KEYS = ('_fmt', '_realized', '_margin')
+
+LOT_FIELDS = ['id', 'd', 'p', 's', 'type', 'debt']
+HISTORY_FIELDS = ['d', 'code', 'name', 'qty', 'buy_cost', 'sell_rev', 'profit', 'roi']
+
+def pack_column(values):
+    """重複值多的字串欄位改存 {'k': 不重複值, 'i': 索引}"""
+    if len(values) > 1 and all(isinstance(v, str) for v in values):
+        keys = list(dict.fromkeys(values))
+        if len(keys) * 2 <= len(values):
+            index = {k: i for i, k in enumerate(keys)}
+            return {'k': keys, 'i': [index[v] for v in values]}
+    return values
+
+def unpack_column(column):
+    if isinstance(column, dict):
+        keys = column['k']
+        return [keys[i] for i in column['i']]
+    return column
+
+def pack_records(records, fields):
+    """list of dict -> {欄位: 陣列}，額外的欄位另外保留"""
+    columns = {f: pack_column([r.get(f) for r in records]) for f in fields}
+    extra = sorted({k for r in records for k in r} - set(fields))
+    for f in extra: columns[f] = pack_column([r.get(f) for r in records])
+    return {'n': len(records), 'cols': columns}
+
+def unpack_records(packed, fields):
+    n = packed['n']
+    columns = {f: unpack_column(col) for f, col in packed['cols'].items()}
+    records = [{} for _ in range(n)]
+    for f, col in columns.items():
+        # 舊資料沒有的欄位不補 None
+        for r, v in zip(records, col):
+            if v is not None or f in fields: r[f] = v
+    return records
+
+def encode_portfolio(data):
+    """data (持股為 Position) -> 第 2 版欄位式 dict"""
+    codes = list(data.get('h', {}))
+    positions = [data['h'][c] for c in codes]
+    lot_rows = []
+    lot_counts = []
+    for pos in positions:
+        rows = [lot.to_row() for lot in pos.iter_lots()]
+        lot_counts.append(len(rows))
+        lot_rows.extend(rows)
+    lot_cols = list(zip(*lot_rows)) or [()] * len(LOT_FIELDS)
+
+    meta = {k: v for k, v in data.items() if k not in ('h', 'history') and k not in RUNTIME_KEYS}
+    return {
+        'v': FORMAT_VERSION,
+        'meta': meta,
+        'h': {
+            'code': codes,
+            'n': pack_column([p.name for p in positions]),
+            'c': [p.avg_cost for p in positions],
+            'lot_n': lot_counts,
+            'lots': {f: pack_column(list(col)) for f, col in zip(LOT_FIELDS, lot_cols)},
+        },
+        'history': pack_records(data.get('history', []), HISTORY_FIELDS),
+    }
+
+def decode_portfolio(doc):
+    """第 2 版 dict -> data (持股為 Position)"""
+    data = dict(doc.get('meta', {}))
+    h = doc.get('h', {})
+    codes = h.get('code', [])
+    names = unpack_column(h.get('n', codes))
+    lot_cols = [unpack_column(h.get('lots', {}).get(f, [])) for f in LOT_FIELDS]
+    lot_rows = list(zip(*lot_cols))
+    holdings = {}
+    start = 0
+    for code, name, c, count in zip(codes, names, h.get('c', []), h.get('lot_n', [])):
+        holdings[code] = Position.from_dict(code, {'n': name, 'c': c, 'lots': [list(r) for r in lot_rows[start:start + count]]})
+        start += count
+    data['h'] = holdings
+    data['history'] = unpack_records(doc['history'], HISTORY_FIELDS) if 'history' in doc else []
+    return data
+
+def dumps(data, compress=True):
+    text = json.dumps(encode_portfolio(data), ensure_ascii=False, separators=(',', ':'))
+    if not compress: return text
+    packed = base64.b64encode(zlib.compress(text.encode('utf-8'))).decode('ascii')
+    return f"{COMPRESSED_PREFIX}{FORMAT_VERSION}:{packed}"
+
+def loads(raw):
+    """
+    讀取任何版本的快照字串，回傳 (data, 版本)。
+    第 1 版的持股仍是 dict，由呼叫端 normalize 成 Position。
+    """
+    if raw.startswith(COMPRESSED_PREFIX):
+        _, packed = raw.split(':', 1)
+        raw = zlib.decompress(base64.b64decode(packed)).decode('utf-8')
+    doc = json.loads(raw)
+    version = doc.get('v', 1) if isinstance(doc, dict) else 1
+    if version == 1: return doc, 1
+    if version > FORMAT_VERSION: raise ValueError(f"不支援的快照版本: {version}")
+    return decode_portfolio(doc), version
+
+def shard(text, size=CELL_LIMIT):
+    return [text[i:i + size] for i in range(0, len(text), size)] or ['']
@@ -0,0 +1,102 @@
+# --- 交易事件 ---
+# 每一筆買進、賣出、資金存提、本金修正都記成一個事件。
+# 讀取時以「最新快照 + 之後的事件重播」還原資料，存檔只需追加一列。
+
+from ledger import Position, DEFAULT_COST_METHOD
+
+# 累積多少筆事件後寫入一次完整快照
+COMPACT_EVERY = 20
+
+def buy_event(d, code, price, shares, trade_type, debt, cash_needed):
+    return {'t': 'buy', 'd': d, 'code': code, 'p': price, 's': shares, 'type': trade_type, 'debt': debt, 'cash': cash_needed}
+
+def sell_event(d, code, qty, price, rate, name, method=DEFAULT_COST_METHOD, lot_ids=None, basis=None):
+    ev = {'t': 'sell', 'd': d, 'code': code, 'qty': qty, 'price': price, 'rate': rate, 'name': name}
+    # 先進先出為預設，不寫入事件
+    if method != DEFAULT_COST_METHOD: ev['method'] = method
+    if lot_ids: ev['lots'] = list(lot_ids)
+    # 海外持股以買進當天匯率換算的台幣成本 (重播時不必再查歷史匯率)
+    if basis is not None: ev['basis'] = basis
+    return ev
+
+def cash_event(amount):
+    return {'t': 'cash', 'amt': amount}
+
+def principal_event(value):
+    return {'t': 'principal', 'v': value}
+
+def delete_event(code, refund=0.0):
+    return {'t': 'delete', 'code': code, 'refund': refund}
+
+def _apply_buy(data, ev):
+    code = ev['code']
+    data['cash'] -= ev['cash']
+    pos = data['h'].get(code)
+    if pos is None: pos = data['h'][code] = Position(code)
+    pos.buy(ev['d'], ev['p'], ev['s'], ev['type'], ev['debt'])
+
+def _apply_sell(data, ev):
+    code = ev['code']
+    sell_qty = ev['qty']
+    rate = ev['rate']
+    pos = data['h'][code]
+    sell_revenue = sell_qty * ev['price'] * rate
+    cost, total_debt_repaid = pos.sell(sell_qty, ev.get('method', DEFAULT_COST_METHOD), ev.get('lots'))
+    # 已實現損益含匯兌損益：成本以買進當天的匯率計，沒有記錄時 (舊事件、台股) 以賣出當天的匯率計
+    total_cost_basis = ev['basis'] if 'basis' in ev else cost * rate
+
+    realized_profit = sell_revenue - total_cost_basis
+    realized_roi = (realized_profit / total_cost_basis * 100) if total_cost_basis else 0
+    data['cash'] += sell_revenue - total_debt_repaid
+    if pos.shares == 0: del data['h'][code]
+
+    record = {
+        'd': ev['d'], 'code': code, 'name': ev['name'], 'qty': sell_qty,
+        'buy_cost': total_cost_basis, 'sell_rev': sell_revenue,
+        'profit': realized_profit, 'roi': realized_roi
+    }
+    data['history'].append(record)
+    # 已建立已實現損益索引時直接累加這一筆
+    index = data.get('_realized')
+    if index is not None and index.size == len(data['history']) - 1: index.add(record)
+
+def _apply_cash(data, ev):
+    data['cash'] += ev['amt']
+    data['principal'] = data.get('principal', 0.0) + ev['amt']
+
+def _apply_principal(data, ev):
+    data['principal'] = ev['v']
+
+def _apply_delete(data, ev):
+    data['cash'] += ev.get('refund', 0.0)
+    data['h'].pop(ev['code'], None)
+
+EVENT_HANDLERS = {
+    'buy': _apply_buy,
+    'sell': _apply_sell,
+    'cash': _apply_cash,
+    'principal': _apply_principal,
+    'delete': _apply_delete,
+}
+
+def apply_event(data, ev):
+    """將單一事件套用到資料 (直接修改 data)"""
+    if 'h' not in data: data['h'] = {}
+    if 'history' not in data: data['history'] = []
+    EVENT_HANDLERS[ev['t']](data, ev)
+    return data
+
+def replay(data, events):
+    """
+    依 seq 套用快照之後的事件。寫入重試可能讓同一個 seq 出現兩次，
+    seq 不大於目前 _seq 的 (已在快照內或已套用過) 一律略過。
+    """
+    for seq, ev in sorted(events, key=lambda e: int(e[0])):
+        seq = int(seq)
+        if seq <= data.get('_seq', 0): continue
+        apply_event(data, ev)
+        data['_seq'] = seq
+    return data
+
+def needs_compaction(data):
+    return data.get('_seq', 0) - data.get('_snap_seq', 0) >= COMPACT_EVERY
@@ -0,0 +1,124 @@
+import time
+import threading
+import numpy as np
+import pandas as pd
+
+# --- 匯率 ---
+# 依代碼後綴判斷計價幣別，所有需要的匯率 ({幣別}TWD=X) 與報價合併成同一次下載。
+# 匯率表記錄每個幣別的取得時間，估值時以陣列一次換算成台幣；
+# 歷史匯率 (計算買進當時的成本) 由 PriceStore 的日線資料提供。
+
+BASE_CURRENCY = 'TWD'
+DEFAULT_CURRENCY = 'USD'
+# 代碼後綴 -> 幣別 (沒有後綴或不在表內的視為美股)
+SUFFIX_CURRENCY = {
+    '.TW': 'TWD', '.TWO': 'TWD',
+    '.HK': 'HKD',
+    '.T': 'JPY',
+    '.DE': 'EUR', '.F': 'EUR', '.PA': 'EUR', '.AS': 'EUR', '.MI': 'EUR', '.MC': 'EUR', '.BR': 'EUR',
+}
+# 從未取得過匯率時的備用值
+FALLBACK_RATES = {'USD': 32.5, 'HKD': 4.15, 'JPY': 0.21, 'EUR': 35.0}
+# 匯率快取存活秒數
+FX_TTL = 300
+
+def currency_of(code):
+    dot = code.rfind('.')
+    if dot <= 0: return DEFAULT_CURRENCY
+    return SUFFIX_CURRENCY.get(code[dot:].upper(), DEFAULT_CURRENCY)
+
+def fx_ticker(currency):
+    return f"{currency}{BASE_CURRENCY}=X"
+
+def foreign_currencies(codes):
+    """codes 需要換算的外幣 (不含台幣)"""
+    return sorted({currency_of(c) for c in codes} - {BASE_CURRENCY})
+
+def rate_array(codes, rates):
+    """每個代碼對台幣的匯率陣列 (相同幣別只查一次)"""
+    if not len(codes): return np.zeros(0)
+    currencies, inverse = np.unique([currency_of(c) for c in codes], return_inverse=True)
+    lookup = np.array([1.0 if cur == BASE_CURRENCY else float(rates.get(cur) or FALLBACK_RATES.get(cur, np.nan)) for cur in currencies])
+    return lookup[inverse]
+
+def rates_on(daily, currencies, days):
+    """
+    每一列 (幣別, 日期) 的歷史匯率：daily 為 FxTable.daily() 的日期 x 幣別表，
+    取該日 (或之前最近一天) 的匯率，同一幣別一次二分搜尋。
+    """
+    currencies = np.asarray(currencies)
+    days = pd.to_datetime(pd.Series(days), errors='coerce')
+    out = np.ones(len(currencies))
+    for cur in np.unique(currencies):
+        if cur == BASE_CURRENCY or cur not in daily: continue
+        series = daily[cur].dropna()
+        if series.empty: continue
+        mask = currencies == cur
+        when = days[mask].fillna(series.index[-1])
+        i = np.clip(series.index.searchsorted(when, side='right') - 1, 0, len(series) - 1)
+        out[mask] = series.to_numpy()[i]
+    return out
+
+class FxTable:
+    """
+    即時匯率表 {幣別: (匯率, 取得時間)}，整個伺服器程序共用。
+    報價更新時順帶取得的匯率以 update() 放入；單獨查詢時 get() 一次補抓所有缺少或過期的幣別，
+    抓取失敗沿用最後一次的匯率，從未取得過才用備用值。
+    """
+    def __init__(self, fetcher, price_store=None, ttl=FX_TTL):
+        self.fetcher = fetcher  # [幣別] -> {幣別: 匯率}
+        self.price_store = price_store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._rates = {}
+
+    def update(self, rates, ts=None):
+        ts = ts or time.time()
+        with self._lock:
+            for cur, rate in rates.items():
+                if rate and rate > 0: self._rates[cur] = (float(rate), ts)
+
+    def stale(self, currencies, now_ts=None):
+        """缺少或過期、需要重抓的幣別"""
+        now_ts = now_ts or time.time()
+        with self._lock:
+            return [c for c in currencies if c != BASE_CURRENCY and (c not in self._rates or now_ts - self._rates[c][1] > self.ttl)]
+
+    def known(self, currencies):
+        """已取得過的匯率 (不連線)"""
+        with self._lock:
+            return {c: self._rates[c][0] for c in currencies if c in self._rates}
+
+    def get(self, currencies):
+        currencies = [c for c in dict.fromkeys(currencies) if c != BASE_CURRENCY]
+        stale = self.stale(currencies)
+        if stale:
+            try: self.update(self.fetcher(stale))
+            except Exception: pass
+        rates = self.known(currencies)
+        for cur in currencies:
+            if cur not in rates: rates[cur] = FALLBACK_RATES.get(cur, np.nan)
+        return rates
+
+    def rate_for(self, code):
+        cur = currency_of(code)
+        return 1.0 if cur == BASE_CURRENCY else self.get([cur])[cur]
+
+    def daily(self, currencies, start, end=None):
+        """日期 x 幣別的歷史匯率 (向前補值，台幣欄為 1)；最早沒有資料的日子以第一筆或目前匯率補上"""
+        currencies = list(dict.fromkeys(currencies))
+        foreign = [c for c in currencies if c != BASE_CURRENCY]
+        frame = pd.DataFrame(index=pd.DatetimeIndex([]))
+        if foreign and self.price_store is not None:
+            try:
+                frame = self.price_store.closes([fx_ticker(c) for c in foreign], start, end)
+                frame.columns = [t[:3] for t in frame.columns]
+            except Exception:
+                frame = pd.DataFrame(index=pd.DatetimeIndex([]))
+        if frame.empty:
+            frame = pd.DataFrame(index=pd.DatetimeIndex([pd.Timestamp(end or pd.Timestamp.today()).normalize()]))
+        for cur in currencies:
+            if cur == BASE_CURRENCY: frame[cur] = 1.0
+            elif cur not in frame.columns: frame[cur] = np.nan
+        latest = self.get(foreign) if frame[foreign].isna().any().any() else {}
+        return frame[currencies].ffill().bfill().fillna(latest)
@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+import pandas as pd
+
+# 超過這段時間才重新向儲存後端同步 (秒)
+HIST_SYNC_MAX_AGE = 300
+
+# --- 資產走勢本機鏡像 ---
+# 資產紀錄 (Hist_ 工作表) 的內容複製一份到本機 SQLite，
+# 之後只讀取上次同步之後的列，資產走勢頁直接從鏡像繪圖。
+
+class HistoryMirror:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS hist (
+                user TEXT NOT NULL, date TEXT NOT NULL, net REAL, principal REAL, dirty INTEGER DEFAULT 0,
+                PRIMARY KEY (user, date)
+            );
+            CREATE TABLE IF NOT EXISTS hist_sync (
+                user TEXT PRIMARY KEY, last_row INTEGER, synced_at REAL, last_date TEXT
+            );
+        ''')
+        # 舊版的 hist_sync 沒有 last_date (第一次同步時會整份重讀)
+        columns = {r[1] for r in self._conn.execute("PRAGMA table_info(hist_sync)")}
+        if 'last_date' not in columns: self._conn.execute("ALTER TABLE hist_sync ADD COLUMN last_date TEXT")
+        self._conn.commit()
+
+    def sync(self, user, read_rows, max_age=HIST_SYNC_MAX_AGE):
+        """
+        補抓上次同步之後的列 (最後一列會重讀，因為當天的紀錄可能被更新)。
+        read_rows(start_row) 回傳第 start_row 列起的 [Date, NetAsset, Principal]。
+        記住的最後一列日期對不上時 (其他程序補齊歷史、整批改寫過工作表)，列號已經移動，整份重讀。
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT last_row, synced_at, last_date FROM hist_sync WHERE user = ?", (user,)).fetchone()
+        last_row, synced_at, last_date = row if row else (1, 0.0, None)
+        if time.time() - synced_at < max_age: return 0
+
+        start = max(last_row, 2)
+        rows = [r for r in read_rows(start) if r and r[0]]
+        full = start > 2 and (not rows or rows[0][0] != last_date)
+        if full:
+            start = 2
+            rows = [r for r in read_rows(start) if r and r[0]]
+        records = []
+        for r in rows:
+            net = pd.to_numeric(r[1] if len(r) > 1 else None, errors='coerce')
+            principal = pd.to_numeric(r[2] if len(r) > 2 else None, errors='coerce')
+            records.append((user, r[0], 0.0 if pd.isna(net) else float(net), 0.0 if pd.isna(principal) else float(principal)))
+
+        with self._lock:
+            # 整份重讀時工作表上已不存在的日期一併清掉 (dirty 的紀錄保留)
+            if full: self._conn.execute("DELETE FROM hist WHERE user = ? AND dirty = 0", (user,))
+            # 本機尚未寫回工作表的紀錄 (dirty) 不被舊值覆蓋
+            self._conn.executemany('''
+                INSERT INTO hist (user, date, net, principal, dirty) VALUES (?, ?, ?, ?, 0)
+                ON CONFLICT (user, date) DO UPDATE SET net = excluded.net, principal = excluded.principal, dirty = 0
+                WHERE hist.dirty = 0 OR (hist.net = excluded.net AND hist.principal = excluded.principal)
+            ''', records)
+            new_last = start + len(rows) - 1 if rows else (1 if full else last_row)
+            new_date = rows[-1][0] if rows else (None if full else last_date)
+            self._conn.execute('''
+                INSERT INTO hist_sync (user, last_row, synced_at, last_date) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user) DO UPDATE SET last_row = excluded.last_row, synced_at = excluded.synced_at,
+                                                 last_date = excluded.last_date
+            ''', (user, new_last, time.time(), new_date))
+            self._conn.commit()
+        return len(records)
+
+    def upsert(self, user, date, net_asset, principal):
+        """本機直接寫入當天紀錄 (工作表由 write-behind 稍後寫入)"""
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO hist (user, date, net, principal, dirty) VALUES (?, ?, ?, ?, 1)
+                ON CONFLICT (user, date) DO UPDATE SET net = excluded.net, principal = excluded.principal, dirty = 1
+            ''', (user, date, float(net_asset), float(principal)))
+            self._conn.commit()
+
+    def reset(self, user):
+        with self._lock:
+            self._conn.execute("DELETE FROM hist WHERE user = ?", (user,))
+            self._conn.execute("DELETE FROM hist_sync WHERE user = ?", (user,))
+            self._conn.commit()
+
+    def frame(self, user):
+        """回傳依日期排序的 DataFrame：Date, NetAsset, Principal, Profit_Val, ROI_Pct"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT date, net, principal FROM hist WHERE user = ? ORDER BY date", (user,)
+            ).fetchall()
+        dfh = pd.DataFrame(rows, columns=['Date', 'NetAsset', 'Principal'])
+        dfh['Date'] = pd.to_datetime(dfh['Date'], errors='coerce')
+        dfh = dfh.dropna(subset=['Date']).sort_values('Date').reset_index(drop=True)
+
+        # 舊資料沒有本金欄位時以淨資產代替
+        net = dfh['NetAsset'].to_numpy(dtype=float)
+        principal = dfh['Principal'].fillna(0).to_numpy(dtype=float)
+        principal = np.where(principal == 0, net, principal)
+        dfh['Principal'] = principal
+        dfh['Profit_Val'] = net - principal
+        with np.errstate(divide='ignore', invalid='ignore'):
+            dfh['ROI_Pct'] = np.where(principal != 0, dfh['Profit_Val'].to_numpy() / principal * 100, 0.0)
+        return dfh
@@ -0,0 +1,42 @@
+import time
+import importlib
+import threading
+
+from metrics import METRICS
+
+# --- 延遲載入 ---
+# yfinance、gspread、oauth2client、plotly 等較重的套件等到第一次使用才 import，
+# 登入頁只需要 streamlit。各模組實際載入耗時記錄在 IMPORT_TIMES 與 METRICS (import.*)。
+
+IMPORT_TIMES = {}  # 模組名稱 -> 載入秒數
+_import_lock = threading.Lock()
+
+def timed_import(name):
+    """import 並記錄第一次載入的耗時"""
+    with _import_lock:
+        t0 = time.perf_counter()
+        module = importlib.import_module(name)
+        if name not in IMPORT_TIMES:
+            IMPORT_TIMES[name] = time.perf_counter() - t0
+            METRICS.record(f"import.{name}", IMPORT_TIMES[name])
+    return module
+
+class LazyModule:
+    """第一次存取屬性時才載入模組"""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None: self._module = timed_import(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f"<lazy module '{self._name}' ({state})>"
+
+def lazy_import(name):
+    return LazyModule(name)
@@ -0,0 +1,168 @@
+# --- 持股批次帳本 ---
+# 每檔持股一個 Position，記錄每一批買進 (lot) 與股數/成本/負債的累計值，
+# 買進、賣出只更新累計值，不必每次重新加總所有 lots。
+# 先進先出的賣出從 head 指標往後扣，已賣完的批次累積到一定數量才一次清掉。
+
+# 成本計算方式
+COST_METHODS = {'FIFO': '先進先出', 'AVG': '平均成本', 'SPECIFIC': '指定批次'}
+DEFAULT_COST_METHOD = 'FIFO'
+
+# 已賣完的批次超過這個數量且佔一半以上時才整理 list
+COMPACT_MIN_DEAD = 32
+
+class Lot:
+    __slots__ = ('id', 'd', 'p', 's', 'type', 'debt')
+
+    def __init__(self, id, d, p, s, type='現股', debt=0.0):
+        self.id = id
+        self.d = d
+        self.p = p
+        self.s = s
+        self.type = type
+        self.debt = debt
+
+    def to_row(self):
+        return [self.id, self.d, self.p, self.s, self.type, self.debt]
+
+class Position:
+    """
+    單一持股：lots 依買進順序排列，shares / cost_total / debt 為累計值 (原幣計價，負債為台幣)。
+    平均成本法賣出時依平均成本扣除成本，批次本身仍保留原始買價。
+    """
+    def __init__(self, code, name=None):
+        self.code = code
+        self.name = name or code
+        self._lots = []
+        self._head = 0  # 第一個尚未賣完的批次
+        self._dead = 0  # head 之後已賣完的批次數 (指定批次賣出造成)
+        self._next_id = 0
+        self.shares = 0
+        self.cost_total = 0.0
+        self.debt = 0.0
+
+    @property
+    def avg_cost(self):
+        return self.cost_total / self.shares if self.shares else 0.0
+
+    @property
+    def lot_count(self):
+        return len(self._lots) - self._head - self._dead
+
+    def iter_lots(self):
+        for lot in self._lots[self._head:]:
+            if lot.s > 0: yield lot
+
+    @property
+    def lots(self):
+        return list(self.iter_lots())
+
+    def _append(self, lot):
+        self._lots.append(lot)
+        self._next_id = max(self._next_id, lot.id + 1)
+        self.shares += lot.s
+        self.cost_total += lot.s * lot.p
+        self.debt += lot.debt
+
+    def buy(self, d, price, shares, trade_type='現股', debt=0.0):
+        lot = Lot(self._next_id, d, price, shares, trade_type, debt)
+        self._append(lot)
+        return lot
+
+    def _take(self, lot, qty):
+        """從單一批次扣除股數，回傳 (扣除股數, 原幣成本, 償還負債)"""
+        take = min(lot.s, qty)
+        debt_part = lot.debt * (take / lot.s) if lot.s > 0 else 0
+        lot.s -= take
+        lot.debt -= debt_part
+        return take, take * lot.p, debt_part
+
+    def sell(self, qty, method=DEFAULT_COST_METHOD, lot_ids=None):
+        """
+        賣出 qty 股，回傳 (原幣成本, 償還負債)。
+        method: FIFO / AVG / SPECIFIC；SPECIFIC 依 lot_ids 的順序扣除，不足的部分再以先進先出補足。
+        """
+        if qty <= 0: return 0.0, 0.0
+        if qty > self.shares: raise ValueError(f"{self.code} 持有 {self.shares} 股，無法賣出 {qty} 股")
+        if method not in COST_METHODS: raise ValueError(f"未知的成本計算方式: {method}")
+        avg = self.avg_cost
+        remain = qty
+        cost = 0.0
+        debt = 0.0
+
+        if method == 'SPECIFIC' and lot_ids:
+            by_id = {lot.id: lot for lot in self.iter_lots()}
+            for lot_id in lot_ids:
+                if remain <= 0: break
+                lot = by_id.get(lot_id)
+                if lot is None: continue
+                take, c, dp = self._take(lot, remain)
+                remain -= take
+                cost += c
+                debt += dp
+                if lot.s == 0: self._dead += 1
+            self._skip_dead()
+
+        while remain > 0 and self._head < len(self._lots):
+            lot = self._lots[self._head]
+            take, c, dp = self._take(lot, remain)
+            remain -= take
+            cost += c
+            debt += dp
+            if lot.s == 0:
+                self._head += 1
+                self._skip_dead()
+
+        if method == 'AVG': cost = qty * avg
+        self.shares -= qty
+        if self.shares <= 0:
+            self.shares = 0
+            self.cost_total = 0.0
+            self.debt = 0.0
+        else:
+            self.cost_total -= cost
+            self.debt -= debt
+        self._compact()
+        return cost, debt
+
+    def _skip_dead(self):
+        while self._head < len(self._lots) and self._lots[self._head].s == 0:
+            self._head += 1
+            self._dead -= 1
+
+    def _compact(self):
+        dead = self._head + self._dead
+        if dead >= COMPACT_MIN_DEAD and dead * 2 >= len(self._lots):
+            self._lots = [lot for lot in self._lots[self._head:] if lot.s > 0]
+            self._head = 0
+            self._dead = 0
+
+    def to_dict(self):
+        """精簡格式：lots 以 [id, d, p, s, type, debt] 陣列儲存"""
+        return {'n': self.name, 'c': self.avg_cost, 'lots': [lot.to_row() for lot in self.iter_lots()]}
+
+    @classmethod
+    def from_dict(cls, code, info):
+        """讀取精簡格式或舊版格式 (lots 為 dict，或完全沒有 lots)"""
+        pos = cls(code, info.get('n', code))
+        lots = info.get('lots')
+        if lots is None:
+            lots = [{'d': '初始', 'p': info.get('c', 0), 's': info.get('s', 0), 'type': '現股', 'debt': 0}]
+        for i, lot in enumerate(lots):
+            if isinstance(lot, dict):
+                lot = Lot(lot.get('id', i), lot.get('d', ''), lot.get('p', 0), lot.get('s', 0), lot.get('type', '現股'), lot.get('debt', 0))
+            else:
+                lot = Lot(*lot)
+            if lot.s > 0: pos._append(lot)
+        # 平均成本法賣出後，平均成本與批次買價加權平均不同，以存檔的 c 為準
+        if 'c' in info and pos.shares:
+            pos.cost_total = float(info['c']) * pos.shares
+        return pos
+
+    def __repr__(self):
+        return f"Position({self.code!r}, shares={self.shares}, avg_cost={self.avg_cost:.4f}, lots={self.lot_count})"
+
+def to_positions(holdings):
+    """data['h'] 內仍是 dict 的持股轉成 Position"""
+    for code, info in holdings.items():
+        if not isinstance(info, Position): holdings[code] = Position.from_dict(code, info)
+    return holdings
@@ -0,0 +1,90 @@
+import numpy as np
+import pandas as pd
+
+from fx import rate_array
+from valuation import quote_arrays
+
+# --- 融資維持率 ---
+# 維持率 = 融資股票市值 / 融資金額；整戶維持率低於 130% 會被追繳。
+# 融資批次攤平成陣列 (代碼索引、股數、負債、買價) 只在持股變動時建一次，放在 data['_margin']，
+# 每次報價更新只做一次陣列運算，盤中自動更新每一輪都可以重算。
+
+# 追繳線與提醒線
+MARGIN_CALL_RATIO = 1.30
+MARGIN_WARN_RATIO = 1.50
+
+class MarginBook:
+    """所有融資批次 (負債 > 0) 的欄位陣列"""
+    def __init__(self, holdings, key=None):
+        self.key = key
+        rows = [(code, lot.s, lot.debt, lot.p) for code, pos in holdings.items() if pos.debt > 0
+                for lot in pos.iter_lots() if lot.debt > 0]
+        self.codes = sorted({r[0] for r in rows})
+        index = {c: i for i, c in enumerate(self.codes)}
+        n = len(rows)
+        self.lot_code = np.fromiter((index[r[0]] for r in rows), dtype=np.int32, count=n)
+        self.lot_shares = np.fromiter((r[1] for r in rows), dtype=float, count=n)
+        self.lot_debt = np.fromiter((r[2] for r in rows), dtype=float, count=n)
+        self.lot_cost = np.fromiter((r[3] for r in rows), dtype=float, count=n)
+
+    def __len__(self):
+        return len(self.lot_code)
+
+    def status(self, quotes, fx_rates, call_ratio=MARGIN_CALL_RATIO):
+        """
+        以目前報價計算維持率。回傳 dict：
+        ratio / value / debt (整戶)、drop (整戶再跌多少會追繳)、symbols (每檔一列的 DataFrame)。
+        抓不到報價的批次以買價計算，與估值相同。
+        """
+        n = len(self.codes)
+        price = quote_arrays(self.codes, quotes)[0]
+        rate = rate_array(self.codes, fx_rates)
+        lot_price = price[self.lot_code]
+        lot_price = np.where(lot_price > 0, lot_price, self.lot_cost)
+        value = np.bincount(self.lot_code, self.lot_shares * lot_price * rate[self.lot_code], minlength=n)
+        debt = np.bincount(self.lot_code, self.lot_debt, minlength=n)
+        shares = np.bincount(self.lot_code, self.lot_shares, minlength=n)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(debt > 0, value / debt, np.inf)
+            cur_price = np.where(price > 0, price, value / (shares * rate))
+            # 單檔跌到 call_price 時該檔維持率等於追繳線
+            call_price = call_ratio * debt / (shares * rate)
+            drop = np.where(cur_price > 0, 1 - call_price / cur_price, 0.0)
+
+        total_value, total_debt = float(value.sum()), float(debt.sum())
+        account_ratio = total_value / total_debt if total_debt > 0 else np.inf
+        return {
+            'ratio': account_ratio,
+            'value': total_value,
+            'debt': total_debt,
+            # 所有融資股票同時下跌時，跌幅超過 drop 即低於追繳線
+            'drop': 1 - call_ratio / account_ratio if total_debt > 0 else 1.0,
+            'symbols': pd.DataFrame({
+                '股票代碼': self.codes, '融資股數': shares.astype(int), '融資市值': value, '融資金額': debt,
+                '維持率': ratio, '現價': cur_price, '追繳價': call_price, '距追繳跌幅': drop,
+            }).sort_values('維持率').reset_index(drop=True),
+        }
+
+def margin_book(data):
+    """取得 (持股有變動時重建) data 的融資批次陣列"""
+    holdings = data.get('h', {})
+    key = (data.get('_seq', 0), id(holdings), len(holdings))
+    book = data.get('_margin')
+    if book is None or book.key != key:
+        book = data['_margin'] = MarginBook(holdings, key)
+    return book
+
+def margin_alerts(status, warn_ratio=MARGIN_WARN_RATIO, call_ratio=MARGIN_CALL_RATIO):
+    """回傳 [(等級, 訊息)]，等級為 'error' (低於追繳線) 或 'warning' (低於提醒線)"""
+    alerts = []
+    if status['debt'] <= 0: return alerts
+    if status['ratio'] < call_ratio:
+        alerts.append(('error', f"整戶維持率 {status['ratio']:.0%} 已低於追繳線 {call_ratio:.0%}，請儘速補繳或減碼"))
+    elif status['ratio'] < warn_ratio:
+        alerts.append(('warning', f"整戶維持率 {status['ratio']:.0%}，再跌 {status['drop']:.1%} 將低於追繳線 {call_ratio:.0%}"))
+    # 追繳看整戶，單檔偏低只提醒
+    low = status['symbols'][status['symbols']['維持率'] < warn_ratio]
+    for code, ratio, drop in low[['股票代碼', '維持率', '距追繳跌幅']].itertuples(index=False):
+        alerts.append(('warning', f"{code} 維持率 {ratio:.0%}" + (f"，再跌 {drop:.1%} 觸及追繳價" if drop > 0 else "，已低於追繳價")))
+    return alerts
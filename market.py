@@ -0,0 +1,448 @@
+import time
+import threading
+import requests
+from collections import namedtuple, OrderedDict
+from types import MappingProxyType
+import pandas as pd
+import urllib3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, time as dtime
+from zoneinfo import ZoneInfo
+from metrics import METRICS
+from lazy import lazy_import
+from fx import FxTable, currency_of, fx_ticker, foreign_currencies
+
+yf = lazy_import('yfinance')
+
+# 忽略 SSL 警告
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+# 證交所 ex_ch 每次最多帶幾檔，避免網址過長導致 msgArray 回傳不完整
+TWSE_CHUNK_SIZE = 50
+TWSE_TIMEOUT = 10
+
+# 報價快取存活秒數：盤中短、收盤後長
+QUOTE_TTL_OPEN = 10
+QUOTE_TTL_CLOSED = 600
+QUOTE_CACHE_SIZE = 5000
+
+# 背景更新間隔 (秒)，盤中較頻繁
+REFRESH_INTERVAL_OPEN = 15
+REFRESH_INTERVAL_CLOSED = 300
+# 使用者超過這段時間沒有互動就不再幫他更新
+WATCH_EXPIRE = 1800
+# 斷路器：連續失敗幾次後暫停該來源，暫停時間指數成長
+BREAKER_THRESHOLD = 3
+BREAKER_BASE_DELAY = 30
+BREAKER_MAX_DELAY = 900
+
+# 各市場交易時段 (當地時間)
+MARKET_HOURS = {
+    'TW': (ZoneInfo('Asia/Taipei'), dtime(9, 0), dtime(13, 30)),
+    'US': (ZoneInfo('America/New_York'), dtime(9, 30), dtime(16, 0)),
+    'HK': (ZoneInfo('Asia/Hong_Kong'), dtime(9, 30), dtime(16, 0)),
+    'JP': (ZoneInfo('Asia/Tokyo'), dtime(9, 0), dtime(15, 30)),
+    'EU': (ZoneInfo('Europe/Berlin'), dtime(9, 0), dtime(17, 30)),
+}
+# 計價幣別 -> 市場
+CURRENCY_MARKET = {'TWD': 'TW', 'USD': 'US', 'HKD': 'HK', 'JPY': 'JP', 'EUR': 'EU'}
+
+TWSE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept": "application/json, text/javascript, */*; q=0.01",
+    "Referer": "https://mis.twse.com.tw/stock/fibest.jsp?stock=2330",
+    "Connection": "keep-alive"
+}
+
+def is_tw_code(code):
+    return '.TW' in code or '.TWO' in code
+
+def empty_quote():
+    return {'p': 0, 'chg': 0, 'chg_pct': 0}
+
+def to_twse_query(code):
+    c_upper = code.upper()
+    if '.TWO' in c_upper:
+        # 上櫃
+        return f"otc_{c_upper.replace('.TWO', '')}.tw"
+    if '.TW' in c_upper:
+        # 上市
+        return f"tse_{c_upper.replace('.TW', '')}.tw"
+    return None
+
+def parse_twse_item(item):
+    exchange = item.get('ex', '')
+    code_raw = item.get('c', '')
+    if exchange == 'tse':
+        original_code = f"{code_raw}.TW"
+    elif exchange == 'otc':
+        original_code = f"{code_raw}.TWO"
+    else:
+        original_code = code_raw
+
+    try:
+        price_str = item.get('z', '-')
+        if price_str == '-':
+            bid = item.get('b', '').split('_')[0]
+            ask = item.get('a', '').split('_')[0]
+            if bid and bid != '-': price_str = bid
+            elif ask and ask != '-': price_str = ask
+
+        price = float(price_str) if price_str and price_str != '-' else 0.0
+        prev_close = float(item.get('y', 0.0))
+
+        if price > 0 and prev_close > 0:
+            change_val = price - prev_close
+            change_pct = (change_val / prev_close * 100)
+        else:
+            change_val = 0; change_pct = 0
+
+        return original_code, {'p': price, 'chg': change_val, 'chg_pct': change_pct, 'realtime': True}
+    except:
+        return original_code, {'p': 0, 'chg': 0, 'chg_pct': 0, 'realtime': False}
+
+def fetch_twse_chunk(query_parts):
+    """
+    抓取一批證交所即時報價，加入 User-Agent 偽裝成瀏覽器，解決 Streamlit Cloud 被擋的問題。
+    連線失敗時丟出例外，由呼叫端決定如何顯示。
+    """
+    query_str = "|".join(query_parts)
+    timestamp = int(time.time() * 1000)
+    url = f"https://mis.twse.com.tw/stock/api/getStockInfo.jsp?ex_ch={query_str}&json=1&delay=0&_={timestamp}"
+
+    session = requests.Session()
+    with METRICS.span('twse.fetch'):
+        response = session.get(url, headers=TWSE_HEADERS, verify=False, timeout=TWSE_TIMEOUT)
+    METRICS.observe_size('twse', len(response.content))
+    if response.status_code != 200:
+        raise RuntimeError(f"證交所連線被拒 (Code {response.status_code})")
+
+    results = {}
+    for item in response.json().get('msgArray', []):
+        code, quote = parse_twse_item(item)
+        results[code] = quote
+    return results
+
+def chunk_twse_queries(codes, chunk_size=TWSE_CHUNK_SIZE):
+    query_parts = [q for q in (to_twse_query(c) for c in codes) if q]
+    return [query_parts[i:i + chunk_size] for i in range(0, len(query_parts), chunk_size)]
+
+def parse_yf_close(hist):
+    if 'Close' not in hist.columns: return None
+    clean = hist['Close'].dropna()
+    if isinstance(clean, pd.DataFrame): clean = clean.iloc[:, 0].dropna()
+    if clean.empty: return None
+    price = float(clean.iloc[-1])
+    prev_close = float(clean.iloc[-2]) if len(clean) >= 2 else price
+    change_val = price - prev_close
+    change_pct = (change_val / prev_close * 100) if prev_close else 0
+    return {'p': price, 'chg': change_val, 'chg_pct': change_pct}
+
+def fetch_yf_quotes(codes, currencies=()):
+    """
+    海外股票報價與所需匯率合併成同一次 yf.download。
+    (yfinance 的 download 內部共用全域暫存，不適合多執行緒同時呼叫)
+    回傳 (報價 dict, {幣別: 匯率})
+    """
+    fx_tickers = {fx_ticker(cur): cur for cur in currencies}
+    tickers = list(codes) + list(fx_tickers)
+    if not tickers: return {}, {}
+
+    results = {}
+    rates = {}
+    with METRICS.span('yf.download'):
+        yf_data = yf.download(tickers, period="5d", group_by='ticker', progress=False, auto_adjust=False)
+    METRICS.observe_size('yf', int(yf_data.memory_usage(deep=False).sum()))
+    for code in tickers:
+        try:
+            hist = yf_data if len(tickers) == 1 else yf_data[code]
+            quote = parse_yf_close(hist)
+        except:
+            quote = None
+        if code in fx_tickers:
+            if quote and quote['p'] > 0: rates[fx_tickers[code]] = quote['p']
+        else:
+            results[code] = quote or empty_quote()
+    return results, rates
+
+def fetch_fx_rates(currencies):
+    """只抓匯率 (FxTable 單獨補抓時使用)"""
+    return fetch_yf_quotes([], currencies)[1]
+
+def fetch_quotes_concurrent(codes, currencies=(), max_workers=8):
+    """
+    平行抓取報價：台股分批與海外股票/匯率同時送出，總耗時約等於最慢的來源。
+    回傳 (報價 dict, {幣別: 匯率}, [(來源, 錯誤訊息)])
+    """
+    codes = list(codes)
+    tw_query = [c for c in codes if is_tw_code(c)]
+    other_query = [c for c in codes if not is_tw_code(c)]
+    chunks = chunk_twse_queries(tw_query)
+
+    results = {}
+    errors = []
+    rates = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks) + 1))) as pool:
+        yf_future = pool.submit(fetch_yf_quotes, other_query, currencies) if (other_query or currencies) else None
+        tw_futures = [pool.submit(fetch_twse_chunk, chunk) for chunk in chunks]
+
+        for f in tw_futures:
+            try:
+                results.update(f.result())
+            except Exception as e:
+                errors.append(('TWSE', str(e)))
+
+        if yf_future:
+            try:
+                yf_results, rates = yf_future.result()
+                results.update(yf_results)
+            except Exception as e:
+                errors.append(('YF', f"yfinance 失敗: {e}"))
+
+    for source, _ in errors: METRICS.incr(f"upstream.{source}.errors")
+
+    # 防呆
+    for c in codes:
+        if c not in results:
+            results[c] = empty_quote()
+
+    return results, rates, errors
+
+# --- 報價快取 (整個伺服器程序共用) ---
+def market_of(code):
+    return CURRENCY_MARKET.get(currency_of(code), 'US')
+
+def source_of(code):
+    return 'TWSE' if is_tw_code(code) else 'YF'
+
+def is_market_open(market, now=None):
+    tz, open_t, close_t = MARKET_HOURS[market]
+    local = (now or datetime.now(tz)).astimezone(tz)
+    return local.weekday() < 5 and open_t <= local.time() <= close_t
+
+def quote_ttl(code, now=None):
+    return QUOTE_TTL_OPEN if is_market_open(market_of(code), now) else QUOTE_TTL_CLOSED
+
+class QuoteCache:
+    """
+    以單一代碼為單位的報價快取，LRU 淘汰。
+    多位使用者持有同一檔股票時共用同一筆報價，更新時只抓缺少或過期的代碼；
+    匯率放在 self.fx，過期的幣別與報價一起下載。
+    """
+    def __init__(self, max_size=QUOTE_CACHE_SIZE, fetcher=None, fx=None):
+        self.max_size = max_size
+        self.fetcher = fetcher or fetch_quotes_concurrent
+        self.fx = fx or FxTable(fetch_fx_rates)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # code -> (quote, fetched_at)
+        self.hits = 0
+        self.misses = 0
+
+    def _get_fresh(self, code, now_ts):
+        entry = self._entries.get(code)
+        if entry is None: return None
+        quote, fetched_at = entry
+        if now_ts - fetched_at > quote_ttl(code): return None
+        self._entries.move_to_end(code)
+        return quote
+
+    def _put(self, code, quote, now_ts):
+        self._entries[code] = (dict(quote), now_ts)
+        self._entries.move_to_end(code)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def lookup(self, codes):
+        """回傳 (新鮮報價 dict, 需重抓的代碼 list)"""
+        now_ts = time.time()
+        found = {}
+        missing = []
+        with self._lock:
+            for c in codes:
+                quote = self._get_fresh(c, now_ts)
+                if quote is None: missing.append(c)
+                else: found[c] = dict(quote)
+            self.hits += len(found)
+            self.misses += len(missing)
+        METRICS.incr('quote_cache.hits', len(found))
+        METRICS.incr('quote_cache.misses', len(missing))
+        return found, missing
+
+    def store(self, quotes):
+        now_ts = time.time()
+        with self._lock:
+            for c, quote in quotes.items():
+                # 抓不到的報價不快取，下次更新時再試
+                if quote.get('p', 0) > 0: self._put(c, quote, now_ts)
+
+    def get_quotes(self, codes, skip_sources=()):
+        """
+        取得報價與匯率，只向上游抓取缺少或過期的部分。
+        skip_sources 內的來源 (TWSE / YF) 不會連線，只回傳快取中仍有效的報價。
+        回傳 (報價 dict, {幣別: 匯率}, [(來源, 錯誤訊息)])
+        """
+        codes = list(dict.fromkeys(codes))
+        currencies = foreign_currencies(codes)
+        found, missing = self.lookup(codes)
+        stale_fx = self.fx.stale(currencies) if 'YF' not in skip_sources else []
+        missing = [c for c in missing if source_of(c) not in skip_sources]
+
+        errors = []
+        if missing or stale_fx:
+            fetched, rates, errors = self.fetcher(missing, currencies=stale_fx)
+            # 有價格的報價記下取得時間 (之後從快取或沿用時都帶著這個時間)
+            fetched_at = time.time()
+            fetched = {c: {**q, 'ts': fetched_at} if q.get('p', 0) > 0 else dict(q) for c, q in fetched.items()}
+            self.store(fetched)
+            self.fx.update(rates)
+            found.update(fetched)
+
+        return found, self.fx.known(currencies), errors
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# --- 背景報價更新 ---
+# ts: 發佈時間 (判斷快照是否更新)；每筆報價的 'ts' 才是取得時間
+# errors: ((來源, 錯誤訊息, 受影響的代碼), ...)
+QuoteSnapshot = namedtuple('QuoteSnapshot', ['quotes', 'fx', 'ts', 'errors'])
+
+EMPTY_SNAPSHOT = QuoteSnapshot(MappingProxyType({}), MappingProxyType({}), 0.0, ())
+
+def error_codes(errors, found):
+    """
+    [(來源, 錯誤訊息)] -> ((來源, 錯誤訊息, 受影響的代碼), ...)：該來源這次沒抓到價格的代碼，
+    都有價格 (例如只有匯率失敗) 時為該來源所有的代碼。快照所有使用者共用，頁面只顯示與自己持股有關的錯誤。
+    """
+    out = []
+    for src, msg in errors:
+        codes = [c for c in found if source_of(c) == src]
+        failed = [c for c in codes if not found[c].get('p', 0) > 0]
+        out.append((src, msg, frozenset(failed or codes)))
+    return tuple(out)
+
+def snapshot_errors(snap, codes):
+    """快照中與 codes 有關的錯誤訊息"""
+    codes = set(codes)
+    return [msg for _, msg, affected in snap.errors if affected & codes]
+
+def quotes_time(snap, codes):
+    """codes 中最舊的報價取得時間 (來源中斷、沿用舊報價時不會變新)；都沒有價格時為 0"""
+    times = [snap.quotes[c]['ts'] for c in codes if 'ts' in snap.quotes.get(c, {})]
+    return min(times) if times else 0.0
+
+class CircuitBreaker:
+    """連續失敗達門檻後暫停呼叫該來源，暫停時間逐次加倍"""
+    def __init__(self, threshold=BREAKER_THRESHOLD, base_delay=BREAKER_BASE_DELAY, max_delay=BREAKER_MAX_DELAY):
+        self.threshold = threshold
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self, now_ts=None):
+        return (now_ts or time.time()) >= self.open_until
+
+    def record(self, ok, now_ts=None):
+        if ok:
+            self.failures = 0
+            self.open_until = 0.0
+            return
+        self.failures += 1
+        if self.failures >= self.threshold:
+            delay = min(self.base_delay * 2 ** (self.failures - self.threshold), self.max_delay)
+            self.open_until = (now_ts or time.time()) + delay
+
+class QuoteRefresher:
+    """
+    背景執行緒：定期更新所有線上使用者持股的聯集，並發佈不可變的報價快照。
+    頁面直接讀取最新快照，不必等待上游；來源失敗時沿用上一次的價格。
+    """
+    def __init__(self, cache, interval_open=REFRESH_INTERVAL_OPEN, interval_closed=REFRESH_INTERVAL_CLOSED):
+        self.cache = cache
+        self.interval_open = interval_open
+        self.interval_closed = interval_closed
+        self.breakers = {'TWSE': CircuitBreaker(), 'YF': CircuitBreaker()}
+        self.snapshot = EMPTY_SNAPSHOT
+        self._watch = {}  # user -> (codes, last_seen)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._thread = threading.Thread(target=self._run, name='quote-refresher', daemon=True)
+        self._thread.start()
+
+    def watch(self, user, codes):
+        codes = tuple(codes)
+        with self._lock:
+            prev = self._watch.get(user)
+            self._watch[user] = (codes, time.time())
+        if not prev or set(codes) - set(prev[0]): self._wake.set()
+
+    def unwatch(self, user):
+        with self._lock:
+            self._watch.pop(user, None)
+
+    def watched_codes(self):
+        now_ts = time.time()
+        with self._lock:
+            for user in [u for u, (_, seen) in self._watch.items() if now_ts - seen > WATCH_EXPIRE]:
+                del self._watch[user]
+            return sorted({c for codes, _ in self._watch.values() for c in codes})
+
+    def interval(self, now=None):
+        any_open = any(is_market_open(m, now) for m in MARKET_HOURS)
+        return self.interval_open if any_open else self.interval_closed
+
+    def refresh(self, codes=None):
+        """更新一次並發佈新快照 (背景執行緒與頁面同步補抓共用)"""
+        codes = self.watched_codes() if codes is None else list(codes)
+        now_ts = time.time()
+        skip = tuple(src for src, b in self.breakers.items() if not b.allow(now_ts))
+        attempted = {source_of(c) for c in codes} | ({'YF'} if foreign_currencies(codes) else set())
+        found, rates, errors = self.cache.get_quotes(codes, skip_sources=skip)
+
+        failed = {src for src, _ in errors}
+        for src in attempted - set(skip):
+            self.breakers[src].record(src not in failed)
+        return self._publish(found, rates, errors)
+
+    def _publish(self, found, rates, errors):
+        # 只保留仍有人追蹤的代碼 (加上這次抓的)，登出使用者的持股不會一直留在快照裡
+        keep = set(self.watched_codes()) | set(found)
+        with self._lock:
+            prev = self.snapshot
+            quotes = {c: q for c, q in prev.quotes.items() if c in keep}
+            for c, q in found.items():
+                if q.get('p', 0) > 0:
+                    quotes[c] = MappingProxyType(dict(q))
+                elif c in quotes:
+                    # 抓不到價格時沿用上一次的報價
+                    quotes[c] = MappingProxyType({**quotes[c], 'stale': True})
+                else:
+                    quotes[c] = MappingProxyType(dict(q))
+            fx = MappingProxyType({**prev.fx, **rates})
+            snap = QuoteSnapshot(MappingProxyType(quotes), fx, time.time(), error_codes(errors, found))
+            self.snapshot = snap
+        return snap
+
+    def get(self, codes):
+        """回傳涵蓋 codes 的快照；快照缺少部分代碼時立即同步補抓"""
+        snap = self.snapshot
+        if all(c in snap.quotes for c in codes) and all(cur in snap.fx for cur in foreign_currencies(codes)): return snap
+        return self.refresh(codes)
+
+    def _run(self):
+        while True:
+            try:
+                codes = self.watched_codes()
+                if codes: self.refresh(codes)
+            except Exception:
+                pass
+            self._wake.wait(self.interval())
+            self._wake.clear()
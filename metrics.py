@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import threading
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# 每個階段保留最近幾筆耗時
+SPAN_WINDOW = 200
+# Prometheus 文字檔最短重寫間隔 (秒)
+PROM_WRITE_INTERVAL = 10
+
+# --- 效能監控 ---
+# span 記錄各階段耗時，counter 記錄快取命中、上游錯誤與傳輸量。
+# 可選擇輸出成 JSON lines (每筆 span 一行) 或 Prometheus 文字格式 (textfile collector)。
+
+class Metrics:
+    def __init__(self, window=SPAN_WINDOW):
+        self._lock = threading.Lock()
+        self._spans = defaultdict(lambda: deque(maxlen=window))
+        self._span_totals = defaultdict(lambda: [0, 0.0])  # name -> [次數, 總秒數]
+        self._counters = defaultdict(float)
+        self.jsonl_path = None
+        self.prom_path = None
+        self._prom_written = 0.0
+
+    def configure(self, jsonl_path=None, prom_path=None):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+
+    @contextmanager
+    def span(self, name):
+        t0 = time.perf_counter()
+        ok = True
+        try:
+            yield
+        except Exception:
+            ok = False
+            self.incr(f"{name}.errors")
+            raise
+        finally:
+            self.record(name, time.perf_counter() - t0, ok)
+
+    def record(self, name, seconds, ok=True):
+        now_ts = time.time()
+        with self._lock:
+            self._spans[name].append((now_ts, seconds))
+            total = self._span_totals[name]
+            total[0] += 1
+            total[1] += seconds
+        if self.jsonl_path:
+            try:
+                with open(self.jsonl_path, 'a') as f:
+                    f.write(json.dumps({'ts': now_ts, 'span': name, 'ms': seconds * 1000, 'ok': ok}) + '\n')
+            except OSError: pass
+        if self.prom_path and now_ts - self._prom_written >= PROM_WRITE_INTERVAL:
+            self.write_prometheus(self.prom_path)
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def observe_size(self, name, nbytes):
+        self.incr(f"{name}.bytes", nbytes)
+        self.incr(f"{name}.payloads")
+
+    def stage_table(self):
+        """各階段最近耗時統計 (ms)，依最後一次發生時間排序"""
+        with self._lock:
+            spans = {k: list(v) for k, v in self._spans.items()}
+            totals = {k: tuple(v) for k, v in self._span_totals.items()}
+        rows = []
+        for name, samples in spans.items():
+            ms = sorted(s * 1000 for _, s in samples)
+            rows.append({
+                'stage': name, 'count': totals[name][0], 'last_ms': samples[-1][1] * 1000,
+                'p50_ms': percentile(ms, 50), 'p95_ms': percentile(ms, 95),
+                'max_ms': ms[-1], 'last_at': samples[-1][0]
+            })
+        return sorted(rows, key=lambda r: r['last_at'], reverse=True)
+
+    def counters(self):
+        with self._lock:
+            return dict(sorted(self._counters.items()))
+
+    def prometheus_text(self):
+        lines = ['# TYPE stock_app_span_seconds summary']
+        with self._lock:
+            totals = {k: tuple(v) for k, v in self._span_totals.items()}
+            counters = dict(self._counters)
+        for name, (count, total) in sorted(totals.items()):
+            lines.append(f'stock_app_span_seconds_count{{stage="{name}"}} {count}')
+            lines.append(f'stock_app_span_seconds_sum{{stage="{name}"}} {total:.6f}')
+        lines.append('# TYPE stock_app_events_total counter')
+        for name, value in sorted(counters.items()):
+            lines.append(f'stock_app_events_total{{name="{name}"}} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path):
+        self._prom_written = time.time()
+        try:
+            with open(path + '.tmp', 'w') as f: f.write(self.prometheus_text())
+            os.replace(path + '.tmp', path)
+        except OSError: pass
+
+    def reset(self):
+        with self._lock:
+            self._spans.clear()
+            self._span_totals.clear()
+            self._counters.clear()
+
+def percentile(sorted_values, q):
+    # 登入頁也會載入本模組，不使用 numpy 以免拖慢冷啟動
+    idx = min(len(sorted_values) - 1, max(0, int(round(q / 100 * (len(sorted_values) - 1)))))
+    return sorted_values[idx]
+
+# 整個程序共用
+METRICS = Metrics()
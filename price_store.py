@@ -0,0 +1,129 @@
+import os
+import time
+import threading
+import pandas as pd
+from datetime import datetime, timedelta
+from lazy import lazy_import
+
+yf = lazy_import('yfinance')
+
+# 同一檔股票至少間隔多久才再向 yfinance 補抓 (秒)
+PRICE_REFRESH_INTERVAL = 3600
+# 沒有任何資料時預設抓多久以前
+DEFAULT_START = '2015-01-01'
+
+# --- 本機日線資料庫 ---
+# 每檔一個 Parquet 檔，只下載最後一根 K 棒之後的資料，
+# 基準指數與持股的歷史價格都由這裡讀取。
+
+class PriceStore:
+    def __init__(self, root, downloader=None):
+        self.root = root
+        self.downloader = downloader or download_closes
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._frames = {}  # symbol -> Series (記憶體快取)
+        self._checked = {}  # symbol -> 上次補抓時間
+        self._covered = {}  # symbol -> 已確認抓過的最早日期 (上市較晚的股票不必每次重抓)
+        self._failed = {}   # symbol -> 上次從頭下載卻沒有資料的時間
+
+    def _path(self, symbol):
+        return os.path.join(self.root, f"{symbol.replace('/', '_')}.parquet")
+
+    def load(self, symbol):
+        """讀取本機收盤價 (index 為日期)"""
+        with self._lock:
+            if symbol in self._frames: return self._frames[symbol]
+        path = self._path(symbol)
+        series = empty_series()
+        if os.path.exists(path):
+            try: series = pd.read_parquet(path)['Close']
+            except Exception: series = empty_series()
+        series.name = symbol
+        with self._lock:
+            self._frames[symbol] = series
+            self._checked.setdefault(symbol, os.path.getmtime(path) if os.path.exists(path) else 0.0)
+        return series
+
+    def _save(self, symbol, series):
+        series = series[~series.index.duplicated(keep='last')].sort_index()
+        series.name = symbol
+        series.to_frame('Close').to_parquet(self._path(symbol))
+        with self._lock:
+            self._frames[symbol] = series
+            self._checked[symbol] = time.time()
+
+    def update(self, symbols, start=DEFAULT_START, force=False):
+        """
+        補抓缺少的日線：已有資料的只抓最後一根 K 棒之後 (含最後一根，盤中可能尚未收盤)。
+        起始日相同的代碼合併成一次 yf.download。
+        """
+        start = pd.Timestamp(start).normalize()
+        groups = {}
+        now_ts = time.time()
+        for symbol in dict.fromkeys(symbols):
+            # 上次下載失敗或沒有資料的代碼，過了更新間隔才重試
+            if not force and now_ts - self._failed.get(symbol, float('-inf')) < PRICE_REFRESH_INTERVAL: continue
+            series = self.load(symbol)
+            first = self._covered.get(symbol, None if series.empty else series.index[0])
+            if first is None or first > start:
+                fetch_from = start
+            else:
+                if not force and now_ts - self._checked.get(symbol, 0.0) < PRICE_REFRESH_INTERVAL: continue
+                fetch_from = series.index[-1]
+            groups.setdefault(fetch_from, []).append(symbol)
+
+        for fetch_from, group in groups.items():
+            try:
+                fresh = self.downloader(group, fetch_from)
+            except Exception:
+                fresh = {}
+            for symbol in group:
+                new = fresh.get(symbol)
+                if new is None or new.empty:
+                    with self._lock:
+                        self._checked[symbol] = time.time()
+                        # 已有資料時只是還沒有新的 K 棒；沒有資料才算失敗
+                        if fetch_from == start: self._failed[symbol] = time.time()
+                    continue
+                old = self.load(symbol)
+                self._save(symbol, pd.concat([old[old.index < new.index[0]], new]))
+                with self._lock:
+                    self._failed.pop(symbol, None)
+                    # 上市較晚的股票：確認從 start 起已抓過，不必每次重抓
+                    if fetch_from == start: self._covered[symbol] = min(start, self._covered.get(symbol, start))
+
+    def closes(self, symbols, start, end=None, update=True):
+        """回傳日期 x 代碼的收盤價表 (需要時先補抓)"""
+        if update: self.update(symbols, start)
+        start = pd.Timestamp(start)
+        frames = {}
+        for symbol in symbols:
+            series = self.load(symbol)
+            series = series[series.index >= start]
+            if end is not None: series = series[series.index <= pd.Timestamp(end)]
+            frames[symbol] = series
+        if not frames: return pd.DataFrame()
+        return pd.DataFrame(frames).sort_index()
+
+def empty_series():
+    return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+
+def download_closes(symbols, start):
+    """向 yfinance 下載收盤價，回傳 {代碼: Series}"""
+    start_str = pd.Timestamp(start).strftime('%Y-%m-%d')
+    end_str = (datetime.now() + timedelta(days=1)).strftime('%Y-%m-%d')
+    df = yf.download(list(symbols), start=start_str, end=end_str, group_by='ticker', progress=False, auto_adjust=False)
+    results = {}
+    for symbol in symbols:
+        try:
+            sub_df = df if len(symbols) == 1 else df[symbol]
+            if 'Close' not in sub_df.columns: continue
+            series = sub_df['Close']
+            if isinstance(series, pd.DataFrame): series = series.iloc[:, 0]
+            series = series.dropna().astype(float)
+            series.index = pd.DatetimeIndex(series.index).tz_localize(None).normalize()
+            results[symbol] = series
+        except Exception:
+            continue
+    return results
@@ -0,0 +1,87 @@
+import pandas as pd
+
+# --- 已實現損益索引 ---
+# 累計總額與「依股票 / 年度 / 月份」的小計，賣出時只加上新的一筆，
+# 不必每次重新掃描整個 history。索引放在 data['_realized']，不寫入快照。
+
+BREAKDOWNS = {'symbol': '依股票', 'year': '依年度', 'month': '依月份'}
+
+class Totals:
+    __slots__ = ('count', 'wins', 'qty', 'cost', 'revenue', 'profit')
+
+    def __init__(self):
+        self.count = 0
+        self.wins = 0
+        self.qty = 0
+        self.cost = 0.0
+        self.revenue = 0.0
+        self.profit = 0.0
+
+    def add(self, rec):
+        profit = rec.get('profit', 0) or 0
+        self.count += 1
+        self.wins += profit > 0
+        self.qty += rec.get('qty', 0) or 0
+        self.cost += rec.get('buy_cost', 0) or 0
+        self.revenue += rec.get('sell_rev', 0) or 0
+        self.profit += profit
+
+    @property
+    def roi(self):
+        return self.profit / self.cost if self.cost else 0.0
+
+class RealizedIndex:
+    def __init__(self):
+        self.total = Totals()
+        self.by_symbol = {}
+        self.by_year = {}
+        self.by_month = {}
+        self.names = {}
+        self.size = 0  # 已計入的 history 筆數
+
+    @property
+    def total_profit(self):
+        return self.total.profit
+
+    def add(self, rec):
+        self.total.add(rec)
+        code = rec.get('code', '')
+        self.names[code] = rec.get('name') or code
+        d = str(rec.get('d', ''))
+        for table, key in ((self.by_symbol, code), (self.by_year, d[:4]), (self.by_month, d[:7])):
+            if key not in table: table[key] = Totals()
+            table[key].add(rec)
+        self.size += 1
+
+    def sync(self, history):
+        """補上 history 中尚未計入的紀錄 (只會是最後面新增的幾筆)"""
+        for rec in history[self.size:]: self.add(rec)
+        return self
+
+    def frame(self, kind):
+        """小計表：依股票時依獲利排序，依期間時新的在前"""
+        if kind == 'symbol':
+            keys = sorted(self.by_symbol, key=lambda k: self.by_symbol[k].profit, reverse=True)
+            table = self.by_symbol
+        else:
+            table = self.by_year if kind == 'year' else self.by_month
+            keys = sorted(table, reverse=True)
+        rows = []
+        for k in keys:
+            t = table[k]
+            row = {'項目': k}
+            if kind == 'symbol': row['名稱'] = self.names.get(k, k)
+            row.update({
+                '筆數': t.count, '勝率': t.wins / t.count if t.count else 0.0, '賣出股數': t.qty,
+                '總成本': t.cost, '賣出收入': t.revenue, '獲利金額': t.profit, '報酬率%': t.roi
+            })
+            rows.append(row)
+        return pd.DataFrame(rows)
+
+def realized_index(data):
+    """取得 (必要時建立) data 的已實現損益索引，並補上新增的紀錄"""
+    history = data.setdefault('history', [])
+    index = data.get('_realized')
+    if index is None or index.size > len(history):
+        index = data['_realized'] = RealizedIndex()
+    return index.sync(history)
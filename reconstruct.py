@@ -0,0 +1,160 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from fx import currency_of, rates_on
+from events import apply_event
+from storage import default_data
+
+# --- 歷史資產重建 ---
+# 由交易紀錄還原每天的持股與現金，再以日線收盤價與歷史匯率估值：
+# 持股變動攤成「日期 x 代碼」矩陣後 cumsum 即為每日股數，乘上價格矩陣與匯率矩陣即為每日市值。
+# 交易紀錄從第一筆開始都在時完全重播；舊資料 (事件化之前) 改由目前的 lots 與已實現紀錄推估。
+
+FLOW_COLUMNS = ['d', 'code', 'shares', 'cash', 'principal']
+
+def _day(ev, ts):
+    return str(ev.get('d') or ts or '')[:10]
+
+def event_flows(events):
+    """
+    重播完整的交易紀錄，回傳 (每筆事件的變動, 重播後的 data)。
+    變動包含股數、淨現金 (現金 - 融資負債)、本金 (事件後的值)；
+    刪除持股時實際移除的股數要重播才知道，所以不直接由事件內容計算。
+    """
+    state = default_data()
+    rows = []
+    for _, ts, ev in events:
+        code = ev.get('code', '')
+        pos = state['h'].get(code)
+        shares0, debt0 = (pos.shares, pos.debt) if pos else (0, 0.0)
+        cash0 = state['cash']
+        apply_event(state, ev)
+        pos = state['h'].get(code)
+        shares1, debt1 = (pos.shares, pos.debt) if pos else (0, 0.0)
+        rows.append((_day(ev, ts), code, shares1 - shares0, (state['cash'] - cash0) - (debt1 - debt0), state.get('principal', 0.0)))
+    flows = pd.DataFrame(rows, columns=FLOW_COLUMNS)
+    # 沒有日期的事件 (存提、本金) 取寫入時間；事件有先後順序，日期不可晚於之後的事件
+    if not flows.empty: flows['d'] = flows['d'][::-1].cummin()[::-1]
+    return flows, state
+
+def ledger_flows(data, fx_daily):
+    """
+    沒有完整交易紀錄時的推估：目前的每一批視為當天買進，已實現紀錄視為當天賣出，
+    賣掉的股數假設在該股最早一次交易時買進 (買進成本取紀錄上的 buy_cost)。
+    """
+    rows = []
+    first_day = {}
+    for code, pos in data.get('h', {}).items():
+        for lot in pos.iter_lots():
+            first_day[code] = min(first_day.get(code, lot.d), lot.d)
+    for rec in data.get('history', []):
+        first_day[rec['code']] = min(first_day.get(rec['code'], rec['d']), rec['d'])
+
+    lots = [(lot.d, code, lot.s, lot.p * lot.s) for code, pos in data.get('h', {}).items() for lot in pos.iter_lots()]
+    if lots:
+        days, codes, shares, amount = zip(*lots)
+        twd = np.asarray(amount) * rates_on(fx_daily, [currency_of(c) for c in codes], days)
+        rows += [(d, c, s, -v, np.nan) for d, c, s, v in zip(days, codes, shares, twd)]
+    for rec in data.get('history', []):
+        code = rec['code']
+        rows.append((first_day[code], code, rec['qty'], -(rec.get('buy_cost') or 0.0), np.nan))
+        rows.append((rec['d'], code, -rec['qty'], rec.get('sell_rev') or 0.0, np.nan))
+    return pd.DataFrame(rows, columns=FLOW_COLUMNS)
+
+def replays_to(state, data):
+    """重播結果與目前資料一致，表示交易紀錄完整 (事件化之前就有的舊資料不會一致)"""
+    if abs(state['cash'] - data.get('cash', 0.0)) > 1: return False
+    held = {c: p.shares for c, p in state['h'].items()}
+    return held == {c: p.shares for c, p in data.get('h', {}).items()}
+
+def position_matrix(flows, dates):
+    """flows 的股數變動 -> 日期 x 代碼的持股矩陣 (非交易日的變動算在下一個交易日)"""
+    trades = flows[flows['code'] != '']
+    codes = sorted(trades['code'].unique())
+    if not codes: return pd.DataFrame(index=dates)
+    row = np.minimum(dates.searchsorted(pd.to_datetime(trades['d'])), len(dates) - 1)
+    col = pd.Index(codes).get_indexer(trades['code'])
+    delta = np.zeros((len(dates), len(codes)))
+    np.add.at(delta, (row, col), trades['shares'].to_numpy(dtype=float))
+    return pd.DataFrame(np.cumsum(delta, axis=0), index=dates, columns=codes)
+
+def reconstruct(data, events, price_store, fx_table, start=None, end=None):
+    """
+    回傳每個交易日的 Date, NetAsset, Principal (NetAsset = 市值 + 現金 - 融資負債)。
+    最後一天的淨現金對齊目前 data 的現金與負債，推估模式下的誤差只影響較早的日期。
+    """
+    end = pd.Timestamp(end or datetime.now() - timedelta(days=1)).normalize()
+    flows, complete = None, False
+    if events and events[0][0] == 1:
+        try:
+            flows, state = event_flows(events)
+            complete = replays_to(state, data)
+        except (KeyError, ValueError):
+            # 事件化之前的舊資料：賣出的持股不在重播結果中 (或股數不足)，交易紀錄不完整
+            complete = False
+    if not complete:
+        days = [lot.d for pos in data.get('h', {}).values() for lot in pos.iter_lots()] + [r['d'] for r in data.get('history', [])]
+        if not days: return pd.DataFrame(columns=['Date', 'NetAsset', 'Principal'])
+        first = pd.Timestamp(min(days))
+        codes = set(data.get('h', {})) | {r['code'] for r in data.get('history', [])}
+        flows = ledger_flows(data, fx_table.daily(sorted({currency_of(c) for c in codes}), first, end))
+
+    # end 之後 (例如今天) 的交易不計入，推估模式對齊目前現金時要扣掉
+    flow_days = pd.to_datetime(flows['d'], errors='coerce')
+    later_cash = flows.loc[flow_days > end, 'cash'].sum()
+    flows = flows[flow_days <= end]
+    if flows.empty: return pd.DataFrame(columns=['Date', 'NetAsset', 'Principal'])
+    first = pd.Timestamp(start) if start else pd.to_datetime(flows['d']).min()
+    dates = pd.bdate_range(first.normalize(), end)
+    if len(dates) == 0: return pd.DataFrame(columns=['Date', 'NetAsset', 'Principal'])
+
+    shares = position_matrix(flows, dates)
+    codes = list(shares.columns)
+    closes = price_store.closes(codes, dates[0], dates[-1]) if codes else pd.DataFrame(index=dates)
+    prices = closes.reindex(columns=codes).reindex(dates.union(closes.index)).ffill().reindex(dates).bfill()
+    # 完全沒有日線的代碼以目前的平均成本估值
+    for code in codes:
+        if prices[code].isna().all():
+            pos = data.get('h', {}).get(code)
+            prices[code] = pos.avg_cost if pos else 0.0
+    fx_daily = fx_table.daily(sorted({currency_of(c) for c in codes}), dates[0], dates[-1])
+    fx_daily = fx_daily.reindex(dates.union(fx_daily.index)).ffill().bfill().reindex(dates)
+    rates = fx_daily[[currency_of(c) for c in codes]].to_numpy() if codes else np.zeros((len(dates), 0))
+    market_value = (shares.to_numpy() * prices.to_numpy() * rates).sum(axis=1)
+
+    row = np.minimum(dates.searchsorted(pd.to_datetime(flows['d'])), len(dates) - 1)
+    cash_delta = np.zeros(len(dates))
+    np.add.at(cash_delta, row, flows['cash'].to_numpy(dtype=float))
+    net_cash = np.cumsum(cash_delta)
+    if not complete:
+        current = data.get('cash', 0.0) - sum(p.debt for p in data.get('h', {}).values())
+        net_cash += current - later_cash - net_cash[-1]
+
+    if complete:
+        principal = pd.Series(flows['principal'].to_numpy(dtype=float), index=row).groupby(level=0).last()
+        principal = principal.reindex(range(len(dates))).ffill().fillna(0.0).to_numpy()
+    else:
+        # 推估模式沒有存提紀錄，本金維持目前的值
+        principal = np.full(len(dates), float(data.get('principal', 0.0)))
+    return pd.DataFrame({'Date': dates.strftime('%Y-%m-%d'), 'NetAsset': market_value + net_cash, 'Principal': principal})
+
+def _number(value):
+    # 工作表讀回來的是字串，改寫時轉回數字 (RAW 寫入字串會變成文字格式)
+    v = pd.to_numeric(value, errors='coerce')
+    return value if pd.isna(v) else int(v)
+
+def backfill_history(backend, user, price_store, fx_table, data=None, end=None):
+    """
+    補上 Hist_ 缺少的日期 (已有的紀錄不動)，依日期排序後整批改寫。回傳補上的筆數。
+    """
+    if data is None: data = backend.load(user)
+    curve = reconstruct(data, backend.read_events(user), price_store, fx_table, end=end)
+    existing = [[r[0]] + [_number(v) for v in r[1:3]] for r in backend.read_history(user) if r and r[0]]
+    have = {r[0] for r in existing}
+    missing = curve[~curve['Date'].isin(have) & (curve['NetAsset'] > 0)]
+    if missing.empty: return 0
+    added = [[d, int(n), int(p)] for d, n, p in missing[['Date', 'NetAsset', 'Principal']].itertuples(index=False)]
+    rows = sorted(existing + added, key=lambda r: r[0])
+    backend.replace_history(user, rows)
+    return len(added)
@@ -0,0 +1,202 @@
+import threading
+import numpy as np
+import pandas as pd
+
+# --- 時間加權 / 金額加權報酬率 ---
+# 外部資金流入取自交易紀錄的「資金存提」(cash) 事件，本金修正不算資金進出；
+# 時間加權報酬率 (TWR) 扣掉資金流入後逐日連乘，可以直接與基準指數的漲跌幅比較；
+# 金額加權報酬率 (XIRR) 以所有資金流入與目前淨資產解年化內部報酬率。
+# ReturnTracker 每新增一列只做一次連乘與一次 (以上次結果為起點的) 牛頓法，
+# twr_curve() / xirr_of() 為整段重算的向量化版本，用來核對增量結果。
+
+XIRR_TOL = 1e-9
+XIRR_MAX_ITER = 50
+DAYS_PER_YEAR = 365.0
+
+def _years(dates, origin):
+    return (np.asarray(dates, dtype='datetime64[D]') - np.datetime64(origin, 'D')).astype(float) / DAYS_PER_YEAR
+
+def xirr(years, amounts, guess=0.1):
+    """
+    年化內部報酬率：sum(amounts / (1 + r) ** years) = 0。
+    years 為距第一筆的年數，amounts 投入為負、取回 (含期末淨資產) 為正；無解回傳 nan。
+    """
+    years = np.asarray(years, dtype=float)
+    amounts = np.asarray(amounts, dtype=float)
+    if len(amounts) < 2 or not (amounts > 0).any() or not (amounts < 0).any(): return np.nan
+    rate = guess if np.isfinite(guess) and guess > -0.99 else 0.1
+    for _ in range(XIRR_MAX_ITER):
+        disc = (1.0 + rate) ** -years
+        npv = (amounts * disc).sum()
+        slope = (-years * amounts * disc / (1.0 + rate)).sum()
+        if slope == 0: break
+        step = npv / slope
+        rate = max(rate - step, (rate - 1.0) / 2)  # 不越過 -100%
+        if abs(step) < XIRR_TOL: return rate
+    # 牛頓法不收斂時改用二分法 (npv 對 rate 單調遞減的一般情況)
+    lo, hi = -0.9999, 100.0
+    f = lambda r: (amounts * (1.0 + r) ** -years).sum()
+    if np.sign(f(lo)) == np.sign(f(hi)): return np.nan
+    for _ in range(200):
+        mid = (lo + hi) / 2
+        if np.sign(f(mid)) == np.sign(f(lo)): lo = mid
+        else: hi = mid
+        if hi - lo < XIRR_TOL: break
+    return (lo + hi) / 2
+
+def cash_flows(events):
+    """交易紀錄 [(seq, 時間, 事件)] 中的資金存提 -> 以日期為索引的每日淨流入 (存入為正)"""
+    rows = [(str(ev.get('d') or ts or '')[:10], float(ev.get('amt', 0.0))) for _, ts, ev in events if ev.get('t') == 'cash']
+    if not rows: return pd.Series(dtype=float, index=pd.DatetimeIndex([]))
+    frame = pd.DataFrame(rows, columns=['d', 'amt'])
+    frame['d'] = pd.to_datetime(frame['d'], errors='coerce')
+    return frame.dropna().groupby('d')['amt'].sum()
+
+def row_flows(dates, flows):
+    """
+    每日流入對齊到資產紀錄的每一列：記在當天或之後第一筆紀錄上。
+    第一筆紀錄 (含) 之前的存提已在期初淨資產內，不另計。
+    """
+    dates = pd.DatetimeIndex(dates)
+    out = np.zeros(len(dates))
+    if len(dates) == 0 or flows is None or flows.empty: return out
+    row = dates.searchsorted(flows.index, side='left')
+    keep = (row > 0) & (row < len(dates))
+    np.add.at(out, row[keep], flows.to_numpy(dtype=float)[keep])
+    return out
+
+def twr_curve(dfh, flows=None):
+    """
+    整段重算：回傳以 Date 為索引的累計時間加權報酬率 (%)。flows 為 row_flows() 的結果。
+    資金在當天收盤前進出：r_t = (NetAsset_t - 流入_t) / NetAsset_{t-1} - 1。
+    """
+    net = dfh['NetAsset'].to_numpy(dtype=float)
+    flows = np.zeros(len(net)) if flows is None else np.asarray(flows, dtype=float)
+    prev = np.concatenate([[np.nan], net[:-1]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r = np.where(prev > 0, (net - flows) / prev - 1, 0.0)
+    return pd.Series((np.cumprod(1 + r) - 1) * 100, index=pd.DatetimeIndex(dfh['Date']), name='TWR_Pct')
+
+def xirr_of(dfh, flows=None):
+    """整段重算的年化金額加權報酬率：第一天的淨資產視為投入，最後一天的淨資產視為取回"""
+    if dfh.empty: return np.nan
+    dates = pd.DatetimeIndex(dfh['Date'])
+    amounts = -(np.zeros(len(dfh)) if flows is None else np.asarray(flows, dtype=float))
+    amounts[0] = -float(dfh['NetAsset'].iloc[0])
+    keep = amounts != 0
+    keep[0] = True
+    years = np.append(_years(dates[keep], dates[0]), _years(dates[-1:], dates[0]))
+    return xirr(years, np.append(amounts[keep], float(dfh['NetAsset'].iloc[-1])))
+
+class ReturnTracker:
+    """
+    逐列累加的 TWR / XIRR。最後一列 (當天) 可能被更新，所以保留「最後一列之前」的狀態，
+    同一天再送進來時只重算最後一步。
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        self.dates = []       # 已處理的日期 (Timestamp)
+        self.twr = []         # 對應的累計 TWR (倍數 - 1)
+        self._growth = 1.0    # 最後一列之前的累計成長倍數
+        self._prev = None     # 最後一列之前的 (淨資產, 資金流入)
+        self._last = None     # 最後一列的 (淨資產, 資金流入)
+        self._flow_years = [] # 最後一列之前的資金流入 (距第一天年數, 金額；投入為負)
+        self._flow_amounts = []
+        self._last_flow = 0.0
+        self._rate = 0.1      # 上次 XIRR 的解，下次牛頓法的起點
+        self.xirr = np.nan
+
+    def update(self, date, net_asset, flow=0.0):
+        """新增一列 (日期須不早於最後一列)，flow 為該列的外部資金流入；同一天重複送進來時取代最後一列"""
+        date = pd.Timestamp(date)
+        with self._lock:
+            if self.dates and date == self.dates[-1]:
+                self.dates.pop(); self.twr.pop()
+            elif self.dates and date < self.dates[-1]:
+                raise ValueError(f"{date:%Y-%m-%d} 早於最後一筆紀錄")
+            elif self._last is not None:
+                # 前一列定案：成長倍數、資金流入併入基礎狀態
+                self._growth *= 1 + self._step(self._prev, self._last)
+                if self._last_flow:
+                    self._flow_years.append(_years([self.dates[-1]], self.dates[0])[0])
+                    self._flow_amounts.append(self._last_flow)
+                self._prev = self._last
+
+            net_asset = float(net_asset)
+            # 第一列的流入已在期初淨資產內
+            flow = 0.0 if self._prev is None else float(flow)
+            self._last = (net_asset, flow)
+            self.dates.append(date)
+            self.twr.append(self._growth * (1 + self._step(self._prev, self._last)) - 1)
+            # 第一列的淨資產視為期初投入，之後的存提為資金流入
+            self._last_flow = -net_asset if self._prev is None else -flow
+            self._solve()
+
+    @staticmethod
+    def _step(prev, cur):
+        if prev is None or prev[0] <= 0: return 0.0
+        return (cur[0] - cur[1]) / prev[0] - 1
+
+    def _solve(self):
+        origin = self.dates[0]
+        years = list(self._flow_years)
+        amounts = list(self._flow_amounts)
+        end = _years([self.dates[-1]], origin)[0]
+        if self._last_flow or not amounts:
+            years.append(end); amounts.append(self._last_flow)
+        years.append(end); amounts.append(self._last[0])
+        rate = xirr(years, amounts, self._rate)
+        if np.isfinite(rate): self._rate = rate
+        self.xirr = rate
+
+    def extend(self, dfh, flows=None):
+        """
+        以 HistoryMirror.frame() 與 row_flows() 的結果更新：只處理最後一列 (含) 之後的列；
+        較早的紀錄或存提有變動 (補齊歷史、重新同步、補記存提) 時整段重來。
+        """
+        dates = pd.DatetimeIndex(dfh['Date'])
+        flows = np.zeros(len(dfh)) if flows is None else np.asarray(flows, dtype=float)
+        with self._lock:
+            n = len(self.dates)
+            fresh = n == 0 or len(dates) < n or dates[n - 1] != self.dates[-1] or (n > 1 and dates[0] != self.dates[0])
+            if not fresh and n > 1 and self._prev is not None:
+                # 倒數第二列的值要一致，否則中間有改寫
+                fresh = (float(dfh['NetAsset'].iloc[n - 2]), float(flows[n - 2]) if n > 2 else 0.0) != self._prev
+            if fresh:
+                self._load(dfh, flows)
+                return self
+        rows = dfh.iloc[n - 1:]
+        for d, net, flow in zip(rows['Date'], rows['NetAsset'], flows[n - 1:]):
+            self.update(d, net, flow)
+        return self
+
+    def _load(self, dfh, flows):
+        """整段以向量化方式重建狀態 (之後的列再逐列累加)"""
+        self.clear()
+        if dfh.empty: return
+        flows = flows.copy()
+        flows[0] = 0.0
+        twr = twr_curve(dfh, flows)
+        net = dfh['NetAsset'].to_numpy(dtype=float)
+        self.dates = list(twr.index)
+        self.twr = list(twr.to_numpy() / 100)
+        amounts = -flows
+        amounts[0] = -net[0]
+        years = _years(twr.index, twr.index[0])
+        keep = amounts[:-1] != 0
+        self._flow_years = list(years[:-1][keep])
+        self._flow_amounts = list(amounts[:-1][keep])
+        self._last_flow = amounts[-1]
+        self._last = (net[-1], flows[-1])
+        if len(net) > 1:
+            self._growth = 1 + self.twr[-2]
+            self._prev = (net[-2], flows[-2])
+        self._solve()
+
+    def curve(self):
+        """累計 TWR (%)，以日期為索引"""
+        with self._lock:
+            return pd.Series(np.asarray(self.twr) * 100, index=pd.DatetimeIndex(self.dates), name='TWR_Pct')
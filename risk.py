@@ -0,0 +1,127 @@
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from statistics import NormalDist
+
+from fx import currency_of
+
+# --- 風險分析 ---
+# 持股與基準指數的日報酬對齊成一個「日期 x 代碼」矩陣 (全部以台幣計，含匯率變動，
+# 海外基準與台幣組合比較 Beta 時才不會漏掉匯率)，
+# 以目前的市值權重得到投資組合的日報酬，波動率、Beta、最大回撤、相關係數與 VaR 都是矩陣運算。
+# 報酬矩陣依 (代碼, 日期)、分析結果依 (持股, 日期) 快取，同一天重跑頁面不重算。
+
+RISK_BENCHMARKS = ['0050.TW', 'SPY']
+# 回看多少天的日線 (日曆天)
+RISK_LOOKBACK_DAYS = 365
+TRADING_DAYS = 252
+VAR_LEVELS = (0.95, 0.99)
+RISK_CACHE_SIZE = 64
+
+def returns_matrix(price_store, fx_table, codes, start, end=None, benchmarks=RISK_BENCHMARKS):
+    """
+    日期 x (持股 + 基準) 的台幣日報酬。台股與美股休市日不同，以前一天收盤補齊 (當天報酬為 0)；
+    完全沒有日線的代碼整欄為 0。
+    """
+    symbols = list(dict.fromkeys(list(codes) + list(benchmarks)))
+    closes = price_store.closes(symbols, start, end).reindex(columns=symbols)
+    if closes.empty: return pd.DataFrame(columns=symbols, dtype=float)
+    fx_daily = fx_table.daily(sorted({currency_of(c) for c in symbols}), start, end)
+    fx_daily = fx_daily.reindex(closes.index.union(fx_daily.index)).ffill().bfill().reindex(closes.index)
+    closes[symbols] = closes[symbols].to_numpy() * fx_daily[[currency_of(c) for c in symbols]].to_numpy()
+    prices = closes.ffill()
+    returns = prices.pct_change(fill_method=None).iloc[1:]
+    return returns.replace([np.inf, -np.inf], np.nan).fillna(0.0)
+
+def drawdown(returns):
+    """累計淨值相對前高的跌幅 (<= 0)"""
+    wealth = np.cumprod(1 + np.asarray(returns, dtype=float))
+    return wealth / np.maximum.accumulate(wealth) - 1 if len(wealth) else wealth
+
+def risk_report(returns, codes, mkt_val, benchmarks=RISK_BENCHMARKS):
+    """
+    returns: returns_matrix() 的結果；codes / mkt_val: 持股與台幣市值。
+    回傳 dict：days, volatility (年化), betas, max_drawdown, drawdown, corr, var, holdings
+    """
+    codes = list(codes)
+    mkt_val = np.asarray(mkt_val, dtype=float)
+    total = mkt_val.sum()
+    weight = mkt_val / total if total > 0 else np.zeros(len(codes))
+    R = returns.reindex(columns=codes).fillna(0.0).to_numpy()
+    port = R @ weight
+    days = len(port)
+
+    sigma = port.std(ddof=1) if days > 1 else 0.0
+    mu = port.mean() if days else 0.0
+
+    # Beta = cov(組合, 基準) / var(基準)，所有基準一次算
+    bench = [b for b in benchmarks if b in returns]
+    B = returns[bench].to_numpy()
+    Bc = B - B.mean(axis=0) if days else B
+    pc = port - mu
+    with np.errstate(divide='ignore', invalid='ignore'):
+        betas = (Bc.T @ pc) / (Bc ** 2).sum(axis=0)
+        # 個股對第一個基準的 Beta
+        stock_beta = (R - R.mean(axis=0)).T @ Bc[:, 0] / (Bc[:, 0] ** 2).sum() if bench and days else np.full(len(codes), np.nan)
+        corr = np.corrcoef(R, rowvar=False) if len(codes) > 1 and days > 1 else np.ones((len(codes), len(codes)))
+
+    dd = drawdown(port)
+    var_rows = []
+    for level in VAR_LEVELS:
+        hist = -np.quantile(port, 1 - level) if days else 0.0
+        param = -(mu - NormalDist().inv_cdf(level) * sigma)
+        var_rows.append({'信賴水準': f"{level:.0%}", '歷史模擬 VaR': hist * total, '參數法 VaR': param * total,
+                         '歷史模擬 %': hist, '參數法 %': param})
+
+    return {
+        'days': days,
+        'volatility': sigma * np.sqrt(TRADING_DAYS),
+        'betas': {b: float(v) for b, v in zip(bench, np.atleast_1d(betas))},
+        'max_drawdown': float(dd.min()) if days else 0.0,
+        'drawdown': pd.Series(dd, index=returns.index, name='drawdown'),
+        'corr': pd.DataFrame(np.nan_to_num(corr), index=codes, columns=codes),
+        'var': pd.DataFrame(var_rows),
+        'holdings': pd.DataFrame({
+            '股票代碼': codes, '占比': weight,
+            '年化波動率': R.std(axis=0, ddof=1) * np.sqrt(TRADING_DAYS) if days > 1 else np.zeros(len(codes)),
+            f"Beta ({bench[0]})" if bench else 'Beta': stock_beta,
+        }),
+    }
+
+class RiskEngine:
+    """報酬矩陣與分析結果的 LRU 快取 (整個伺服器程序共用)"""
+    def __init__(self, price_store, fx_table, max_size=RISK_CACHE_SIZE, lookback_days=RISK_LOOKBACK_DAYS):
+        self.price_store = price_store
+        self.fx_table = fx_table
+        self.max_size = max_size
+        self.lookback_days = lookback_days
+        self._lock = threading.Lock()
+        self._matrices = OrderedDict()  # (代碼, 日期) -> 報酬矩陣
+        self._reports = OrderedDict()   # (持股, 日期) -> 分析結果
+
+    def _cached(self, store, key, build):
+        with self._lock:
+            if key in store:
+                store.move_to_end(key)
+                return store[key]
+        value = build()
+        with self._lock:
+            store[key] = value
+            while len(store) > self.max_size: store.popitem(last=False)
+        return value
+
+    def returns(self, codes, day=None):
+        day = day or datetime.now().strftime('%Y-%m-%d')
+        codes = tuple(sorted(codes))
+        start = pd.Timestamp(day) - timedelta(days=self.lookback_days)
+        return self._cached(self._matrices, (codes, day),
+                            lambda: returns_matrix(self.price_store, self.fx_table, list(codes), start, day))
+
+    def report(self, codes, shares, mkt_val, day=None):
+        """codes / shares / mkt_val：目前持股；持股與日期相同時直接回傳上次的結果"""
+        day = day or datetime.now().strftime('%Y-%m-%d')
+        key = (tuple(sorted(zip(codes, (float(s) for s in shares)))), day)
+        return self._cached(self._reports, key,
+                            lambda: risk_report(self.returns(codes, day), codes, mkt_val))
@@ -0,0 +1,262 @@
+import time
+import threading
+from collections import OrderedDict
+from metrics import METRICS
+from lazy import lazy_import
+
+gspread = lazy_import('gspread')
+service_account = lazy_import('oauth2client.service_account')
+
+# 背景寫入間隔 (秒)
+FLUSH_INTERVAL = 5
+# 跨工作表批次讀寫時每次最多帶幾個範圍 (避免網址過長)
+BATCH_RANGES = 100
+# 工作表列數不足時一次多擴充的列數 (避免每天都要擴充)
+GROW_ROWS = 1000
+
+SCOPE = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/drive']
+
+def authorize(creds_dict):
+    """以服務帳戶金鑰 (dict) 建立已授權的 gspread client"""
+    creds = service_account.ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+    return gspread.authorize(creds)
+
+# --- Google Sheets 連線池 ---
+# 整個伺服器程序共用一個已授權的 client 與已開啟的試算表/工作表，
+# 避免每次互動都重新授權、重新 client.open() 查詢雲端硬碟。
+
+class SheetPool:
+    def __init__(self, client_factory, spreadsheet_name):
+        self.client_factory = client_factory
+        self.spreadsheet_name = spreadsheet_name
+        self._lock = threading.RLock()
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    def client(self):
+        with self._lock:
+            if self._client is not None and self._token_expired(self._client):
+                self._reset()
+            if self._client is None:
+                self._client = self.client_factory()
+            return self._client
+
+    def spreadsheet(self):
+        with self._lock:
+            if self._spreadsheet is None:
+                client = self.client()
+                if client is None: return None
+                self._spreadsheet = client.open(self.spreadsheet_name)
+            return self._spreadsheet
+
+    def worksheet(self, title, rows=100, cols=2, header=None):
+        """取得工作表 handle，不存在時自動建立 (並寫入標題列)"""
+        with self._lock:
+            ws = self._worksheets.get(title)
+            if ws is not None: return ws
+            spreadsheet = self.spreadsheet()
+            if spreadsheet is None: return None
+            try:
+                ws = spreadsheet.worksheet(title)
+            except gspread.exceptions.WorksheetNotFound:
+                ws = spreadsheet.add_worksheet(title=title, rows=str(rows), cols=str(cols))
+                if header: ws.append_row(header)
+            self._worksheets[title] = ws
+            return ws
+
+    def worksheets(self):
+        """列出試算表內所有工作表 (順便放進快取)"""
+        with self._lock:
+            spreadsheet = self.spreadsheet()
+            if spreadsheet is None: return []
+            all_ws = spreadsheet.worksheets()
+            for ws in all_ws: self._worksheets[ws.title] = ws
+            return all_ws
+
+    def invalidate(self, title=None):
+        """發生錯誤時丟棄 handle；不指定工作表則連 client 一起重建"""
+        with self._lock:
+            if title is None: self._reset()
+            else: self._worksheets.pop(title, None)
+
+    def _reset(self):
+        self._client = None
+        self._spreadsheet = None
+        self._worksheets = {}
+
+    @staticmethod
+    def _token_expired(client):
+        # oauth2client 憑證會帶 access_token_expired，過期時重新授權
+        creds = getattr(client, 'auth', None) or getattr(getattr(client, 'http_client', None), 'auth', None)
+        return bool(getattr(creds, 'access_token_expired', False))
+
+
+# --- 延遲合併寫入 (write-behind) ---
+# 同一工作表的多次寫入先放在佇列，同一範圍只保留最後的值，
+# 追加的列合併成一次 append_rows，定時或登出時才真正送出。
+
+class WriteBehind:
+    def __init__(self, flush_interval=FLUSH_INTERVAL, on_error=None):
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = OrderedDict()  # title -> {'ws', 'cells', 'appends'}
+        self._row_index = {}  # title -> (最後一列的 key, 列號)
+        self._thread = None
+
+    def start(self):
+        if self._thread and self._thread.is_alive(): return
+        self._thread = threading.Thread(target=self._run, name='sheet-write-behind', daemon=True)
+        self._thread.start()
+
+    def _slot(self, ws):
+        slot = self._pending.get(ws.title)
+        if slot is None:
+            slot = self._pending[ws.title] = {'ws': ws, 'cells': OrderedDict(), 'appends': []}
+        slot['ws'] = ws
+        return slot
+
+    def set_range(self, ws, rng, values):
+        """覆寫一個範圍 (同範圍重複寫入只保留最後一次)"""
+        with self._lock:
+            cells = self._slot(ws)['cells']
+            cells.pop(rng, None)
+            cells[rng] = values
+
+    def append(self, ws, row):
+        with self._lock:
+            self._slot(ws)['appends'].append(row)
+
+    def upsert_row(self, ws, key, values, locate):
+        """
+        第一欄等於 key 的最後一列就地更新，否則追加新列 (例如同一天的資產紀錄)。
+        locate(ws) 回傳 (最後一列的 key, 列號)。key 與記住的最後一列不同 (新的一天) 時重新定位，
+        其他程序 (批次估值) 可能已寫入這一天的列；同一個 key 之後的更新沿用記住的列號。
+        """
+        known = self._row_index.get(ws.title)
+        if known is None or known[0] != key:
+            # 佇列中的新增列先送出，重新定位時才算得到
+            if self.has_pending([ws.title]):
+                errors = self.flush([ws.title])
+                if errors: raise errors[0][1]
+            self._row_index[ws.title] = locate(ws)
+        with self._lock:
+            last_key, last_row = self._row_index[ws.title]
+            slot = self._slot(ws)
+            if key == last_key:
+                pending = slot.get('upsert')
+                if pending is not None and any(r is pending for r in slot['appends']):
+                    pending[:] = values
+                else:
+                    cols = chr(ord('A') + len(values) - 1)
+                    slot['cells'].pop(f"A{last_row}:{cols}{last_row}", None)
+                    slot['cells'][f"A{last_row}:{cols}{last_row}"] = [values]
+            else:
+                row = list(values)
+                slot['appends'].append(row)
+                slot['upsert'] = row
+                self._row_index[ws.title] = (key, last_row + 1)
+
+    def forget_rows(self, title):
+        """工作表被整批改寫後丟棄記住的最後一列，下次 upsert 重新定位"""
+        with self._lock:
+            self._row_index.pop(title, None)
+
+    def has_pending(self, titles=None):
+        with self._lock:
+            return any(titles is None or t in titles for t in self._pending)
+
+    def flush(self, titles=None):
+        """立即送出佇列中的寫入；回傳 [(工作表名稱, 例外)]，失敗的部分留在佇列下次重試"""
+        errors = []
+        with self._flush_lock:
+            with self._lock:
+                keys = [t for t in self._pending if titles is None or t in titles]
+                batch = [(t, self._pending.pop(t)) for t in keys]
+            for title, slot in batch:
+                ws = slot['ws']
+                try:
+                    if slot['appends']:
+                        METRICS.observe_size('sheets.write', payload_size(slot['appends']))
+                        with METRICS.span('sheets.append_rows'):
+                            ws.append_rows(slot['appends'], value_input_option='RAW', table_range='A1')
+                        slot['appends'] = []
+                    if slot['cells']:
+                        METRICS.observe_size('sheets.write', sum(payload_size(v) for v in slot['cells'].values()))
+                        with METRICS.span('sheets.batch_update'):
+                            ws.batch_update([{'range': r, 'values': v} for r, v in slot['cells'].items()], value_input_option='RAW')
+                        slot['cells'] = OrderedDict()
+                except Exception as e:
+                    errors.append((title, e))
+                    self._requeue(title, slot)
+        return errors
+
+    def _requeue(self, title, slot):
+        with self._lock:
+            cur = self._pending.get(title)
+            if cur is None:
+                self._pending[title] = slot
+                self._pending.move_to_end(title, last=False)
+                return
+            cur['appends'][:0] = slot['appends']
+            for rng, values in slot['cells'].items():
+                # 佇列中較新的值優先
+                if rng not in cur['cells']: cur['cells'][rng] = values
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                for title, _ in self.flush():
+                    if self.on_error: self.on_error(title)
+            except Exception:
+                pass
+
+# --- 跨工作表批次讀寫 ---
+# 一次 API 呼叫讀寫多張工作表的範圍 (批次估值時所有使用者共用)。
+
+def sheet_range(title, rng):
+    return "'" + title.replace("'", "''") + "'!" + rng
+
+def batch_get(spreadsheet, ranges):
+    """讀取多個範圍，回傳與 ranges 同順序的 [[值]]"""
+    values = []
+    for i in range(0, len(ranges), BATCH_RANGES):
+        chunk = ranges[i:i + BATCH_RANGES]
+        with METRICS.span('sheets.batch_get'):
+            result = spreadsheet.values_batch_get(chunk)
+        got = [vr.get('values', []) for vr in result.get('valueRanges', [])]
+        METRICS.observe_size('sheets.read', sum(payload_size(v) for v in got))
+        values.extend(got)
+    return values
+
+def batch_set(spreadsheet, data):
+    """data: [(範圍, [[值]])]，覆寫多個範圍"""
+    for i in range(0, len(data), BATCH_RANGES):
+        chunk = data[i:i + BATCH_RANGES]
+        METRICS.observe_size('sheets.write', sum(payload_size(v) for _, v in chunk))
+        with METRICS.span('sheets.values_batch_update'):
+            spreadsheet.values_batch_update({
+                'valueInputOption': 'RAW',
+                'data': [{'range': rng, 'values': values} for rng, values in chunk],
+            })
+
+def grow_rows(spreadsheet, needed):
+    """
+    needed: [(工作表, 至少需要的列數)]。values 的批次寫入不會自動擴充格線 (append 才會)，
+    超出列數會失敗，所以先以一次 batch_update 把不夠的工作表補足 (多留 GROW_ROWS 列)。回傳有擴充的工作表名稱。
+    """
+    short = [(ws, n) for ws, n in needed if ws.row_count < n]
+    if not short: return []
+    with METRICS.span('sheets.grow_rows'):
+        spreadsheet.batch_update({'requests': [
+            {'appendDimension': {'sheetId': ws.id, 'dimension': 'ROWS', 'length': n - ws.row_count + GROW_ROWS}}
+            for ws, n in short
+        ]})
+    return [ws.title for ws, _ in short]
+
+def payload_size(rows):
+    """估算寫入的字元數 (儲存格內容長度總和)"""
+    return sum(len(str(v)) for row in rows for v in row)
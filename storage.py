@@ -0,0 +1,392 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+
+import codec
+from events import apply_event, replay, needs_compaction
+from ledger import to_positions
+from metrics import METRICS
+from sheets import payload_size, sheet_range, batch_get, batch_set, grow_rows
+
+# --- 儲存後端 ---
+# 介面：load / append_event / save_snapshot / record_history / read_history / flush / list_users
+# 批次估值另有 load_many / record_history_many，預設逐一呼叫，後端可改成批次讀寫。
+# GoogleSheetsBackend 為原本的試算表儲存，SQLiteBackend 供自架與效能測試使用。
+
+def default_data():
+    return {'h': {}, 'cash': 0.0, 'principal': 0.0, 'history': [], '_fmt': codec.FORMAT_VERSION}
+
+def normalize_data(data):
+    """補齊欄位與舊版資料相容處理"""
+    if 'h' not in data: data['h'] = {}
+    if 'cash' not in data: data['cash'] = 0.0
+    if 'history' not in data: data['history'] = []
+    if 'principal' not in data: data['principal'] = data.get('cash', 0.0)
+
+    # 持股轉成 Position (舊版沒有 lots 的資料在此補上)
+    to_positions(data['h'])
+    return data
+
+def parse_snapshot(raw_data):
+    """讀取任何版本的快照；_fmt 記錄讀到的版本，舊版會在下一次存檔時改存新格式"""
+    try:
+        if raw_data:
+            data, version = codec.loads(raw_data)
+            data = normalize_data(data)
+            data['_fmt'] = version
+            return data
+    except Exception: pass
+    return default_data()
+
+def encode_snapshot(data, compress=False):
+    data['_snap_seq'] = data.get('_seq', 0)
+    data['_fmt'] = codec.FORMAT_VERSION
+    return codec.dumps(data, compress)
+
+def needs_migration(data):
+    return data.get('_fmt', codec.FORMAT_VERSION) < codec.FORMAT_VERSION
+
+def now_str():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+class StorageBackend:
+    def load(self, user):
+        """讀取最新快照並重播之後的事件"""
+        raise NotImplementedError
+
+    def append_event(self, user, seq, event):
+        raise NotImplementedError
+
+    def save_snapshot(self, user, data):
+        raise NotImplementedError
+
+    def record_history(self, user, date, net_asset, principal):
+        """寫入當天的淨資產紀錄 (同一天只保留一列)"""
+        raise NotImplementedError
+
+    def read_history(self, user, start_row=2):
+        """回傳第 start_row 列 (第 1 列為標題) 之後的 [Date, NetAsset, Principal]"""
+        raise NotImplementedError
+
+    def replace_history(self, user, rows):
+        """以依日期排序的 [Date, NetAsset, Principal] 整批改寫資產紀錄 (補齊歷史資料時使用)"""
+        raise NotImplementedError
+
+    def read_events(self, user):
+        """回傳完整的交易紀錄 [(seq, 時間, event)]"""
+        raise NotImplementedError
+
+    def flush(self):
+        """送出尚未寫入的資料，回傳 [(名稱, 例外)]"""
+        return []
+
+    def list_users(self):
+        raise NotImplementedError
+
+    def load_many(self, users):
+        """回傳 {使用者: data}"""
+        return {u: self.load(u) for u in users}
+
+    def record_history_many(self, records):
+        """records: [(使用者, 日期, 淨資產, 本金)]，回傳寫入失敗的清單"""
+        for user, date, net_asset, principal in records:
+            self.record_history(user, date, net_asset, principal)
+        return self.flush()
+
+def commit_event(backend, user, data, event, durable=False):
+    """
+    套用事件並追加一筆交易紀錄，累積足夠事件 (或快照仍是舊格式) 時才寫入完整快照。
+    durable=True (買進/賣出) 時立即送出，回傳寫入失敗的清單。
+    """
+    apply_event(data, event)
+    seq = data.get('_seq', 0) + 1
+    backend.append_event(user, seq, event)
+    data['_seq'] = seq
+    if needs_compaction(data) or needs_migration(data): backend.save_snapshot(user, data)
+    return backend.flush() if durable else []
+
+# 分片快照的 A1 標頭
+SHARD_HEADER = '#shards:'
+
+def log_tail_range(data):
+    """
+    Log_ 工作表中可能含有快照之後事件的範圍。第 1 列為標題，事件 seq 至少在第 seq+1 列；
+    重複送出的列只會讓之後的事件往下移，從第 _seq+2 列開始讀不會漏掉，多讀到的舊事件由 replay 依 seq 略過。
+    """
+    return f"A{data.get('_seq', 0) + 2}:C"
+
+def log_events(rows):
+    """Log_ 的列 -> [(seq, 事件)] (seq 非數字的列略過)"""
+    return [(int(r[0]), json.loads(r[2])) for r in rows if len(r) >= 3 and str(r[0]).isdigit()]
+
+class GoogleSheetsBackend(StorageBackend):
+    """
+    User_{user} 的 A1 存快照、Log_{user} 逐列追加事件、Hist_{user} 存每日淨資產。
+    快照超過單一儲存格上限時，A1 改存 '#shards:N'，內容依序放在 A2:A{N+1}。
+    寫入經由 WriteBehind 合併後批次送出。
+    """
+    def __init__(self, pool, writer, compress=True):
+        self.pool = pool
+        self.writer = writer
+        self.compress = compress
+
+    def _sheet(self, title, **kwargs):
+        try:
+            ws = self.pool.worksheet(title, **kwargs)
+        except Exception:
+            self.pool.invalidate()
+            raise
+        if ws is None: raise RuntimeError("無法連線 Google Sheets")
+        return ws
+
+    def user_sheet(self, user):
+        return self._sheet(f"User_{user}", rows=100, cols=2)
+
+    def log_sheet(self, user):
+        return self._sheet(f"Log_{user}", rows=1000, cols=3, header=['Seq', 'Time', 'Event'])
+
+    def history_sheet(self, user):
+        return self._sheet(f"Hist_{user}", rows=1000, cols=3, header=['Date', 'NetAsset', 'Principal'])
+
+    def load(self, user):
+        sheet = self.user_sheet(user)
+        log_sheet = self.log_sheet(user)
+        with METRICS.span('sheets.acell'):
+            raw_data = sheet.acell('A1').value
+        if raw_data and raw_data.startswith(SHARD_HEADER):
+            n = int(raw_data[len(SHARD_HEADER):])
+            with METRICS.span('sheets.shards'):
+                raw_data = ''.join(r[0] for r in sheet.get(f"A2:A{n + 1}") if r)
+        METRICS.observe_size('sheets.read', len(raw_data or ''))
+        data = parse_snapshot(raw_data)
+        try:
+            with METRICS.span('sheets.log_tail'):
+                rows = log_sheet.get(log_tail_range(data))
+        except Exception:
+            self.pool.invalidate(log_sheet.title)
+            raise
+        return replay(data, log_events(rows))
+
+    def append_event(self, user, seq, event):
+        self.writer.append(self.log_sheet(user), [seq, now_str(), json.dumps(event, ensure_ascii=False)])
+
+    def save_snapshot(self, user, data):
+        # 排入佇列，連續存檔只送最後一次
+        shards = codec.shard(encode_snapshot(data, self.compress))
+        if len(shards) == 1:
+            self.writer.set_range(self.user_sheet(user), 'A1', [shards])
+        else:
+            values = [[f"{SHARD_HEADER}{len(shards)}"]] + [[s] for s in shards]
+            self.writer.set_range(self.user_sheet(user), f"A1:A{len(values)}", values)
+
+    def record_history(self, user, date, net_asset, principal):
+        hist_sheet = self.history_sheet(user)
+        try:
+            self.writer.upsert_row(hist_sheet, date, [date, int(net_asset), int(principal)], locate_last_history_row)
+        except Exception:
+            self.pool.invalidate(hist_sheet.title)
+            raise
+
+    def read_history(self, user, start_row=2):
+        hist_sheet = self.history_sheet(user)
+        try:
+            with METRICS.span('sheets.read_history'):
+                return hist_sheet.get(f"A{start_row}:C")
+        except Exception:
+            self.pool.invalidate(hist_sheet.title)
+            raise
+
+    def replace_history(self, user, rows):
+        hist_sheet = self.history_sheet(user)
+        # 先送出佇列中的當日紀錄，改寫後的列數不同，記住的最後一列也要重新定位
+        self.writer.flush([hist_sheet.title])
+        if rows:
+            # 補齊多年的紀錄可能超過建立時的 1000 列
+            if grow_rows(self.pool.spreadsheet(), [(hist_sheet, len(rows) + 1)]):
+                self.pool.invalidate(hist_sheet.title)
+            self.writer.set_range(hist_sheet, f"A2:C{len(rows) + 1}", [list(r) for r in rows])
+        errors = self.writer.flush([hist_sheet.title])
+        self.writer.forget_rows(hist_sheet.title)
+        if errors: raise errors[0][1]
+
+    def read_events(self, user):
+        log_sheet = self.log_sheet(user)
+        try:
+            with METRICS.span('sheets.read_events'):
+                rows = log_sheet.get("A2:C")
+        except Exception:
+            self.pool.invalidate(log_sheet.title)
+            raise
+        # 重複送出的列只留第一筆
+        events = {}
+        for r in rows:
+            if len(r) >= 3 and str(r[0]).isdigit(): events.setdefault(int(r[0]), (int(r[0]), r[1], json.loads(r[2])))
+        return [events[seq] for seq in sorted(events)]
+
+    def flush(self):
+        errors = self.writer.flush()
+        for title, _ in errors: self.pool.invalidate(title)
+        return errors
+
+    def list_users(self):
+        return sorted(ws.title[len('User_'):] for ws in self.pool.worksheets() if ws.title.startswith('User_'))
+
+    def load_many(self, users):
+        """
+        一次讀取多位使用者：所有 A1 一次 batch_get，分片快照與事件尾端再合併成一次，
+        不論人數多少最多三次 API 呼叫。
+        """
+        spreadsheet = self.pool.spreadsheet()
+        titles = {ws.title for ws in self.pool.worksheets()}
+        users = [u for u in users if f"User_{u}" in titles]
+        heads = batch_get(spreadsheet, [sheet_range(f"User_{u}", 'A1') for u in users])
+        raws = {u: (rows[0][0] if rows and rows[0] else '') for u, rows in zip(users, heads)}
+
+        sharded = [u for u in users if raws[u].startswith(SHARD_HEADER)]
+        shard_ranges = [sheet_range(f"User_{u}", f"A2:A{int(raws[u][len(SHARD_HEADER):]) + 1}") for u in sharded]
+        for u, rows in zip(sharded, batch_get(spreadsheet, shard_ranges)):
+            raws[u] = ''.join(r[0] for r in rows if r)
+
+        datas = {u: parse_snapshot(raws[u]) for u in users}
+        logged = [u for u in users if f"Log_{u}" in titles]
+        tail_ranges = [sheet_range(f"Log_{u}", log_tail_range(datas[u])) for u in logged]
+        for u, rows in zip(logged, batch_get(spreadsheet, tail_ranges)):
+            replay(datas[u], log_events(rows))
+        return datas
+
+    def record_history_many(self, records):
+        """
+        一次讀取所有 Hist 工作表的 A 欄找出最後一列，再以一次 values_batch_update 寫入
+        (同一天已有紀錄時就地更新)，不必逐張掃描整張工作表。列數不足的工作表先一起擴充。
+        """
+        if not records: return []
+        spreadsheet = self.pool.spreadsheet()
+        # 一次取得所有工作表 (含目前的列數)
+        self.pool.worksheets()
+        sheets = [self.history_sheet(user) for user, *_ in records]
+        titles = [ws.title for ws in sheets]
+        ranges = []
+        for title in titles: ranges += [sheet_range(title, 'A:A'), sheet_range(title, 'A1:C1')]
+        got = batch_get(spreadsheet, ranges)
+
+        data = []
+        needed = []
+        for i, (ws, (user, date, net_asset, principal)) in enumerate(zip(sheets, records)):
+            col, header = got[2 * i], got[2 * i + 1]
+            if header and len(header[0]) < 3: data.append((sheet_range(ws.title, 'C1'), [['Principal']]))
+            last_date = col[-1][0] if len(col) > 1 and col[-1] else None
+            row = len(col) if last_date == date else len(col) + 1
+            data.append((sheet_range(ws.title, f"A{row}:C{row}"), [[date, int(net_asset), int(principal)]]))
+            needed.append((ws, row))
+        try:
+            for title in grow_rows(spreadsheet, needed): self.pool.invalidate(title)
+            batch_set(spreadsheet, data)
+        except Exception as e:
+            self.pool.invalidate()
+            return [('values_batch_update', e)]
+        return []
+
+def locate_last_history_row(hist_sheet):
+    # 每天第一次寫入時掃描，同一天之後的更新由 WriteBehind 記住最後一列的位置
+    with METRICS.span('sheets.get_all_values'):
+        all_values = hist_sheet.get_all_values()
+    METRICS.observe_size('sheets.read', payload_size(all_values))
+    if len(all_values) > 0 and len(all_values[0]) < 3:
+         hist_sheet.update_cell(1, 3, 'Principal')
+    last_date = all_values[-1][0] if len(all_values) > 1 else None
+    return last_date, len(all_values)
+
+class SQLiteBackend(StorageBackend):
+    """本機 SQLite (WAL 模式)，每次寫入立即 commit"""
+    def __init__(self, path, compress=False):
+        self.compress = compress
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                user TEXT PRIMARY KEY, seq INTEGER NOT NULL, data TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS events (
+                user TEXT NOT NULL, seq INTEGER NOT NULL, ts TEXT, event TEXT NOT NULL,
+                PRIMARY KEY (user, seq)
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                user TEXT NOT NULL, date TEXT NOT NULL, net REAL, principal REAL,
+                PRIMARY KEY (user, date)
+            );
+        ''')
+        self._conn.commit()
+
+    def load(self, user):
+        with self._lock:
+            row = self._conn.execute("SELECT data FROM snapshots WHERE user = ?", (user,)).fetchone()
+            data = parse_snapshot(row[0] if row else None)
+            events = self._conn.execute(
+                "SELECT seq, event FROM events WHERE user = ? AND seq > ? ORDER BY seq", (user, data.get('_seq', 0))
+            ).fetchall()
+        return replay(data, [(seq, json.loads(ev)) for seq, ev in events])
+
+    def append_event(self, user, seq, event):
+        with self._lock:
+            # 重試送出同一個 seq 時保留第一筆
+            self._conn.execute("INSERT OR IGNORE INTO events (user, seq, ts, event) VALUES (?, ?, ?, ?)",
+                               (user, seq, now_str(), json.dumps(event, ensure_ascii=False)))
+            self._conn.commit()
+
+    def save_snapshot(self, user, data):
+        payload = encode_snapshot(data, self.compress)
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO snapshots (user, seq, data) VALUES (?, ?, ?)
+                ON CONFLICT (user) DO UPDATE SET seq = excluded.seq, data = excluded.data
+            ''', (user, data.get('_seq', 0), payload))
+            self._conn.commit()
+
+    def record_history(self, user, date, net_asset, principal):
+        with self._lock:
+            self._conn.execute('''
+                INSERT INTO history (user, date, net, principal) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user, date) DO UPDATE SET net = excluded.net, principal = excluded.principal
+            ''', (user, date, int(net_asset), int(principal)))
+            self._conn.commit()
+
+    def record_history_many(self, records):
+        with self._lock:
+            self._conn.executemany('''
+                INSERT INTO history (user, date, net, principal) VALUES (?, ?, ?, ?)
+                ON CONFLICT (user, date) DO UPDATE SET net = excluded.net, principal = excluded.principal
+            ''', [(u, d, int(n), int(p)) for u, d, n, p in records])
+            self._conn.commit()
+        return []
+
+    def read_history(self, user, start_row=2):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT date, net, principal FROM history WHERE user = ? ORDER BY date LIMIT -1 OFFSET ?",
+                (user, max(start_row - 2, 0))
+            ).fetchall()
+        return [[d, n, p] for d, n, p in rows]
+
+    def replace_history(self, user, rows):
+        with self._lock:
+            self._conn.execute("DELETE FROM history WHERE user = ?", (user,))
+            self._conn.executemany("INSERT INTO history (user, date, net, principal) VALUES (?, ?, ?, ?)",
+                                   [(user, d, int(float(n)), int(float(p))) for d, n, p in rows])
+            self._conn.commit()
+
+    def read_events(self, user):
+        with self._lock:
+            rows = self._conn.execute("SELECT seq, ts, event FROM events WHERE user = ? ORDER BY seq", (user,)).fetchall()
+        return [(seq, ts, json.loads(ev)) for seq, ts, ev in rows]
+
+    def list_users(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user FROM snapshots UNION SELECT DISTINCT user FROM events ORDER BY user"
+            ).fetchall()
+        return [r[0] for r in rows]
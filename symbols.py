@@ -0,0 +1,115 @@
+import os
+import csv
+import numpy as np
+
+# --- 股票代碼清單 ---
+# 從隨程式附帶的 symbols.csv (代碼、名稱、市場) 載入，代碼與名稱排序成一個陣列，
+# 前綴搜尋只需兩次二分搜尋；買入時的自動完成、表格名稱與代碼檢查都由這裡查詢。
+# 更新清單：python -m symbols --update (下載證交所、櫃買中心與 Nasdaq 的上市清單)
+
+LISTING_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'symbols.csv')
+SEARCH_LIMIT = 20
+# 台股代碼可不輸入後綴搜尋 (2330 -> 2330.TW)
+TW_SUFFIXES = ('.TW', '.TWO')
+
+TWSE_LISTING_URL = "https://openapi.twse.com.tw/v1/exchangeReport/STOCK_DAY_ALL"
+TPEX_LISTING_URL = "https://www.tpex.org.tw/openapi/v1/tpex_mainboard_daily_close_quotes"
+US_LISTING_URL = "https://www.nasdaqtrader.com/dynamic/SymDir/nasdaqtraded.txt"
+
+class SymbolDirectory:
+    """代碼 -> (名稱, 市場)，並以排序後的搜尋鍵 (代碼、去掉後綴的台股代碼、名稱) 支援前綴搜尋"""
+    def __init__(self, rows):
+        self._by_code = {}
+        for code, name, market in rows:
+            self._by_code[code.upper()] = (name or code, market)
+        self.codes = list(self._by_code)
+
+        keys, owners, kinds = [], [], []
+        for i, (code, (name, _)) in enumerate(self._by_code.items()):
+            keys.append(code); owners.append(i); kinds.append(0)
+            if code.endswith(TW_SUFFIXES):
+                keys.append(code.rsplit('.', 1)[0]); owners.append(i); kinds.append(0)
+            if name and name.upper() != code:
+                keys.append(name.upper()); owners.append(i); kinds.append(1)
+        order = np.argsort(keys, kind='stable')
+        self._keys = np.array(keys)[order]
+        self._owners = np.array(owners, dtype=np.int32)[order]
+        self._kinds = np.array(kinds, dtype=np.int8)[order]
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code.upper() in self._by_code
+
+    def get(self, code, default=None):
+        """代碼的名稱 (與 dict.get 相同用法，可直接當名稱對照表)"""
+        entry = self._by_code.get(code.upper())
+        return entry[0] if entry else default
+
+    def market(self, code):
+        entry = self._by_code.get(code.upper())
+        return entry[1] if entry else None
+
+    def label(self, code):
+        name = self.get(code)
+        return f"{code} {name}" if name and name != code else code
+
+    def search(self, query, limit=SEARCH_LIMIT):
+        """代碼或名稱前綴搜尋：完全相符的代碼在前，其次代碼、名稱相符"""
+        q = query.strip().upper()
+        if not q or not len(self._keys): return []
+        lo = np.searchsorted(self._keys, q, side='left')
+        hi = np.searchsorted(self._keys, q + '\U0010ffff', side='left')
+        # 同一前綴下較短的鍵排在前面，只需看前面幾筆
+        hi = min(hi, lo + limit * 4)
+        exact = [i for i in range(lo, hi) if self._keys[i] == q and self._kinds[i] == 0]
+        rest = sorted(range(lo, hi), key=lambda i: self._kinds[i])
+        found = dict.fromkeys(self.codes[self._owners[i]] for i in exact + rest)
+        return list(found)[:limit]
+
+def load_directory(path=LISTING_PATH):
+    rows = []
+    if os.path.exists(path):
+        with open(path, encoding='utf-8', newline='') as f:
+            rows = [(r['code'], r['name'], r['market']) for r in csv.DictReader(f) if r.get('code')]
+    return SymbolDirectory(rows)
+
+# --- 更新清單 ---
+def fetch_listing():
+    """下載最新上市清單，回傳 [(代碼, 名稱, 市場)]"""
+    import requests
+    rows = []
+    twse = requests.get(TWSE_LISTING_URL, timeout=30).json()
+    rows += [(f"{r['Code']}.TW", r['Name'], 'TWSE') for r in twse if r.get('Code')]
+    tpex = requests.get(TPEX_LISTING_URL, timeout=30).json()
+    rows += [(f"{r['SecuritiesCompanyCode']}.TWO", r['CompanyName'], 'TPEx') for r in tpex if r.get('SecuritiesCompanyCode')]
+    lines = requests.get(US_LISTING_URL, timeout=30).text.splitlines()
+    header = lines[0].split('|')
+    for line in lines[1:]:
+        r = dict(zip(header, line.split('|')))
+        if not r.get('Symbol') or r.get('Test Issue') == 'Y' or line.startswith('File Creation Time'): continue
+        # yfinance 的股別以 '-' 分隔 (BRK.B -> BRK-B)
+        rows.append((r['Symbol'].replace('.', '-'), r['Security Name'], 'US'))
+    return rows
+
+def update_listing(path=LISTING_PATH):
+    """以最新清單更新 symbols.csv；已有的中文名稱與其他市場的代碼保留"""
+    current = load_directory(path)
+    merged = {c: (current.get(c), current.market(c)) for c in current.codes}
+    for code, name, market in fetch_listing():
+        code = code.upper()
+        if code not in merged: merged[code] = (name.strip(), market)
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['code', 'name', 'market'])
+        for code, (name, market) in merged.items(): writer.writerow([code, name, market])
+    return len(merged)
+
+if __name__ == '__main__':
+    import sys
+    if '--update' in sys.argv:
+        print(f"已更新 {update_listing()} 檔代碼")
+    else:
+        directory = load_directory()
+        for code in directory.search(' '.join(sys.argv[1:])): print(directory.label(code))
@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from codec import HISTORY_FIELDS
+
+# --- 大型表格 ---
+# 格式化與損益顏色在資料更新時整欄算好一次並快取，
+# 排序、搜尋在原始數值上做，畫面只顯示目前這一頁 (Styler 只處理一頁的列數)。
+
+PAGE_SIZES = [25, 50, 100, 200]
+
+PROFIT_COLORS = ('color: red', 'color: green', 'color: black')
+
+# 庫存明細
+HOLDINGS_FORMATS = {
+    '股數': '{:,}', '成本': '{:,.2f}', '現價': '{:,.2f}',
+    '日損益%': '{:+.2%}', '日損益': '{:+,.0f}',
+    '總損益%': '{:+.2%}', '總損益': '{:+,.0f}',
+    '市值': '{:,.0f}', '占比': '{:.1%}'
+}
+HOLDINGS_COLORED = ['日損益%', '日損益', '總損益%', '總損益']
+
+# 已實現損益 (欄位順序與 codec.HISTORY_FIELDS 對應)
+HISTORY_COLUMNS = ['日期', '代碼', '名稱', '賣出股數', '總成本', '賣出收入', '獲利金額', '報酬率%']
+HISTORY_FORMATS = {
+    '賣出股數': '{:,}', '總成本': '{:,.0f}', '賣出收入': '{:,.0f}',
+    '獲利金額': '{:+,.0f}', '報酬率%': '{:+.2%}'
+}
+HISTORY_COLORED = ['獲利金額', '報酬率%']
+
+# 已實現損益小計 (依股票 / 年度 / 月份)
+BREAKDOWN_FORMATS = {
+    '筆數': '{:,}', '勝率': '{:.0%}', '賣出股數': '{:,}', '總成本': '{:,.0f}', '賣出收入': '{:,.0f}',
+    '獲利金額': '{:+,.0f}', '報酬率%': '{:+.2%}'
+}
+
+class FormattedTable:
+    """原始數值 (排序/搜尋用)、格式化後的文字與每格的 CSS，三者列順序相同"""
+    def __init__(self, raw, formats, colored):
+        self.raw = raw.reset_index(drop=True)
+        self.text = format_frame(self.raw, formats)
+        self.css = color_frame(self.raw, colored)
+
+    def __len__(self):
+        return len(self.raw)
+
+    def query(self, search='', search_cols=(), sort_by=None, ascending=True):
+        """回傳符合搜尋條件、依 sort_by 排序後的列位置"""
+        mask = np.ones(len(self.raw), dtype=bool)
+        if search:
+            mask = np.zeros(len(self.raw), dtype=bool)
+            for col in search_cols:
+                mask |= self.raw[col].astype(str).str.contains(search, case=False, regex=False).to_numpy()
+        rows = np.flatnonzero(mask)
+        if sort_by and len(rows):
+            values = self.raw[sort_by].iloc[rows]
+            order = values.reset_index(drop=True).sort_values(ascending=ascending, kind='stable', na_position='last').index
+            rows = rows[order.to_numpy()]
+        return rows
+
+    def page(self, rows, page, page_size):
+        """取出一頁並套上預先算好的顏色"""
+        sel = rows[page * page_size:(page + 1) * page_size]
+        text = self.text.iloc[sel]
+        css = self.css.iloc[sel]
+        return text.style.apply(lambda _: css, axis=None)
+
+def format_frame(df, formats):
+    text = df.copy()
+    for col, fmt in formats.items():
+        if col in df.columns:
+            text[col] = [fmt.format(v) for v in df[col].tolist()]
+    return text
+
+def color_frame(df, colored):
+    css = pd.DataFrame('', index=df.index, columns=df.columns)
+    for col in colored:
+        if col not in df.columns: continue
+        v = df[col].to_numpy(dtype=float)
+        css[col] = np.where(v > 0, PROFIT_COLORS[0], np.where(v < 0, PROFIT_COLORS[1], PROFIT_COLORS[2]))
+    return css
+
+def history_frame(history):
+    """已實現紀錄 (新的在前) 轉成顯示用欄位"""
+    df = pd.DataFrame.from_records(history[::-1], columns=HISTORY_FIELDS)
+    df.columns = HISTORY_COLUMNS
+    df['報酬率%'] = df['報酬率%'] / 100
+    return df
+
+def page_count(n, page_size):
+    return max(1, -(-n // page_size))
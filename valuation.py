@@ -0,0 +1,145 @@
+import copy
+import numpy as np
+import pandas as pd
+
+from ledger import DEFAULT_COST_METHOD
+from fx import rate_array, rates_on, currency_of, BASE_CURRENCY
+from realized import realized_index
+
+# 庫存明細表格顯示的欄位
+DISPLAY_COLUMNS = ['股票代碼', '公司名稱', '股數', '成本', '現價', '日損益%', '日損益', '總損益%', '總損益', '市值', '占比']
+
+def holdings_arrays(holdings):
+    """
+    將 data['h'] (Position) 攤平成欄位陣列。
+    股數、平均成本與融資負債直接取 Position 的累計值，不必逐筆加總 lots。
+    """
+    codes = list(holdings)
+    n = len(codes)
+    positions = [holdings[c] for c in codes]
+    shares = np.fromiter((float(p.shares) for p in positions), dtype=float, count=n)
+    cost = np.fromiter((p.avg_cost for p in positions), dtype=float, count=n)
+    debt = np.fromiter((p.debt for p in positions), dtype=float, count=n)
+    return codes, shares, cost, debt
+
+def quote_arrays(codes, quotes):
+    """報價表轉成欄位陣列，缺少的代碼價格記為 0"""
+    n = len(codes)
+    rows = [quotes.get(c) or {} for c in codes]
+    price = np.fromiter((float(q.get('p', 0) or 0) for q in rows), dtype=float, count=n)
+    chg = np.fromiter((float(q.get('chg', 0) or 0) for q in rows), dtype=float, count=n)
+    chg_pct = np.fromiter((float(q.get('chg_pct', 0) or 0) for q in rows), dtype=float, count=n)
+    stale = np.fromiter((bool(q.get('stale', False)) for q in rows), dtype=bool, count=n)
+    return price, chg, chg_pct, stale
+
+def value_portfolio(holdings, quotes, fx_rates, names=None, basis=None):
+    """
+    持股估值 (向量化)：市值、成本、負債、日損益、總損益、報酬率與占比。
+    holdings: data['h']；quotes: {代碼: {'p','chg','chg_pct'}}；fx_rates: {幣別: 對台幣匯率}；names: 代碼對應名稱
+    basis: cost_basis_twd() 的台幣成本 (買進當天匯率)，總損益因此包含匯兌損益；沒有時以目前匯率換算成本。
+    回傳每檔一列的 DataFrame，可直接給表格與熱力圖使用。
+    """
+    names = names or {}
+    codes, shares, cost, debt = holdings_arrays(holdings)
+    price, chg, chg_pct, stale = quote_arrays(codes, quotes)
+    rate = rate_array(codes, fx_rates)
+
+    # 抓不到報價時以成本價計算
+    cur_p = np.where(price > 0, price, cost)
+
+    mkt_val = cur_p * shares * rate
+    cost_val = cost * shares * rate
+    if basis:
+        cost_val = np.fromiter((basis.get(c, v) for c, v in zip(codes, cost_val)), dtype=float, count=len(codes))
+    actual_principal = cost_val - debt
+    total_profit = mkt_val - cost_val
+    with np.errstate(divide='ignore', invalid='ignore'):
+        total_profit_pct = np.where(actual_principal > 0, total_profit / actual_principal, 0.0)
+    day_profit = chg * shares * rate
+
+    total_mkt = mkt_val.sum()
+    weight = mkt_val / total_mkt if total_mkt > 0 else np.zeros(len(codes))
+
+    return pd.DataFrame({
+        'raw_code': codes, '股票代碼': codes, '公司名稱': [names.get(c, c) for c in codes],
+        '股數': shares.astype(int), '成本': cost, '現價': cur_p,
+        '日損益%': chg_pct / 100, '日損益': day_profit,
+        '總損益%': total_profit_pct, '總損益': total_profit,
+        '市值': mkt_val, 'mkt_val_raw': mkt_val, '占比': weight,
+        'cost_val': cost_val, 'debt': debt, 'stale': stale,
+    })
+
+def cost_basis_twd(holdings, daily_rates):
+    """
+    以各批買進當天的匯率換算的台幣成本 (未扣融資)，回傳 {代碼: 金額}。
+    daily_rates: FxTable.daily() 的日期 x 幣別表；同一檔以各批金額加權的平均匯率乘上累計成本。
+    """
+    basis = {}
+    lot_code, lot_date, lot_amt = [], [], []
+    for code, pos in holdings.items():
+        if currency_of(code) == BASE_CURRENCY:
+            basis[code] = pos.cost_total
+            continue
+        for lot in pos.iter_lots():
+            lot_code.append(code); lot_date.append(lot.d); lot_amt.append(lot.p * lot.s)
+    if not lot_code: return basis
+
+    lots = pd.DataFrame({'code': lot_code, 'amt': lot_amt})
+    lots['twd'] = lots['amt'] * rates_on(daily_rates, [currency_of(c) for c in lot_code], lot_date)
+    sums = lots.groupby('code')[['amt', 'twd']].sum()
+    for code, row in sums.iterrows():
+        cost_total = holdings[code].cost_total
+        basis[code] = cost_total * row['twd'] / row['amt'] if row['amt'] else 0.0
+    return basis
+
+def sell_basis_twd(pos, qty, daily_rates, method=DEFAULT_COST_METHOD, lot_ids=None):
+    """
+    賣出 qty 股的台幣成本：以實際會被扣除的各批 (在副本上試算賣出) 買進當天的匯率換算；
+    平均成本法以整檔的平均台幣成本計。daily_rates 同 cost_basis_twd()。
+    """
+    if qty <= 0 or not pos.shares: return 0.0
+    if method == 'AVG':
+        return cost_basis_twd({pos.code: pos}, daily_rates)[pos.code] * qty / pos.shares
+    before = {lot.id: (lot.d, lot.p, lot.s) for lot in pos.iter_lots()}
+    trial = copy.deepcopy(pos)
+    trial.sell(qty, method, lot_ids)
+    after = {lot.id: lot.s for lot in trial.iter_lots()}
+    taken = [(d, p * (s - after.get(lot_id, 0))) for lot_id, (d, p, s) in before.items() if s > after.get(lot_id, 0)]
+    if not taken: return 0.0
+    days, amount = zip(*taken)
+    return float(np.dot(amount, rates_on(daily_rates, [currency_of(pos.code)] * len(days), days)))
+
+def summarize_portfolio(positions, cash, principal, realized_profit=0.0):
+    """由估值結果計算帳戶總覽 (淨資產、損益、ROI)"""
+    total_mkt_val = float(positions['市值'].sum())
+    total_cost_val = float(positions['cost_val'].sum())
+    total_debt = float(positions['debt'].sum())
+    total_day_profit = float(positions['日損益'].sum())
+
+    net_asset = (total_mkt_val + cash) - total_debt
+    unrealized_profit = total_mkt_val - total_cost_val
+
+    # 總損益 = 未實現 + 已實現；ROI = 總損益 / 本金
+    total_profit_sum = unrealized_profit + realized_profit
+    roi_basis = principal if principal > 0 else 1
+    total_roi_pct = (total_profit_sum / roi_basis) * 100
+
+    return {
+        'net_asset': net_asset,
+        'cash': cash,
+        'total_mkt_val': total_mkt_val,
+        'total_debt': total_debt,
+        'current_principal': principal,
+        'total_day_profit': total_day_profit,
+        'unrealized_profit': unrealized_profit,
+        'total_realized_profit': realized_profit,
+        'total_profit_sum': total_profit_sum,
+        'total_roi_pct': total_roi_pct,
+    }
+
+def value_account(data, quotes, fx_rates, names=None, basis=None):
+    """單一使用者的完整估值：持股明細 (positions) 加上帳戶總覽，頁面與批次估值共用"""
+    positions = value_portfolio(data.get('h', {}), quotes, fx_rates, names, basis)
+    principal = data.get('principal', data.get('cash', 0))
+    summary = summarize_portfolio(positions, data.get('cash', 0), principal, realized_index(data).total_profit)
+    return {**summary, 'positions': positions}